@@ -0,0 +1,71 @@
+"""Server CPU cost of /download with and without zero-copy sendfile.
+
+Starts the Flask app on localhost, pulls one large shared file repeatedly
+from a separate client process and reports the server's CPU seconds per
+GB served for the buffered and the sendfile engines.
+
+    python benchmarks/download_cpu.py --size-mb 512 --rounds 4
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLIENT = """
+import sys, urllib.request
+url, rounds = sys.argv[1], int(sys.argv[2])
+for _ in range(rounds):
+    with urllib.request.urlopen(url) as response:
+        while response.read(1024 * 1024):
+            pass
+"""
+
+def run(size_mb, rounds):
+    workdir = tempfile.mkdtemp(prefix='ft-bench-')
+    os.chdir(workdir)
+    sys.path.insert(0, SRC_DIR)
+    import file_transfer_app as fta
+    from werkzeug.serving import make_server
+
+    fta.log_message = lambda message: None
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    filepath = os.path.join(fta.UPLOAD_FOLDER, 'bench.bin')
+    with open(filepath, 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size_mb):
+            f.write(block)
+
+    server = make_server('127.0.0.1', 0, fta.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/download/bench.bin'
+
+    results = {}
+    gigabytes = size_mb * rounds / 1024
+    for engine, zero_copy in (('buffered', False), ('sendfile', True)):
+        fta.ZERO_COPY_DOWNLOADS = zero_copy
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        subprocess.run([sys.executable, '-c', CLIENT, url, str(rounds)], check=True)
+        cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+        results[engine] = {
+            'cpu_seconds_per_gb': round(cpu / gigabytes, 3),
+            'throughput_mb_s': round(size_mb * rounds / wall, 1)
+        }
+    server.shutdown()
+    os.chdir(SRC_DIR)
+    shutil.rmtree(workdir)
+    return {'file_mb': size_mb, 'rounds': rounds, 'results': results}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--rounds', type=int, default=4)
+    args = parser.parse_args()
+    print(json.dumps(run(args.size_mb, args.rounds), indent=2))
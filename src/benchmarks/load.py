@@ -0,0 +1,283 @@
+"""Load generator for uploads, downloads and listings.
+
+Starts the app headless on localhost in a child process and drives it with
+concurrent keep-alive clients for a fixed time, then times /list_files
+against share folders of different sizes. Prints one JSON document (MB/s,
+p50/p95/p99 latency, server CPU and RSS) meant to be diffed between versions.
+Transfers wait for their turn at /queue like the browser does, and that wait
+counts towards their latency.
+
+    python benchmarks/load.py --clients 16 --sizes 4K:8,1M:4,64M:1 --mix upload=1,download=2,list=1
+    python benchmarks/load.py --duration 30 --list-sizes 10,1000,100000 --output before.json
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BLOCK = os.urandom(1024 * 1024)
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Serves the app from the working directory until stdin closes; every 'usage'
+# line is answered with the process's CPU time and memory
+SERVER = """
+import json, os, sys, threading
+sys.path.insert(0, sys.argv[1])
+import file_transfer_app as fta
+fta.log_message = lambda message: None
+engine = fta.AsyncTransferServer if sys.argv[2] == 'asyncio' else fta.TransferServer
+server = engine(fta.app, '127.0.0.1', 0)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+print(server.server_address[1], flush=True)
+for line in sys.stdin:
+    times = os.times()
+    usage = {'cpu_seconds': times.user + times.system, 'rss_mb': None, 'peak_rss_mb': None}
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage['peak_rss_mb'] = round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+        with open('/proc/self/statm') as f:
+            usage['rss_mb'] = round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2, 1)
+    except (ImportError, OSError):
+        pass
+    print(json.dumps(usage), flush=True)
+"""
+
+class Server:
+    def __init__(self, workdir, engine):
+        self.process = subprocess.Popen([sys.executable, '-c', SERVER, SRC_DIR, engine], cwd=workdir,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.port = int(self.process.stdout.readline())
+
+    def usage(self):
+        self.process.stdin.write('usage\n')
+        self.process.stdin.flush()
+        return json.loads(self.process.stdout.readline())
+
+    def stop(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+def parse_size(text):
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+def parse_weights(text, parse_key):
+    # 'a:2,b' or 'a=2,b' -> {a: 2.0, b: 1.0}
+    weights = {}
+    for item in text.split(','):
+        key, _, weight = item.replace('=', ':').partition(':')
+        weights[parse_key(key)] = float(weight or 1)
+    return weights
+
+def write_file(path, size):
+    with open(path, 'wb') as f:
+        for offset in range(0, size, len(BLOCK)):
+            f.write(BLOCK[:min(len(BLOCK), size - offset)])
+
+def iter_upload(name, size, boundary):
+    yield (f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{name}"\r\n'
+           'Content-Type: application/octet-stream\r\n\r\n').encode()
+    # A fresh prefix per upload, so the server cannot answer from its dedup store
+    first = os.urandom(min(16, size))
+    yield first
+    offset = len(first)
+    while offset < size:
+        data = BLOCK[:min(len(BLOCK), size - offset)]
+        offset += len(data)
+        yield data
+    yield f'\r\n--{boundary}--\r\n'.encode()
+
+def percentiles(values):
+    if not values:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    values = sorted(values)
+    pick = lambda p: round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 2)
+    return {'p50_ms': pick(50), 'p95_ms': pick(95), 'p99_ms': pick(99)}
+
+def request(conn, method, path, body=None, headers=None):
+    started = time.perf_counter()
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    received = 0
+    while True:
+        data = response.read(1024 * 1024)
+        if not data:
+            break
+        received += len(data)
+    if response.status >= 400:
+        raise http.client.HTTPException(f'{method} {path}: {response.status}')
+    return time.perf_counter() - started, received
+
+def wait_turn(conn, direction, size):
+    # Asks /queue for a slot until the server has one; the ticket claims it
+    ticket = None
+    while True:
+        conn.request('GET', f'/queue/{direction}?size={size}', headers={'X-Queue-Ticket': ticket or ''})
+        response = conn.getresponse()
+        data = json.loads(response.read() or b'{}')
+        if response.status == 200:
+            return data.get('ticket')
+        if response.status != 503:
+            raise http.client.HTTPException(f'GET /queue/{direction}: {response.status}')
+        ticket = data.get('ticket')
+        time.sleep(float(response.getheader('Retry-After') or 1))
+
+def run_client(port, deadline, sizes, mix, seed, results, lock):
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    operations, op_weights = list(mix), list(mix.values())
+    size_list, size_weights = list(sizes), list(sizes.values())
+    count = 0
+    while time.perf_counter() < deadline:
+        op = rng.choices(operations, op_weights)[0]
+        size = rng.choices(size_list, size_weights)[0] if op != 'list' else 0
+        try:
+            if op == 'upload':
+                started = time.perf_counter()
+                ticket = wait_turn(conn, 'upload', size)
+                boundary = f'bench{seed}x{count}'
+                length = sum(len(part) for part in iter_upload(f'up-{seed}-{count}.bin', 0, boundary)) + size
+                elapsed, _ = request(conn, 'POST', '/upload', iter_upload(f'up-{seed}-{count}.bin', size, boundary),
+                                     {'Content-Type': f'multipart/form-data; boundary={boundary}',
+                                      'Content-Length': str(length), 'X-Queue-Ticket': ticket or ''})
+                elapsed, moved = time.perf_counter() - started, size
+            elif op == 'download':
+                started = time.perf_counter()
+                ticket = wait_turn(conn, 'download', size)
+                _, moved = request(conn, 'GET', f'/download/bench-{size}.bin', headers={'X-Queue-Ticket': ticket or ''})
+                elapsed = time.perf_counter() - started
+            else:
+                elapsed, moved = request(conn, 'GET', '/list_files')
+            sample = (op, size, elapsed, moved, None)
+        except (OSError, http.client.HTTPException) as e:
+            sample = (op, size, None, 0, type(e).__name__)
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        with lock:
+            results.append(sample)
+        count += 1
+    conn.close()
+
+def summarize(samples, wall):
+    ok = [s for s in samples if s[4] is None]
+    errors = {}
+    for s in samples:
+        if s[4] is not None:
+            errors[s[4]] = errors.get(s[4], 0) + 1
+    moved = sum(s[3] for s in ok)
+    summary = {'requests': len(ok), 'errors': errors, 'mb': round(moved / 1024 ** 2, 1),
+               'mb_per_s': round(moved / 1024 ** 2 / wall, 1), 'requests_per_s': round(len(ok) / wall, 1)}
+    summary.update(percentiles([s[2] for s in ok]))
+    return summary
+
+def run_load(engine, clients, duration, sizes, mix, seed):
+    workdir = tempfile.mkdtemp(prefix='ft-load-')
+    try:
+        os.makedirs(os.path.join(workdir, 'uploads'))
+        for size in sizes:
+            write_file(os.path.join(workdir, 'uploads', f'bench-{size}.bin'), size)
+        server = Server(workdir, engine)
+        try:
+            results, lock = [], threading.Lock()
+            before = server.usage()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                for i in range(clients):
+                    pool.submit(run_client, server.port, started + duration, sizes, mix, seed + i, results, lock)
+            wall = time.perf_counter() - started
+            after = server.usage()
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'wall_seconds': round(wall, 2), 'total': summarize(results, wall), 'operations': {}}
+    for op in mix:
+        by_op = [s for s in results if s[0] == op]
+        report['operations'][op] = summarize(by_op, wall)
+        if op != 'list':
+            report['operations'][op]['by_size'] = {
+                str(size): summarize([s for s in by_op if s[1] == size], wall) for size in sizes}
+    cpu = after['cpu_seconds'] - before['cpu_seconds']
+    moved_gb = sum(s[3] for s in results if s[4] is None) / 1024 ** 3
+    report['server'] = {'cpu_seconds': round(cpu, 2), 'cpu_percent': round(100 * cpu / wall, 1),
+                        'cpu_seconds_per_gb': round(cpu / moved_gb, 3) if moved_gb else None,
+                        'rss_mb': after['rss_mb'], 'peak_rss_mb': after['peak_rss_mb']}
+    return report
+
+def run_listing(engine, count, rounds):
+    workdir = tempfile.mkdtemp(prefix='ft-list-')
+    try:
+        shared = os.path.join(workdir, 'uploads')
+        os.makedirs(shared)
+        for i in range(count):
+            with open(os.path.join(shared, f'file-{i:06d}.txt'), 'wb') as f:
+                f.write(b'x' * (i % 4096))
+        server = Server(workdir, engine)
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=600)
+            first, size = request(conn, 'GET', '/list_files')
+            report = {'files': count, 'first_ms': round(first * 1000, 2), 'response_kb': round(size / 1024, 1)}
+            for label, path in (('full', '/list_files'), ('page', '/list_files?limit=200')):
+                report[label] = percentiles([request(conn, 'GET', path)[0] for _ in range(rounds)])
+            conn.close()
+            report['server'] = server.usage()
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engine', choices=['production', 'asyncio'], default='production')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=15, help='seconds of mixed load')
+    parser.add_argument('--sizes', default='4K:8,256K:4,4M:2,64M:1',
+                        help='file sizes with optional weights, e.g. 4K:8,1M,4G:1')
+    parser.add_argument('--mix', default='upload=1,download=2,list=1', help='operation weights')
+    parser.add_argument('--list-sizes', default='10,1000,10000,100000',
+                        help='share folder sizes for the listing test; empty to skip')
+    parser.add_argument('--list-rounds', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    mix = {op: weight for op, weight in parse_weights(args.mix, str.strip).items() if weight > 0}
+    unknown = set(mix) - {'upload', 'download', 'list'}
+    if unknown:
+        parser.error(f"unknown operations in --mix: {', '.join(sorted(unknown))}")
+    config = {'engine': args.engine, 'clients': args.clients, 'duration': args.duration,
+              'sizes': args.sizes, 'mix': args.mix, 'seed': args.seed}
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'cpus': os.cpu_count(), 'config': config,
+              'load': run_load(args.engine, args.clients, args.duration, parse_weights(args.sizes, parse_size),
+                               mix, args.seed),
+              'listing': [run_listing(args.engine, int(count), args.list_rounds)
+                          for count in args.list_sizes.split(',') if count.strip()]}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
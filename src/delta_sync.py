@@ -0,0 +1,89 @@
+"""Refresh a local copy of a shared file by pulling only what changed.
+
+Sends block signatures of the local copy to the server's /delta endpoint and
+rebuilds the new version from the copy/literal records it streams back. Needs
+nothing beyond the standard library, so it also runs on a phone (e.g. Termux).
+
+    python delta_sync.py http://192.168.1.20:8080 server.log ~/logs/server.log
+"""
+import argparse
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import urllib.error
+import urllib.request
+import zlib
+from urllib.parse import quote
+
+def pick_block_size(size):
+    # About 2000 blocks per file, a power of two between 1 KiB and 8 MiB
+    block_size = 1024
+    while block_size < 8 * 1024 * 1024 and size // block_size > 2000:
+        block_size *= 2
+    return block_size
+
+def signatures(path, block_size):
+    blocks = []
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(block_size), b''):
+            blocks.append([zlib.adler32(data), hashlib.sha256(data).hexdigest()[:16]])
+    return blocks
+
+def read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError('Delta stream ended early')
+    return data
+
+def apply_delta(stream, old_path, block_size, out):
+    received = 0
+    hasher = hashlib.sha256()
+    with open(old_path, 'rb') as old:
+        while True:
+            op = read_exact(stream, 1)
+            if op == b'C':
+                start, count = struct.unpack('>II', read_exact(stream, 8))
+                old.seek(start * block_size)
+                data = old.read(count * block_size)
+            elif op == b'L':
+                length, = struct.unpack('>I', read_exact(stream, 4))
+                data = read_exact(stream, length)
+                received += length
+            elif op == b'E':
+                if read_exact(stream, 32) != hasher.digest():
+                    raise ValueError('Rebuilt file does not match the server copy')
+                return received
+            else:
+                raise ValueError(f'Unknown delta record {op!r}')
+            hasher.update(data)
+            out.write(data)
+
+def sync(server, name, path):
+    size = os.path.getsize(path)
+    block_size = pick_block_size(size)
+    body = json.dumps({'block_size': block_size, 'size': size, 'blocks': signatures(path, block_size)}).encode()
+    url = f"{server.rstrip('/')}/delta/{quote(name)}"
+    req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as out, urllib.request.urlopen(req) as response:
+            received = apply_delta(response, path, block_size, out)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return {'file_size': os.path.getsize(path), 'literal_bytes': received, 'signature_bytes': len(body)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('server', help='e.g. http://192.168.1.20:8080')
+    parser.add_argument('name', help='name of the shared file')
+    parser.add_argument('path', help='local copy to update in place')
+    args = parser.parse_args()
+    try:
+        print(json.dumps(sync(args.server, args.name, args.path), indent=2))
+    except (urllib.error.URLError, ValueError, OSError) as e:
+        sys.exit(f'Delta sync failed: {e}')
@@ -1,24 +1,185 @@
 import os
 import socket
 import threading
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, Response, g
 import tkinter as tk
-from tkinter import scrolledtext, filedialog, messagebox
+from tkinter import scrolledtext, filedialog, messagebox, ttk
 from datetime import datetime
 import shutil
+import json
+import uuid
+import tempfile
+import mimetypes
+import sys
+import io
+import http.server
+import asyncio
+import argparse
+import time
+import base64
+import bisect
+import collections
+import contextlib
+import functools
+import random
+import cProfile
+import pstats
+import marshal
+import queue
+import zipfile
+import subprocess
+import zlib
+import struct
+import hashlib
+import errno
+import logging
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote_to_bytes, parse_qs
+from werkzeug.utils import secure_filename
+from werkzeug.http import http_date, parse_date, parse_options_header
+from werkzeug.datastructures import Headers
+from werkzeug.wsgi import LimitedStream
+from werkzeug.sansio.multipart import MultipartDecoder, File, Field, Data, Epilogue, NeedData
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
 
 app = Flask(__name__)
 
 # Configuration
 DOWNLOAD_FOLDER = os.path.join(os.getcwd(), 'downloads')
 UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')
+CACHE_FOLDER = os.path.join(os.getcwd(), '.cache')
+PARTIAL_FOLDER = os.path.join(DOWNLOAD_FOLDER, '.partial')
+STORE_FOLDER = os.path.join(DOWNLOAD_FOLDER, '.store')
+SHARE_PARTIAL_FOLDER = os.path.join(UPLOAD_FOLDER, '.partial')
+CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_CONNECTIONS = 6
+UPLOAD_SESSION_TTL = 24 * 3600  # an upload session with no new data for this long is removed
+UPLOAD_SESSION_EMPTY_TTL = 15 * 60  # the same for a session that never received any data
+HASH_BUFFER_LIMIT = 32 * 1024 * 1024  # out-of-order bytes per upload held in memory until they can be hashed
+COPY_BUFFER_SIZE = 64 * 1024
+STREAMING_UPLOADS = True
+DISK_SPACE_RESERVE = 64 * 1024 * 1024  # kept free on the received-files disk
+PREALLOCATE_UPLOADS = True
+PREALLOCATE_MIN_SIZE = 1024 * 1024
+DEDUP_RECEIVED_FILES = True
+SAMPLE_HASH_SIZE = 64 * 1024
+MAX_PRECHECK_FILES = 10000
+CHECKSUM_SAVE_DELAY = 2
+DELTA_MIN_BLOCK_SIZE = 1024
+DELTA_MAX_BLOCK_SIZE = 8 * 1024 * 1024
+MAX_DELTA_BLOCKS = 1024 * 1024
+DELTA_SCAN_LIMIT = 16 * 1024 * 1024  # unmatched bytes rolled through before only block boundaries are tried
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+MAX_CONTENT_LENGTH = 64 * 1024 ** 3  # largest compressed request body accepted, counted once decoded
+ZSTD_INPUT_STEP = 256  # zstd input per call; 4 bytes can expand to 128 KB, so at most about 8 MB out
+MAX_RANGES = 16
+ZERO_COPY_DOWNLOADS = True
+SENDFILE_CHUNK_SIZE = 8 * 1024 * 1024
+LOG_HISTORY_LINES = 2000
+LOG_QUEUE_LIMIT = 10000
+LOG_DRAIN_BATCH = 500
+LOG_DRAIN_INTERVAL = 100  # ms
+LOG_FILE = None
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(-4, 11))  # 64 KiB/s .. 1 GiB/s
+THROUGHPUT_MIN_BYTES = 256 * 1024
+DASHBOARD_INTERVAL = 1000  # ms
+SPARKLINE_POINTS = 60
+PROFILING = False
+PROFILE_SAMPLE_RATE = 0.0  # share of profiled requests also run under cProfile
+PROFILE_TOP_FUNCTIONS = 30
+UPLOAD_LIMIT = 0  # bytes/s for all clients together, 0 for no limit
+DOWNLOAD_LIMIT = 0
+CLIENT_UPLOAD_LIMIT = 0  # bytes/s per client IP
+CLIENT_DOWNLOAD_LIMIT = 0
+SHAPING_BURST = 0.25  # seconds of traffic a bucket may send at once
+SHAPING_QUANTUM = 256 * 1024
+SHAPING_REBALANCE_INTERVAL = 0.5
+SHAPING_IDLE_TIMEOUT = 5
+MAX_ACTIVE_UPLOADS = 4  # 0 for no limit
+MAX_ACTIVE_DOWNLOADS = 8
+MAX_QUEUED_TRANSFERS = 64  # per direction; beyond this a request gets a 503 without a ticket
+QUEUE_MIN_SIZE = 1024 * 1024  # smaller transfers never wait; they are done before they could thrash the disk
+QUEUE_RETRY_AFTER = 1  # seconds a queued client waits before asking again
+QUEUE_TICKET_TTL = 6  # a ticket not renewed for this long loses its place
+QUEUE_HOLD_TIMEOUT = 3  # a slot set aside for a queued client is given up after this long
+ADMISSION_LINGER = 5  # an upload session keeps its slot this long between segments
+SERVER_PORT = 8080
+SERVER_MODE = 'production'  # 'asyncio' for the event-loop engine, 'development' for Flask's server
+MAX_WORKERS = 32
+LISTEN_BACKLOG = 128
+CONNECTION_TIMEOUT = 60
+KEEPALIVE_TIMEOUT = 15
+SHUTDOWN_TIMEOUT = 5  # seconds connections get to finish up when the server stops
+ASYNC_IO_WORKERS = 8
+MAX_DRAIN_SIZE = 1024 * 1024
+INDEX_RESCAN_INTERVAL = 30
+LIST_PAGE_SIZE = 200
+MAX_LIST_PAGE_SIZE = 1000
+WATCH_INTERVAL = 2
+HOUSEKEEPING_INTERVAL = 60
+EVENT_QUEUE_SIZE = 256
+EVENT_KEEPALIVE_INTERVAL = 15
+ZIP_COMPRESS_LEVEL = 1
+COMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif',
+    '.mp4', '.mov', '.m4v', '.mkv', '.webm', '.avi', '.3gp',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.apk', '.docx', '.xlsx', '.pptx'
+}
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_MAX_SIZE = 64 * 1024 * 1024  # larger files go out as is: sendfile, Content-Length and ranges
+COMPRESSION_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'compressed')
+COMPRESSION_CACHE_SIZE = 256 * 1024 * 1024
+COMPRESSION_CACHE_MAX_FILE = 64 * 1024 * 1024
+THUMBNAIL_SIZE = 256
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_TIMEOUT = 30
+THUMBNAIL_RETRY_AFTER = 1  # seconds; previews still being made answer 202
+THUMBNAIL_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'thumbnails')
+THUMBNAIL_CACHE_SIZE = 128 * 1024 * 1024
+THUMBNAIL_IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tif', '.tiff', '.heic', '.heif', '.avif'}
+THUMBNAIL_VIDEO_EXTENSIONS = {'.mp4', '.mov', '.m4v', '.mkv', '.webm', '.avi', '.3gp'}
 os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(PARTIAL_FOLDER, exist_ok=True)
+os.makedirs(STORE_FOLDER, exist_ok=True)
+os.makedirs(SHARE_PARTIAL_FOLDER, exist_ok=True)
 
 # Global variables
 log_widget = None
+log_queue = queue.SimpleQueue()
+log_dropped = 0
+file_logger = None
 server_thread = None
 server_running = False
+http_server = None
+share_watcher = None
+housekeeper = None
+upload_sessions = {}
+upload_sessions_lock = threading.Lock()
 
 def get_local_ip():
     try:
@@ -31,14 +192,2494 @@ def get_local_ip():
         return "127.0.0.1"
 
 def log_message(message):
-    timestamp = datetime.now().strftime("%H:%M:%S")
-    log_text = f"[{timestamp}] {message}\n"
-    if log_widget:
-        log_widget.insert(tk.END, log_text)
-        log_widget.see(tk.END)
+    # Safe from any thread: records are queued and the Tk main loop drains them
+    global log_dropped
+    with profile_phase('log_message'):
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        if log_queue.qsize() < LOG_QUEUE_LIMIT:
+            log_queue.put(f"[{timestamp}] {message}\n")
+        else:
+            log_dropped += 1
+        if file_logger is not None:
+            file_logger.info(message)
+
+def start_log_file(path):
+    # Rotating log written by a listener thread, so requests never wait on the disk
+    global file_logger
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=LOG_FILE_MAX_BYTES,
+                                                   backupCount=LOG_FILE_BACKUPS, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    records = queue.SimpleQueue()
+    logging.handlers.QueueListener(records, handler).start()
+    logger = logging.getLogger('file_transfer')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    file_logger = logger
+
+def drain_log_queue():
+    # Oldest records past what the widget keeps are dropped unseen
+    global log_dropped
+    skipped = 0
+    while log_queue.qsize() > LOG_HISTORY_LINES:
+        try:
+            log_queue.get_nowait()
+            skipped += 1
+        except queue.Empty:
+            break
+    lines = []
+    while len(lines) < LOG_DRAIN_BATCH:
+        try:
+            lines.append(log_queue.get_nowait())
+        except queue.Empty:
+            break
+    skipped, log_dropped = skipped + log_dropped, 0
+    if skipped:
+        lines.insert(0, f"[{datetime.now().strftime('%H:%M:%S')}] ... {skipped} older messages not shown\n")
+    return lines
+
+# Metrics
+# Prometheus text exposition without the client library. Each family has its
+# own lock and an update is a dict lookup plus an add, so it stays on.
+def format_labels(names, values):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {} if labels else {(): 0}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f'{self.name}{format_labels(self.labels, key)} {value}' for key, value in values]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.labels = labels
+        self.values = {}  # labels -> [count per bucket..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, list(counts)) for key, counts in self.values.items())
+        lines = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{format_labels(self.labels + ("le",), key + (bound,))} {total}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {counts[-1]:.6f}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {total}')
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self.families = []
+        self.requests = self.add(Counter(
+            'filetransfer_requests_total', 'HTTP requests handled', ('endpoint', 'status')))
+        self.latency = self.add(Histogram(
+            'filetransfer_request_duration_seconds', 'Time from request to the last body byte',
+            LATENCY_BUCKETS, ('endpoint',)))
+        self.throughput = self.add(Histogram(
+            'filetransfer_transfer_throughput_bytes_per_second',
+            f'Throughput of uploads and downloads of at least {THROUGHPUT_MIN_BYTES} bytes',
+            THROUGHPUT_BUCKETS, ('direction',)))
+        self.bytes_received = self.add(Counter('filetransfer_received_bytes_total', 'Request body bytes read'))
+        self.bytes_sent = self.add(Counter('filetransfer_sent_bytes_total', 'Response body bytes sent'))
+        self.files_received = self.add(Counter('filetransfer_received_files_total', 'Files stored from uploads'))
+        self.files_sent = self.add(Counter('filetransfer_sent_files_total', 'Complete file downloads'))
+        self.errors = self.add(Counter('filetransfer_errors_total', 'Failed requests and transfers', ('type',)))
+        self.active_transfers = self.add(Gauge(
+            'filetransfer_active_transfers', 'Uploads and downloads in progress', ('direction',)))
+        self.open_connections = self.add(Gauge('filetransfer_open_connections', 'Client connections held open'))
+
+    def add(self, family):
+        self.families.append(family)
+        return family
+
+    def record(self, endpoint, status, started, received=0, sent=0, direction=None):
+        elapsed = time.perf_counter() - started
+        self.requests.inc(endpoint, str(status))
+        self.latency.observe(elapsed, endpoint)
+        if status >= 400:
+            self.errors.inc(f'http_{status}')
+        if received:
+            self.bytes_received.inc(amount=received)
+        if sent:
+            self.bytes_sent.inc(amount=sent)
+        if direction is not None:
+            self.active_transfers.dec(direction)
+            moved = received if direction == 'upload' else sent
+            if moved >= THROUGHPUT_MIN_BYTES and elapsed > 0:
+                self.throughput.observe(moved / elapsed, direction)
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            lines.append(f'# HELP {family.name} {family.help_text}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            lines.extend(family.samples())
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class CountingReader:
+    # Stands in for wsgi.input so a view's request body is counted as it is
+    # read; given a client, uploads are also held to its bandwidth share here
+    def __init__(self, stream, client=None):
+        self.stream = stream
+        self.count = 0
+        self.client = client
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.received(len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self.stream.readline(size)
+        self.received(len(data))
+        return data
+
+    def readinto(self, buffer):
+        count = self.stream.readinto(buffer)
+        self.received(count or 0)
+        return count
+
+    def received(self, count):
+        self.count += count
+        if self.client is not None and count:
+            delay = upload_shaper.reserve(self.client, count)
+            if delay > 0:
+                time.sleep(delay)
+
+class CountingBody:
+    # Streamed response body that counts what the server pulled from it;
+    # given a client, it is also held to that client's download share
+    def __init__(self, iterable, client=None):
+        self.iterable = iterable
+        self.count = 0
+        self.finished = False
+        self.client = client
+
+    def __iter__(self):
+        for data in self.iterable:
+            self.count += len(data)
+            yield data
+            if self.client is not None and data:
+                delay = download_shaper.reserve(self.client, len(data))
+                if delay > 0:
+                    time.sleep(delay)
+        self.finished = True
+
+def instrumented(endpoint, direction=None, sends_file=False):
+    # Counts and times a view. Streamed bodies are measured when the server
+    # closes them, so latency and throughput cover the whole transfer.
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            # The asyncio engine shapes bodies it reads ahead while they arrive
+            shaped = direction == 'upload' and not request.environ.get('filetransfer.shaped')
+            body_in = request.environ['wsgi.input'] = CountingReader(request.environ['wsgi.input'],
+                                                                    request.remote_addr if shaped else None)
+            transfer = None
+            if direction is not None:
+                metrics.active_transfers.inc(direction)
+                # Views that know a better name or size update g.transfer
+                transfer = g.transfer = transfers.start(direction, request.remote_addr, kwargs.get('filename', ''))
+                if direction == 'upload':
+                    transfer.total = request.content_length
+                    transfer.sources.append(lambda: body_in.count)
+            profile = profiler.start(endpoint) if profiler.enabled else None
+            profiler.local.profile = profile
+            try:
+                response = app.make_response(run_sampled(profile and profile.sampler,
+                                                         lambda: view(*args, **kwargs)))
+            except Exception as e:
+                metrics.errors.inc(type(e).__name__)
+                metrics.record(endpoint, 500, started, body_in.count, 0, direction)
+                if transfer is not None:
+                    transfers.finish(transfer)
+                if profile is not None:
+                    profiler.finish(profile)
+                raise
+            finally:
+                profiler.local.profile = None
+            status = response.status_code
+            head = request.method == 'HEAD'
+
+            def finish(sent, complete):
+                if transfer is not None:
+                    transfers.finish(transfer)
+                if profile is not None:
+                    profiler.finish(profile)
+                metrics.record(endpoint, status, started, body_in.count, sent, direction)
+                if not complete:
+                    metrics.errors.inc('incomplete_response')
+                elif sends_file and status == 200:
+                    metrics.files_sent.inc()
+
+            if isinstance(response.response, FileBody):
+                body = response.response
+                body.profile = profile
+                if direction == 'download':
+                    body.client = request.remote_addr
+                    transfer.total = body.content_length
+                    transfer.sources.append(lambda: body.sent)
+                body.call_on_close(lambda: finish(body.sent, head or body.sent == body.content_length))
+            elif response.is_streamed and not response.direct_passthrough:
+                iterable = response.response
+                if profile is not None and profile.sampler is not None:
+                    iterable = iter_sampled(iterable, profile.sampler)
+                body = response.response = CountingBody(iterable,
+                                                        request.remote_addr if direction == 'download' else None)
+                if direction == 'download':
+                    transfer.total = response.content_length
+                    transfer.sources.append(lambda: body.count)
+                response.call_on_close(lambda: finish(body.count, head or body.finished))
+            else:
+                finish(0 if head else response.content_length or 0, True)
+            return response
+        return wrapper
+    return decorate
+
+# Profiling
+# Off unless PROFILING is set (--profile or the GUI checkbox). Steps on the
+# transfer path run inside profile_phase(); with no active profile that is a
+# thread-local lookup returning a shared no-op context.
+NO_PHASE = contextlib.nullcontext()
+
+class Phase:
+    __slots__ = ('profile', 'name', 'started')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.profile.nested.append(0.0)
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        inner = self.profile.nested.pop()
+        self.profile.nested[-1] += inner
+        self.profile.add(self.name, elapsed - inner)
+
+class RequestProfile:
+    # Phase times are exclusive: time in a nested phase is not counted again in its parent
+    def __init__(self, endpoint, sampler=None):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.nested = [0.0]
+        self.sampler = sampler
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self.nested[-1] += seconds
+
+    def phase(self, name):
+        return Phase(self, name)
+
+class ProfileLocal(threading.local):
+    # A class default, so reading it never goes through AttributeError
+    profile = None
+
+class Profiler:
+    def __init__(self, enabled=PROFILING, sample_rate=PROFILE_SAMPLE_RATE):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.local = ProfileLocal()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.stats = None
+            self.sampled = 0
+
+    def start(self, endpoint):
+        sampler = cProfile.Profile() if self.sample_rate and random.random() < self.sample_rate else None
+        return RequestProfile(endpoint, sampler)
+
+    def finish(self, profile):
+        total = time.perf_counter() - profile.started
+        stats = None
+        if profile.sampler is not None:
+            try:
+                stats = pstats.Stats(profile.sampler)
+            except TypeError:
+                pass  # the sampler never got to run
+        with self.lock:
+            entry = self.endpoints.setdefault(profile.endpoint, {'requests': 0, 'seconds': 0.0,
+                                                                 'max_seconds': 0.0, 'phases': {}})
+            entry['requests'] += 1
+            entry['seconds'] += total
+            entry['max_seconds'] = max(entry['max_seconds'], total)
+            phases = entry['phases']
+            for name, seconds in profile.phases.items():
+                phases[name] = phases.get(name, 0.0) + seconds
+            phases['other'] = phases.get('other', 0.0) + max(0.0, total - sum(profile.phases.values()))
+            if stats is not None:
+                self.sampled += 1
+                if self.stats is None:
+                    self.stats = stats
+                else:
+                    self.stats.add(stats)
+
+    def report(self, top=PROFILE_TOP_FUNCTIONS):
+        with self.lock:
+            endpoints = {}
+            for endpoint, entry in sorted(self.endpoints.items()):
+                seconds = entry['seconds'] or 1e-9
+                endpoints[endpoint] = {
+                    'requests': entry['requests'],
+                    'mean_ms': round(1000 * entry['seconds'] / entry['requests'], 3),
+                    'max_ms': round(1000 * entry['max_seconds'], 3),
+                    'phases': {name: {'ms': round(1000 * value, 3), 'share': round(value / seconds, 4)}
+                               for name, value in sorted(entry['phases'].items(), key=lambda item: -item[1])}
+                }
+            functions = []
+            if self.stats is not None:
+                rows = sorted(self.stats.stats.items(), key=lambda item: -item[1][3])[:top]
+                for (filename, line, name), (_, calls, own, cumulative, _) in rows:
+                    functions.append({'function': f'{os.path.basename(filename)}:{line}({name})', 'calls': calls,
+                                      'own_ms': round(1000 * own, 3), 'cumulative_ms': round(1000 * cumulative, 3)})
+            return {'enabled': self.enabled, 'sample_rate': self.sample_rate, 'sampled_requests': self.sampled,
+                    'endpoints': endpoints, 'functions': functions}
+
+    def pstats_dump(self):
+        # Same bytes as Stats.dump_stats(), for python -m pstats or snakeviz
+        with self.lock:
+            return marshal.dumps(self.stats.stats) if self.stats is not None else None
+
+profiler = Profiler()
+
+def profile_phase(name):
+    profile = profiler.local.profile if profiler.enabled else None
+    return NO_PHASE if profile is None else Phase(profile, name)
+
+def phase_of(profile, name):
+    return NO_PHASE if profile is None else Phase(profile, name)
+
+def run_sampled(sampler, func, *args):
+    if sampler is None:
+        return func(*args)
+    try:
+        sampler.enable()
+    except ValueError:
+        return func(*args)  # Python 3.12+ allows one active profiler per process
+    try:
+        return func(*args)
+    finally:
+        sampler.disable()
+
+def iter_sampled(iterable, sampler):
+    iterator = iter(iterable)
+    while True:
+        data = run_sampled(sampler, next, iterator, None)
+        if data is None:
+            return
+        yield data
+
+# Live transfers
+class Transfer:
+    # One in-flight request. Progress is read from byte counters the request
+    # keeps anyway, so the transfer path does no extra work for the dashboard.
+    def __init__(self, direction, client, name, total=None):
+        self.direction = direction
+        self.client = client
+        self.name = name
+        self.total = total
+        self.started = time.monotonic()
+        self.sources = []
+        self.sampled = 0
+        # Segments of one resumable upload share a group; base() is what earlier segments stored
+        self.group = None
+        self.base = None
+
+    def moved(self):
+        return sum(source() for source in self.sources)
+
+class TransferRegistry:
+    def __init__(self, history=SPARKLINE_POINTS):
+        self.active = []
+        self.lock = threading.Lock()
+        self.unsampled = 0
+        self.last_sample = time.monotonic()
+        self.rows = {}
+        self.history = collections.deque([0] * history, maxlen=history)
+
+    def start(self, direction, client, name, total=None):
+        transfer = Transfer(direction, client, name, total)
+        with self.lock:
+            self.active.append(transfer)
+        return transfer
+
+    def finish(self, transfer):
+        with self.lock:
+            self.active.remove(transfer)
+            self.unsampled += transfer.moved() - transfer.sampled
+
+    def sample(self):
+        # Called at a fixed rate by the GUI: one row per file with its current
+        # and average rate, plus a point of aggregate bandwidth for the sparkline
+        now = time.monotonic()
+        with self.lock:
+            active = list(self.active)
+            moved, self.unsampled = self.unsampled, 0
+        rows = {}
+        for transfer in active:
+            done = transfer.moved()
+            moved += done - transfer.sampled
+            transfer.sampled = done
+            key = transfer.group or id(transfer)
+            row = rows.get(key)
+            if row is None:
+                base = transfer.base() if transfer.base else 0
+                row = rows[key] = {'direction': transfer.direction, 'client': transfer.client,
+                                   'name': transfer.name, 'total': transfer.total,
+                                   'done': base, 'base': base, 'started': transfer.started}
+            row['done'] += done
+            row['started'] = min(row['started'], transfer.started)
+        elapsed, self.last_sample = now - self.last_sample, now
+        self.history.append(moved / elapsed if elapsed > 0 else 0)
+
+        previous, self.rows = self.rows, {}
+        for key, row in rows.items():
+            if row['total'] is not None:
+                row['done'] = min(row['done'], row['total'])
+            first, last = previous.get(key) or ((row['started'], row['base']),) * 2
+            row['rate'] = (row['done'] - last[1]) / max(now - last[0], 1e-6)
+            row['average'] = (row['done'] - first[1]) / max(now - first[0], 1e-6)
+            row['eta'] = None
+            if row['total'] is not None and row['average'] > 0:
+                row['eta'] = (row['total'] - row['done']) / row['average']
+            self.rows[key] = (first, (now, row['done']))
+        return list(rows.values()), list(self.history)
+
+transfers = TransferRegistry()
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+# Bandwidth shaping
+class TokenBucket:
+    # Reservation style: a take may overdraw the bucket and the caller sleeps
+    # off the debt, so transfers never spin waiting for tokens
+    def __init__(self, rate):
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.configure(rate)
+
+    def configure(self, rate):
+        self.rate = rate
+        self.burst = max(rate * SHAPING_BURST, SHAPING_QUANTUM)
+        self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, amount, now):
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class ClientShare:
+    def __init__(self, rate, now):
+        self.bucket = TokenBucket(rate)
+        self.used = 0
+        self.throttled = False
+        self.seen = now
+
+class BandwidthShaper:
+    # One per direction: a bucket for the total and one per client IP. Every
+    # SHAPING_REBALANCE_INTERVAL the total is water-filled: clients that used
+    # less than their share keep what they used, and the rest is split evenly
+    # between the clients the shaper held back, so idle capacity is not lost.
+    def __init__(self, rate=0, client_rate=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.client_rate = client_rate
+        self.total = TokenBucket(rate)
+        self.clients = {}
+        self.window_started = time.monotonic()
+
+    @property
+    def active(self):
+        return self.rate > 0 or self.client_rate > 0
+
+    def configure(self, rate, client_rate):
+        with self.lock:
+            self.rate, self.client_rate = rate, client_rate
+            self.total.configure(rate)
+            self.rebalance(time.monotonic())
+
+    def fair_rate(self, share):
+        if self.client_rate and (not share or share > self.client_rate):
+            return self.client_rate
+        return share
+
+    def reserve(self, client, amount):
+        # Seconds the caller should wait after moving amount bytes for client
+        if not self.active:
+            return 0.0
+        now = time.monotonic()
+        with self.lock:
+            if now - self.window_started >= SHAPING_REBALANCE_INTERVAL:
+                self.rebalance(now)
+            share = self.clients.get(client)
+            if share is None:
+                share = self.clients[client] = ClientShare(
+                    self.fair_rate(self.rate / (len(self.clients) + 1)), now)
+            share.used += amount
+            share.seen = now
+            delay = max(share.bucket.reserve(amount, now), self.total.reserve(amount, now))
+            if delay > 0:
+                share.throttled = True
+        return delay
+
+    def rebalance(self, now):
+        elapsed = max(now - self.window_started, 1e-3)
+        self.window_started = now
+        for client in [c for c, share in self.clients.items() if now - share.seen > SHAPING_IDLE_TIMEOUT]:
+            del self.clients[client]
+        held = [share for share in self.clients.values() if share.throttled]
+        rate = self.rate
+        if rate and held:
+            free = rate - sum(share.used / elapsed for share in self.clients.values() if not share.throttled)
+            rate = max(free / len(held), self.rate / len(self.clients))
+        for share in self.clients.values():
+            share.bucket.configure(self.fair_rate(rate))
+            share.used, share.throttled = 0, False
+
+upload_shaper = BandwidthShaper(UPLOAD_LIMIT, CLIENT_UPLOAD_LIMIT)
+download_shaper = BandwidthShaper(DOWNLOAD_LIMIT, CLIENT_DOWNLOAD_LIMIT)
+
+# Admission control
+class QueueTicket:
+    # A place in line, kept as long as the client asks again within QUEUE_TICKET_TTL
+    def __init__(self, client, size, seq, now):
+        self.id = uuid.uuid4().hex
+        self.client = client
+        self.size = size
+        self.seq = seq
+        self.seen = now
+        # A held ticket has a slot set aside until it comes back, for QUEUE_HOLD_TIMEOUT
+        self.held = False
+        self.position = 0
+
+class Slot:
+    def __init__(self, key, client, linger):
+        self.key = key
+        self.client = client
+        self.users = 1
+        self.linger = linger
+        self.idle_since = None
+
+class TransferScheduler:
+    # One per direction, capping how many transfers run at once. Nothing waits
+    # on the server: a request that can't start gets a 503 with a ticket and asks
+    # again after Retry-After. Tickets rank by how many transfers their device
+    # already runs, then by size, so one photo from a phone doesn't sit behind a
+    # laptop's backup. A freed slot is held for the best waiting ticket rather
+    # than going to whoever happens to ask first.
+    def __init__(self, limit=0, queue_size=MAX_QUEUED_TRANSFERS):
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.queue_size = queue_size
+        self.running = {}
+        self.waiting = {}
+        self.next_seq = 0
+
+    @property
+    def active(self):
+        return self.limit > 0
+
+    def configure(self, limit):
+        with self.lock:
+            self.limit = limit
+            self.refresh(time.monotonic())
+
+    def admit(self, client, size=None, ticket_id=None, group=None, hold=False):
+        # (slot, None): start now and release the slot when done. (None, ticket):
+        # wait at ticket.position, or with position 0, a slot held for a probe.
+        # (None, None): the queue is full.
+        if size is not None and size < QUEUE_MIN_SIZE and ticket_id is None:
+            return Slot(None, client, False), None
+        now = time.monotonic()
+        with self.lock:
+            self.refresh(now)
+            slot = self.running.get(group) if group is not None else None
+            if slot is not None:
+                # Parallel segments of one resumable upload share its slot
+                slot.users += 1
+                slot.idle_since = None
+                return slot, None
+            ticket = self.waiting.pop(ticket_id, None) if ticket_id else None
+            queued = ticket is not None
+            if ticket is None:
+                ticket = QueueTicket(client, size, self.next_seq, now)
+                self.next_seq += 1
+            ticket.seen = now
+            if not ticket.held:
+                rank = self.rank()
+                free = self.free_slots()
+                ahead = sum(1 for other in self.waiting.values() if not other.held and rank(other) < rank(ticket))
+                if ahead >= free:
+                    if not queued and len(self.waiting) >= self.queue_size:
+                        return None, None
+                    ticket.position = ahead - max(free, 0) + 1
+                    self.waiting[ticket.id] = ticket
+                    return None, ticket
+            if hold:
+                ticket.held, ticket.position = True, 0
+                self.waiting[ticket.id] = ticket
+                return None, ticket
+            key = group if group is not None else ticket.id
+            slot = self.running[key] = Slot(key, client, group is not None)
+            return slot, None
+
+    def release(self, slot):
+        with self.lock:
+            slot.users -= 1
+            if slot.users > 0:
+                return
+            now = time.monotonic()
+            if slot.linger:
+                # The next segment usually follows within moments; keep the slot for it
+                slot.idle_since = now
+            elif self.running.get(slot.key) is slot:
+                del self.running[slot.key]
+            self.refresh(now)
+
+    def end_group(self, group):
+        with self.lock:
+            slot = self.running.get(group)
+            if slot is None:
+                return
+            slot.linger = False
+            if slot.users == 0:
+                del self.running[group]
+            self.refresh(time.monotonic())
+
+    def queued(self):
+        with self.lock:
+            self.refresh(time.monotonic())
+            return sum(1 for t in self.waiting.values() if not t.held)
+
+    def rank(self):
+        busy = collections.Counter(slot.client for slot in self.running.values())
+        return lambda t: (busy[t.client], float('inf') if t.size is None else t.size, t.seq)
+
+    def free_slots(self):
+        return self.limit - len(self.running) - sum(1 for t in self.waiting.values() if t.held)
+
+    def refresh(self, now):
+        # Drops tickets nobody came back for and upload slots left idle, then
+        # sets aside what is free for the tickets first in line
+        for ticket_id in [t.id for t in self.waiting.values()
+                          if now - t.seen > (QUEUE_HOLD_TIMEOUT if t.held else QUEUE_TICKET_TTL)]:
+            del self.waiting[ticket_id]
+        for key in [s.key for s in self.running.values()
+                    if s.idle_since is not None and now - s.idle_since > ADMISSION_LINGER]:
+            del self.running[key]
+        free = self.free_slots()
+        if free > 0:
+            for ticket in sorted((t for t in self.waiting.values() if not t.held), key=self.rank())[:free]:
+                ticket.held, ticket.position, ticket.seen = True, 0, now
+
+upload_queue = TransferScheduler(MAX_ACTIVE_UPLOADS)
+download_queue = TransferScheduler(MAX_ACTIVE_DOWNLOADS)
+transfer_queues = {'upload': upload_queue, 'download': download_queue}
+
+def queue_busy(ticket):
+    # Body and headers of the 503 for a request that has to wait; with no
+    # ticket the queue itself is full and the client starts over later
+    body = {'error': 'Server busy', 'retry_after': QUEUE_RETRY_AFTER}
+    headers = [('Retry-After', str(QUEUE_RETRY_AFTER))]
+    if ticket is None:
+        body['error'] = 'Transfer queue is full'
+    else:
+        body.update(ticket=ticket.id, position=ticket.position)
+        headers.append(('X-Queue-Ticket', ticket.id))
+    return body, headers
+
+def admitted(scheduler, size=None, group=None):
+    # Runs a view only when the scheduler has a slot for it. size and group are
+    # worked out from the view's arguments; the slot is released when the
+    # server closes the response, so a streamed download holds it to the end.
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not scheduler.active:
+                return view(*args, **kwargs)
+            ticket_id = request.headers.get('X-Queue-Ticket') or request.args.get('ticket')
+            slot, ticket = scheduler.admit(request.remote_addr, size and size(**kwargs), ticket_id,
+                                           group and group(**kwargs))
+            if slot is None:
+                body, headers = queue_busy(ticket)
+                return jsonify(body), 503, headers
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except Exception:
+                scheduler.release(slot)
+                raise
+            release = lambda: scheduler.release(slot)
+            if isinstance(response.response, FileBody):
+                response.response.call_on_close(release)
+            elif response.is_streamed:
+                response.call_on_close(release)
+            else:
+                release()
+            return response
+        return wrapper
+    return decorate
+
+# Disk space
+def check_free_space(size, folder=DOWNLOAD_FOLDER):
+    # None if size more bytes fit while leaving DISK_SPACE_RESERVE free; otherwise
+    # the body of a 507, sent before any of those bytes cross the network
+    if not size:
+        return None
+    try:
+        free = max(0, shutil.disk_usage(folder).free - DISK_SPACE_RESERVE)
+    except OSError:
+        return None
+    if size <= free:
+        return None
+    return {'error': f'Not enough free space on the computer: {format_size(size)} needed, '
+                     f'{format_size(free)} available', 'needed': size, 'available': free}
+
+def preallocate(fd, size):
+    # Reserves the file's blocks in one go, so a large upload is laid out in a
+    # few extents instead of growing a few KB at a time. Where the filesystem
+    # can't do it the file just grows as it is written; a full disk still raises.
+    if not PREALLOCATE_UPLOADS or size < PREALLOCATE_MIN_SIZE or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if is_disk_full(e):
+            raise
+
+def is_disk_full(e):
+    return isinstance(e, OSError) and e.errno in (errno.ENOSPC, getattr(errno, 'EDQUOT', errno.ENOSPC))
+
+# Resumable uploads
+class UploadSession:
+    def __init__(self, session_id, filename, size, ranges=None, allocated=False):
+        self.id = session_id
+        self.filename = filename
+        self.size = size
+        self.ranges = ranges or []
+        self.allocated = allocated
+        self.lock = threading.Lock()
+        self.reset_hash()
+
+    @property
+    def part_path(self):
+        return os.path.join(PARTIAL_FOLDER, self.id + '.part')
+
+    @property
+    def meta_path(self):
+        return os.path.join(PARTIAL_FOLDER, self.id + '.json')
+
+    def add_range(self, start, end):
+        if end <= start:
+            return
+        merged = []
+        for r_start, r_end in sorted(self.ranges + [[start, end]]):
+            if merged and r_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], r_end)
+            else:
+                merged.append([r_start, r_end])
+        self.ranges = merged
+
+    def received(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def is_complete(self):
+        return self.ranges == [[0, self.size]] or self.size == 0
+
+    def reset_hash(self):
+        # Bytes are hashed as the in-order frontier reaches them. Parallel segments
+        # run ahead of it, so their pieces wait in memory (up to HASH_BUFFER_LIMIT);
+        # only what did not fit is read back at finalize.
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.stale = False
+        self.clear_pending()
+
+    def clear_pending(self):
+        # Whatever was waiting is on disk too; finalize reads it from there
+        self.pending = {}
+        self.pending_starts = []
+        self.pending_size = 0
+
+    def overlaps_pending(self, offset, end):
+        i = bisect.bisect_left(self.pending_starts, offset)
+        if i < len(self.pending_starts) and self.pending_starts[i] < end:
+            return True
+        return i > 0 and self.pending_starts[i - 1] + len(self.pending[self.pending_starts[i - 1]]) > offset
+
+    def hash_piece(self, offset, data):
+        with self.lock:
+            if self.stale or not data:
+                return
+            if offset < self.hashed or self.overlaps_pending(offset, offset + len(data)):
+                # Bytes written twice may differ from what was hashed: hash the file at finalize
+                self.stale = True
+                self.clear_pending()
+                return
+            if offset > self.hashed:
+                if self.pending_size + len(data) <= HASH_BUFFER_LIMIT:
+                    self.pending[offset] = data
+                    bisect.insort(self.pending_starts, offset)
+                    self.pending_size += len(data)
+                return
+            self.hasher.update(data)
+            self.hashed += len(data)
+            while self.pending_starts and self.pending_starts[0] == self.hashed:
+                data = self.pending.pop(self.pending_starts.pop(0))
+                self.pending_size -= len(data)
+                self.hasher.update(data)
+                self.hashed += len(data)
+
+    def digest(self):
+        if self.stale:
+            self.reset_hash()
+        self.clear_pending()
+        with open(self.part_path, 'rb') as f:
+            f.seek(self.hashed)
+            while self.hashed < self.size:
+                data = f.read(min(COPY_BUFFER_SIZE, self.size - self.hashed))
+                if not data:
+                    break
+                self.hasher.update(data)
+                self.hashed += len(data)
+        return self.hasher.hexdigest()
+
+    def save(self):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'name': self.filename, 'size': self.size, 'ranges': self.ranges,
+                       'allocated': self.allocated}, f)
+        os.replace(tmp_path, self.meta_path)
+
+    def allocate(self):
+        # The part file starts sparse; its blocks are reserved when the first bytes
+        # arrive, so a session that never sends anything costs no disk space
+        with self.lock:
+            if self.allocated:
+                return
+            with open(self.part_path, 'r+b') as f:
+                preallocate(f.fileno(), self.size)
+            self.allocated = True
+            self.save()
+
+    def remove(self):
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.filename,
+            'size': self.size,
+            'ranges': self.ranges,
+            'received': self.received(),
+            'chunk_size': CHUNK_SIZE,
+            'max_connections': UPLOAD_CONNECTIONS
+        }
+
+    def write_at(self, fd, data, offset):
+        # Positional writes, so concurrent segments never share a file position
+        view = memoryview(data)
+        while view:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(fd, view, offset)
+            else:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+            view = view[written:]
+            offset += written
+
+    @classmethod
+    def load(cls, session_id):
+        meta_path = os.path.join(PARTIAL_FOLDER, session_id + '.json')
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return cls(session_id, meta['name'], meta['size'], meta['ranges'], meta.get('allocated', False))
+
+def get_upload_session(session_id):
+    # Session ids are uuid4 hex strings; anything else could escape PARTIAL_FOLDER
+    if len(session_id) != 32 or any(c not in '0123456789abcdef' for c in session_id):
+        return None
+    with upload_sessions_lock:
+        session = upload_sessions.get(session_id)
+        if session is None:
+            try:
+                session = UploadSession.load(session_id)
+            except (OSError, ValueError, KeyError):
+                return None
+            upload_sessions[session_id] = session
+        return session
+
+def expire_upload_sessions():
+    # Removes sessions nobody has sent data to for UPLOAD_SESSION_TTL (or that never
+    # got any within UPLOAD_SESSION_EMPTY_TTL), and part files left by a crash
+    now = time.time()
+    with os.scandir(PARTIAL_FOLDER) as it:
+        entries = [(entry.name, entry.stat()) for entry in it if entry.is_file()]
+    metas = {name[:-5] for name, _ in entries if name.endswith('.json')}
+    for name, st in entries:
+        if name.endswith('.json'):
+            session = get_upload_session(name[:-5])
+            if session is None:
+                continue
+            ttl = UPLOAD_SESSION_TTL if session.ranges else UPLOAD_SESSION_EMPTY_TTL
+            if now - st.st_mtime < ttl:
+                continue
+            with session.lock:
+                session.remove()
+            with upload_sessions_lock:
+                upload_sessions.pop(session.id, None)
+            upload_queue.end_group(session.id)
+            log_message(f"Upload expired: {session.filename} ({format_size(session.received())} of {format_size(session.size)})")
+        elif name.endswith('.part') and name[:-5] not in metas and now - st.st_mtime >= UPLOAD_SESSION_TTL:
+            # Streaming upload or session whose process died mid-write
+            try:
+                os.remove(os.path.join(PARTIAL_FOLDER, name))
+            except FileNotFoundError:
+                pass
+
+class ChunkWriter:
+    # The body of one PUT /upload/session/<id>: decoded bytes are written at their
+    # offset and hashed as they arrive. The Flask route feeds it from the request
+    # stream, the asyncio engine straight from the socket.
+    def __init__(self, session, offset, decoder):
+        self.session = session
+        self.offset = offset
+        self.decoder = decoder
+        self.written = 0
+        self.overflow = self.disk_full = False
+        self.fd = os.open(session.part_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+
+    def feed(self, data, last=False):
+        # False once the chunk runs past the declared file size. Pieces are
+        # decoded one at a time, so a chunk that inflates past it stops there.
+        def decoded():
+            yield from self.decoder.decode(data)
+            if last:
+                yield self.decoder.flush()
+        pieces = decoded()
+        while True:
+            with profile_phase('decompress'):
+                piece = next(pieces, None)
+            if piece is None:
+                break
+            position = self.offset + self.written
+            if position + len(piece) > self.session.size:
+                self.overflow = True
+                return False
+            with profile_phase('disk_write'):
+                self.session.write_at(self.fd, piece, position)
+            with profile_phase('hash'):
+                self.session.hash_piece(position, piece)
+            self.written += len(piece)
+        return True
+
+    def fail(self, e):
+        self.disk_full = is_disk_full(e)
+        log_message(f"Upload error: {self.session.filename}: {str(e)}")
+
+    def finish(self, complete):
+        # Returns the response body and status
+        session = self.session
+        os.close(self.fd)
+        # Whatever reached the disk counts, so a dropped connection resumes mid-chunk
+        with session.lock, profile_phase('session_save'):
+            session.add_range(self.offset, self.offset + self.written)
+            session.save()
+            if not complete:
+                # The gap this leaves may never be filled; don't hold memory for it
+                session.clear_pending()
+        if self.overflow:
+            return {'error': 'Chunk exceeds the declared file size', 'ranges': session.ranges}, 416
+        if self.disk_full:
+            return {'error': 'The computer ran out of disk space', 'ranges': session.ranges}, 507
+        if not complete:
+            return {'error': 'Incomplete chunk', 'ranges': session.ranges}, 400
+        return {'ranges': session.ranges, 'received': session.received()}, 200
+
+def start_chunk(session, offset, length, encoding):
+    # Checks a chunk before any of its body is read: (ChunkWriter, None) or (None, (body, status))
+    if offset is None or offset < 0 or length is None:
+        return None, ({'error': 'An offset and Content-Length are required'}, 400)
+    try:
+        decoder = StreamDecoder(encoding)
+    except ValueError as e:
+        return None, ({'error': str(e)}, 415)
+    # Offsets and sizes refer to the decoded bytes; Content-Length is what is on the wire
+    if decoder.encoding is None and offset + length > session.size:
+        return None, ({'error': 'Chunk exceeds the declared file size'}, 416)
+    try:
+        if not session.allocated:
+            # First data for this file: reserve all of it now, so the disk can't fill up under the upload
+            shortage = check_free_space(session.size - session.received())
+            if shortage is not None:
+                log_message(f"Upload error: {shortage['error']}")
+                return None, (dict(shortage, ranges=session.ranges), 507)
+            session.allocate()
+        return ChunkWriter(session, offset, decoder), None
+    except OSError as e:
+        log_message(f"Upload error: {session.filename}: {str(e)}")
+        return None, ({'error': str(e), 'ranges': session.ranges}, 507 if is_disk_full(e) else 500)
+
+def remaining_upload(session_id):
+    # Ranks a segment by what its file still needs, so nearly done uploads finish first
+    session = get_upload_session(session_id)
+    return session.size - session.received() if session is not None else None
+
+# Streaming uploads
+class IncomingFile:
+    # Written under a temp name in PARTIAL_FOLDER (same filesystem) and
+    # renamed into DOWNLOAD_FOLDER in one step, so readers never see a partial file
+    def __init__(self, filename, expected_size=None):
+        self.filename = filename
+        self.path = os.path.join(DOWNLOAD_FOLDER, filename)
+        fd, self.tmp_path = tempfile.mkstemp(suffix='.part', dir=PARTIAL_FOLDER)
+        self.file = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.preallocated = False
+        if expected_size:
+            try:
+                preallocate(fd, expected_size)
+            except OSError:
+                self.abort()
+                raise
+            self.preallocated = True
+
+    def write(self, data):
+        with profile_phase('disk_write'):
+            self.file.write(data)
+        with profile_phase('hash'):
+            self.hasher.update(data)
+        self.size += len(data)
+
+    def commit(self):
+        with profile_phase('commit'):
+            if self.preallocated:
+                # The declared size may have been too large
+                self.file.truncate()
+            self.file.close()
+            duplicate = content_store.commit(self.tmp_path, self.hasher.hexdigest(), self.path)
+            checksum_index.record(self.path, self.hasher.hexdigest())
+        metrics.files_received.inc()
+        return duplicate
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+class MultipartUpload:
+    # Incremental multipart/form-data parser: every 'files' part is written
+    # straight to its IncomingFile, so memory stays bounded by UPLOAD_BUFFER_SIZE.
+    # A 'sha256' field before a file part is the digest that file must match, a
+    # 'size' field its length in bytes, used to preallocate it.
+    def __init__(self, boundary, transfer=None, body_size=None):
+        self.decoder = MultipartDecoder(boundary, max_form_memory_size=2 * UPLOAD_BUFFER_SIZE)
+        self.transfer = transfer
+        self.body_size = body_size
+        self.current = None
+        self.field = None
+        self.field_name = None
+        self.expected = None
+        self.expected_size = None
+        self.received = []
+        self.checksums = {}
+        self.rejected = []
+
+    def feed(self, data):
+        with profile_phase('multipart_parse'):
+            self.parse(data)
+
+    def parse(self, data):
+        self.decoder.receive_data(data)
+        while True:
+            event = self.decoder.next_event()
+            if isinstance(event, (NeedData, Epilogue)):
+                break
+            if isinstance(event, File):
+                with profile_phase('secure_filename'):
+                    safe_filename = secure_filename(event.filename)
+                if event.name == 'files' and safe_filename:
+                    self.current = IncomingFile(safe_filename, self.expected_size)
+                    self.expected_size = None
+                    if self.transfer is not None:
+                        self.transfer.name = safe_filename
+            elif isinstance(event, Field):
+                self.field = bytearray() if event.name in ('sha256', 'size') else None
+                self.field_name = event.name
+            elif isinstance(event, Data) and self.current is not None:
+                self.current.write(event.data)
+                if not event.more_data:
+                    self.finish_file()
+            elif isinstance(event, Data) and self.field is not None:
+                self.field += event.data
+                if not event.more_data:
+                    value = self.field.decode('ascii', 'replace').strip().lower()
+                    if self.field_name == 'sha256':
+                        self.expected = value
+                    elif value.isdigit():
+                        # No part can be larger than the request that carries it
+                        self.expected_size = min(int(value), self.body_size or int(value))
+                    self.field = None
+
+    def finish_file(self):
+        incoming, expected = self.current, self.expected
+        self.current = self.expected = None
+        digest = incoming.hasher.hexdigest()
+        if expected and expected != digest:
+            incoming.abort()
+            self.rejected.append(incoming.filename)
+            log_message(f"Upload error: Checksum mismatch for {incoming.filename}")
+            return
+        duplicate = incoming.commit()
+        self.received.append(incoming.filename)
+        self.checksums[incoming.filename] = digest
+        log_message(f"Received: {incoming.filename}" + (" (duplicate)" if duplicate else ""))
+
+    def result(self):
+        # (status, body) shared by the WSGI route and the asyncio engine
+        if self.rejected:
+            return 422, {'error': 'Checksum mismatch', 'rejected': self.rejected,
+                         'count': len(self.received), 'checksums': self.checksums}
+        if not self.received:
+            return 400, {'error': 'No files provided'}
+        return 200, {'success': True, 'count': len(self.received), 'checksums': self.checksums}
+
+    def abort(self):
+        if self.current is not None:
+            self.current.abort()
+            self.current = None
+
+# Content-addressed store
+FICLONE = 0x40049409  # Linux ioctl: make a file share another file's extents
+
+def clone_file(src, dest):
+    # Copy-on-write copy (Btrfs, XFS, bcachefs): no bytes are written and the two
+    # files stay independent. Raises OSError where the filesystem cannot do it,
+    # leaving dest (possibly created empty) for the caller to reuse or remove.
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this system')
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+
+class ContentStore:
+    # One blob per SHA-256 in STORE_FOLDER: a read-only reflink of the first
+    # received copy of some bytes, which later copies are reflinked from. Reflinks
+    # share extents but not the inode, so every received file stays an ordinary
+    # file that can be edited in place without touching the blob or other copies.
+    # Hardlinks would save the same space but tie the blob to a file the user may
+    # change, so where the filesystem cannot reflink, files are stored plainly.
+    # A blob whose size or mtime moved since it was last hashed is hashed again
+    # before reuse. A blob no received file has the bytes of any more (deleted,
+    # overwritten or edited, going by the checksum index) is collected by the
+    # housekeeping pass.
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.reflinks = True
+        self.verified = {}  # digest -> (size, mtime_ns) the blob last hashed to
+        self.collected_blobs = self.collected_bytes = 0
+
+    def blob_path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest[2:])
+
+    def commit(self, tmp_path, digest, path):
+        # Moves tmp_path into place as path; returns True if the bytes were already stored
+        if not DEDUP_RECEIVED_FILES or not self.reflinks:
+            os.replace(tmp_path, path)
+            return False
+        blob = self.blob_path(digest)
+        with self.lock:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                if self.holds(blob, digest):
+                    link_path = tmp_path + '.link'
+                    self.link(blob, link_path)
+                    os.replace(link_path, path)
+                    os.remove(tmp_path)
+                    return True
+                self.link(tmp_path, tmp_path + '.blob')
+                os.chmod(tmp_path + '.blob', 0o444)
+                os.replace(tmp_path + '.blob', blob)
+                st = os.stat(blob)
+                self.verified[digest] = (st.st_size, st.st_mtime_ns)
+            except OSError as e:
+                if not self.reflinks:
+                    log_message(f"Deduplication disabled: {str(e)}")
+                for leftover in (tmp_path + '.link', tmp_path + '.blob'):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+            os.replace(tmp_path, path)
+            return False
+
+    def holds(self, blob, digest):
+        # True if blob still has the bytes it is named after
+        try:
+            st = os.stat(blob)
+        except FileNotFoundError:
+            return False
+        if self.verified.get(digest) != (st.st_size, st.st_mtime_ns):
+            # Changed behind the app's back, or not checked since the app started
+            if full_digest(blob) != digest:
+                self.verified.pop(digest, None)
+                log_message(f"Stored copy {digest[:12]} was changed; storing the new upload instead")
+                return False
+            self.verified[digest] = (st.st_size, st.st_mtime_ns)
+        return True
+
+    def link(self, blob, dest):
+        # Raises OSError where the filesystem cannot reflink; callers store or copy plainly
+        try:
+            clone_file(blob, dest)
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS):
+                self.reflinks = False
+            raise
+
+    def received(self):
+        # (stat, digest or None) of each received file
+        with os.scandir(DOWNLOAD_FOLDER) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    yield st, checksum_index.lookup(os.path.abspath(entry.path), st.st_size, st.st_mtime_ns)
+
+    def blobs(self):
+        for dirpath, _, filenames in os.walk(self.folder):
+            for name in filenames:
+                yield os.path.basename(dirpath) + name, os.path.join(dirpath, name)
+
+    def collect(self):
+        removed = freed = 0
+        with self.lock:
+            in_use = {digest for _, digest in self.received()}
+            for digest, blob in self.blobs():
+                if digest not in in_use:
+                    size = os.stat(blob).st_size
+                    os.remove(blob)
+                    self.verified.pop(digest, None)
+                    removed += 1
+                    freed += size
+            self.collected_blobs += removed
+            self.collected_bytes += freed
+        return removed, freed
+
+    def stats(self):
+        # Reflinked copies share extents that stat cannot see, so received files
+        # with the bytes of a stored blob are counted as stored once
+        stored_digests = {digest for digest, _ in self.blobs()}
+        files = logical = stored = 0
+        counted = set()
+        for st, digest in self.received():
+            files += 1
+            logical += st.st_size
+            if digest not in stored_digests:
+                stored += st.st_size
+            elif digest not in counted:
+                counted.add(digest)
+                stored += st.st_size
+        return {
+            'enabled': DEDUP_RECEIVED_FILES and self.reflinks,
+            'reflinks': self.reflinks,
+            'files': files,
+            'unique_blobs': len(stored_digests),
+            'logical_bytes': logical,
+            'stored_bytes': stored,
+            'saved_bytes': logical - stored,
+            'dedup_ratio': round(logical / stored, 2) if stored else 1.0,
+            'collected_blobs': self.collected_blobs,
+            'collected_bytes': self.collected_bytes
+        }
+
+content_store = ContentStore(STORE_FOLDER)
+
+# Integrity checksums
+class ChecksumIndex:
+    # SHA-256 of files whose bytes passed through the server in full (uploads,
+    # buffered or compressed downloads, archives, share copies), kept in a
+    # sidecar JSON file and trusted only while size and mtime are unchanged
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.save_timer = None
+        try:
+            with open(path) as f:
+                self.entries = {p: entry for p, entry in json.load(f).items() if os.path.exists(p)}
+        except (OSError, ValueError):
+            pass
+
+    def lookup(self, filepath, size, mtime_ns):
+        entry = self.entries.get(filepath)
+        if entry and entry[0] == size and entry[1] == mtime_ns:
+            return entry[2]
+        return None
+
+    def record(self, filepath, digest, st=None):
+        # st is the stat taken before the bytes were read; skip files changed since
+        filepath = os.path.abspath(filepath)
+        current = os.stat(filepath)
+        if st is not None and (current.st_size, current.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            return
+        with self.lock:
+            if self.entries.get(filepath) == [current.st_size, current.st_mtime_ns, digest]:
+                return
+            self.entries[filepath] = [current.st_size, current.st_mtime_ns, digest]
+            if self.save_timer is None:
+                self.save_timer = threading.Timer(CHECKSUM_SAVE_DELAY, self.save)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+        if os.path.dirname(filepath) == UPLOAD_FOLDER:
+            share_index.digest_known(os.path.basename(filepath))
+
+    def save(self):
+        with self.lock:
+            self.save_timer = None
+            data = json.dumps(self.entries)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+checksum_index = ChecksumIndex(os.path.join(CACHE_FOLDER, 'checksums.json'))
+
+def copy_with_checksum(src, dest):
+    # shutil.copy2 with the SHA-256 taken on the way, so sharing a file needs no extra
+    # read. The copy is renamed into place when complete, so phones never list or
+    # download half of it.
+    hasher = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=SHARE_PARTIAL_FOLDER)
+    try:
+        with os.fdopen(fd, 'wb') as fdest, open(src, 'rb') as fsrc:
+            preallocate(fdest.fileno(), os.fstat(fsrc.fileno()).st_size)
+            for data in iter(lambda: fsrc.read(UPLOAD_BUFFER_SIZE), b''):
+                hasher.update(data)
+                fdest.write(data)
+            fdest.truncate()
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    checksum_index.record(dest, hasher.hexdigest())
+
+# Upload pre-check
+def sample_digest(filepath, size):
+    # Must match the page's hash worker: SHA-256 over "<size>:" followed by the
+    # first, middle and last SAMPLE_HASH_SIZE bytes (the whole file when small)
+    hasher = hashlib.sha256(f'{size}:'.encode())
+    if size <= 3 * SAMPLE_HASH_SIZE:
+        spans = [(0, size)]
+    else:
+        middle = (size - SAMPLE_HASH_SIZE) // 2
+        spans = [(0, SAMPLE_HASH_SIZE), (middle, middle + SAMPLE_HASH_SIZE), (size - SAMPLE_HASH_SIZE, size)]
+    with open(filepath, 'rb') as f:
+        for start, end in spans:
+            f.seek(start)
+            hasher.update(f.read(end - start))
+    return hasher.hexdigest()
+
+def full_digest(filepath):
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for data in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+class ReceivedIndex:
+    # Hashes of the files in DOWNLOAD_FOLDER, computed on demand for files whose
+    # size matches a pre-check and reused until the file's size or mtime changes.
+    # A matching sample only makes a file 'maybe' there: the page then sends the
+    # full SHA-256 of just those files, and only a full match is 'present' or 'linked'.
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.digests = {}
+
+    def digest(self, name, st, kind):
+        key = (name, kind)
+        with self.lock:
+            cached = self.digests.get(key)
+        if cached and cached[0] == (st.st_size, st.st_mtime_ns):
+            return cached[1]
+        filepath = os.path.join(self.folder, name)
+        if kind == 'sample':
+            value = sample_digest(filepath, st.st_size)
+        else:
+            # Received files usually had theirs taken on the way in
+            value = checksum_index.lookup(filepath, st.st_size, st.st_mtime_ns) or full_digest(filepath)
+        with self.lock:
+            self.digests[key] = ((st.st_size, st.st_mtime_ns), value)
+        return value
+
+    def candidates(self, sizes):
+        found = {}
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_size in sizes:
+                        found.setdefault(st.st_size, []).append((entry.name, st))
+        return found
+
+    def find(self, candidates, name, sample, sha256):
+        # Returns (name of a file with these bytes, sample matched); the same name
+        # is tried first so an unchanged file stays 'present'
+        sampled = False
+        for candidate, st in sorted(candidates, key=lambda c: c[0] != name):
+            if self.digest(candidate, st, 'sample') != sample:
+                continue
+            sampled = True
+            if sha256 and self.digest(candidate, st, 'sha256') == sha256:
+                return candidate, True
+        return None, sampled
+
+    def link(self, source, name, sha256):
+        # Same bytes under another name: reflinked like the content store does it,
+        # or copied, instead of re-uploaded. The copy goes into the temp file mkstemp
+        # created exclusively (never a freed name another request could take) and
+        # then replaces the target in one step.
+        source_path = os.path.join(self.folder, source)
+        filepath = os.path.join(self.folder, name)
+        fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=PARTIAL_FOLDER)
+        os.close(fd)
+        try:
+            try:
+                if not (DEDUP_RECEIVED_FILES and content_store.reflinks):
+                    raise OSError(errno.EOPNOTSUPP, 'Linking is off')
+                content_store.link(source_path, tmp_path)
+            except OSError:
+                shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        checksum_index.record(filepath, sha256)
+
+    def check(self, files):
+        sizes = {item.get('size') for item in files if isinstance(item, dict) and isinstance(item.get('size'), int)}
+        candidates = self.candidates(sizes)
+        results = []
+        for item in files:
+            item = item if isinstance(item, dict) else {}
+            name = secure_filename(str(item.get('name') or ''))
+            size, sample, sha256 = item.get('size'), item.get('sample'), item.get('sha256')
+            sha256 = sha256.strip().lower() if isinstance(sha256, str) else None
+            status = 'missing'
+            if name and isinstance(size, int) and isinstance(sample, str):
+                match, sampled = self.find(candidates.get(size, []), name, sample, sha256)
+                if match == name:
+                    status = 'present'
+                elif match:
+                    self.link(match, name, sha256)
+                    status = 'linked'
+                    log_message(f"Received: {name} (same as {match})")
+                elif sampled and not sha256:
+                    status = 'maybe'
+            results.append({'name': name, 'status': status})
+        return results
+
+received_index = ReceivedIndex(DOWNLOAD_FOLDER)
+
+# Share folder index
+class EventHub:
+    # Fan-out of share folder changes; a subscriber whose callback fails
+    # (e.g. its queue is full) is dropped and has to resync
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.add(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers.discard(callback)
+
+    def is_subscribed(self, callback):
+        with self.lock:
+            return callback in self.subscribers
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                self.unsubscribe(callback)
+
+share_events = EventHub()
+
+class ShareIndex:
+    # In-memory listing of a folder. It is rescanned only when the folder's
+    # mtime changes, after invalidate(), or every INDEX_RESCAN_INTERVAL seconds
+    # to catch files edited in place (which leave the folder mtime alone).
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.instance = uuid.uuid4().hex[:8]
+        self.entries = {}
+        self.version = 0
+        self.folder_mtime = None
+        self.scanned_at = 0
+        self.stale = True
+        self.listing = None
+        self.views = {}
+
+    @property
+    def etag(self):
+        return f'"{self.instance}-{self.version}"'
+
+    def invalidate(self):
+        self.stale = True
+
+    def refresh(self):
+        with self.lock:
+            folder_mtime = os.stat(self.folder).st_mtime_ns
+            now = time.monotonic()
+            if (not self.stale and folder_mtime == self.folder_mtime
+                    and now - self.scanned_at < INDEX_RESCAN_INTERVAL):
+                return
+            entries = {}
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    if entry.is_file():
+                        st = entry.stat()
+                        entries[entry.name] = (st.st_size, st.st_mtime_ns)
+            if entries != self.entries:
+                previous = self.entries
+                self.entries = entries
+                self.version += 1
+                self.listing = None
+                self.views = {}
+                share_events.publish({
+                    'version': self.etag,
+                    'added': [file_entry(name, *entries[name]) for name in entries if name not in previous],
+                    'modified': [file_entry(name, *entries[name]) for name in entries
+                                 if name in previous and previous[name] != entries[name]],
+                    'removed': [name for name in previous if name not in entries]
+                })
+            self.folder_mtime = folder_mtime
+            self.scanned_at = now
+            # A change in the same mtime tick as this scan would go unnoticed
+            self.stale = time.time_ns() - folder_mtime < 2 * 10**9
+
+    def digest_known(self, name):
+        # Listings carry checksums, so learning one is a change like any other
+        with self.lock:
+            if name not in self.entries:
+                return
+            self.version += 1
+            self.listing = None
+            share_events.publish({
+                'version': self.etag,
+                'added': [],
+                'modified': [file_entry(name, *self.entries[name])],
+                'removed': []
+            })
+
+    def json_listing(self):
+        self.refresh()
+        with self.lock:
+            if self.listing is None:
+                files = [file_entry(name, size, mtime_ns) for name, (size, mtime_ns) in self.entries.items()]
+                self.listing = json.dumps({'files': files}).encode()
+            return self.etag, self.listing
+
+    def sorted_view(self, sort):
+        # (key, name) pairs in ascending order, built once per version and sort
+        self.refresh()
+        with self.lock:
+            view = self.views.get(sort)
+            if view is None:
+                if sort == 'name':
+                    view = sorted((name.lower(), name) for name in self.entries)
+                else:
+                    field = 0 if sort == 'size' else 1
+                    view = sorted((stat[field], name) for name, stat in self.entries.items())
+                self.views[sort] = view
+            return self.etag, view, self.entries
+
+share_index = ShareIndex(UPLOAD_FOLDER)
+
+def file_entry(name, size, mtime_ns):
+    entry = {'name': name, 'size': size, 'mtime': mtime_ns // 10**9}
+    digest = checksum_index.lookup(os.path.join(UPLOAD_FOLDER, name), size, mtime_ns)
+    if digest:
+        entry['sha256'] = digest
+    return entry
+
+def start_share_watcher():
+    # Polls the share index so changes made outside the app become events;
+    # an unchanged folder costs one stat per WATCH_INTERVAL
+    global share_watcher
+    if share_watcher is not None:
+        return
+
+    def watch():
+        while True:
+            try:
+                share_index.refresh()
+            except OSError as e:
+                log_message(f"Share watcher error: {str(e)}")
+            time.sleep(WATCH_INTERVAL)
+
+    share_watcher = threading.Thread(target=watch, name='share-watcher', daemon=True)
+    share_watcher.start()
+
+def start_housekeeping():
+    # Periodic cleanup of what finished or abandoned transfers leave behind:
+    # expired upload sessions and stored blobs no received file has the bytes of any more
+    global housekeeper
+    if housekeeper is not None:
+        return
+
+    def sweep():
+        while True:
+            time.sleep(HOUSEKEEPING_INTERVAL)
+            try:
+                expire_upload_sessions()
+                removed, freed = content_store.collect()
+                if removed:
+                    log_message(f"Freed {format_size(freed)} of stored copies no file uses any more")
+            except OSError as e:
+                log_message(f"Housekeeping error: {str(e)}")
+
+    housekeeper = threading.Thread(target=sweep, name='housekeeping', daemon=True)
+    housekeeper.start()
+
+def format_sse(event_type, data):
+    return f'event: {event_type}\ndata: {json.dumps(data)}\n\n'.encode()
+
+def encode_list_cursor(sort, key, name):
+    return base64.urlsafe_b64encode(json.dumps([sort, key, name]).encode()).decode()
+
+def decode_list_cursor(cursor, sort):
+    value = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if value[0] != sort:
+        raise ValueError('Cursor belongs to a different sort order')
+    return (value[1], value[2])
+
+def list_page(args):
+    sort = args.get('sort', 'name')
+    if sort not in ('name', 'size', 'mtime'):
+        raise ValueError(f"Unknown sort '{sort}'")
+    descending = args.get('order', 'asc') == 'desc'
+    query = args.get('q', '').lower()
+    extensions = {'.' + ext.strip().lower().lstrip('.') for ext in args.get('ext', '').split(',') if ext.strip()}
+    min_size = args.get('min_size', type=int)
+    max_size = args.get('max_size', type=int)
+    limit = min(args.get('limit', LIST_PAGE_SIZE, type=int), MAX_LIST_PAGE_SIZE)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+
+    etag, view, entries = share_index.sorted_view(sort)
+    if args.get('cursor'):
+        cursor = decode_list_cursor(args['cursor'], sort)
+        if descending:
+            positions = range(bisect.bisect_left(view, cursor) - 1, -1, -1)
+        else:
+            positions = range(bisect.bisect_right(view, cursor), len(view))
+    else:
+        positions = range(len(view) - 1, -1, -1) if descending else range(len(view))
+
+    files = []
+    next_cursor = None
+    for position in positions:
+        key, name = view[position]
+        size, mtime_ns = entries[name]
+        if query and query not in name.lower():
+            continue
+        if extensions and os.path.splitext(name)[1].lower() not in extensions:
+            continue
+        if (min_size is not None and size < min_size) or (max_size is not None and size > max_size):
+            continue
+        if len(files) == limit:
+            next_cursor = encode_list_cursor(sort, *previous)
+            break
+        files.append(file_entry(name, size, mtime_ns))
+        previous = (key, name)
+    return etag, {'files': files, 'next_cursor': next_cursor, 'total': len(entries)}
+
+# Compression
+MAGIC_SIGNATURES = [
+    (0, b'\xff\xd8\xff'), (0, b'\x89PNG'), (0, b'GIF8'), (8, b'WEBP'), (4, b'ftyp'),
+    (0, b'\x1a\x45\xdf\xa3'), (8, b'AVI '), (0, b'ID3'), (0, b'OggS'), (0, b'fLaC'),
+    (0, b'PK\x03\x04'), (0, b'\x1f\x8b'), (0, b'\x28\xb5\x2f\xfd'), (0, b'BZh'),
+    (0, b'\xfd7zXZ\x00'), (0, b'7z\xbc\xaf\x27\x1c'), (0, b'Rar!')
+]
+
+def is_compressed_file(filepath):
+    # Media and archives gain nothing from another compression pass
+    if os.path.splitext(filepath)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    try:
+        with open(filepath, 'rb') as f:
+            head = f.read(16)
+    except OSError:
+        return False
+    return any(head[offset:offset + len(magic)] == magic for offset, magic in MAGIC_SIGNATURES)
+
+def supported_encodings():
+    # In order of preference
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+def negotiate_encoding(accept_encodings):
+    for encoding in supported_encodings():
+        if accept_encodings.quality(encoding) > 0:
+            return encoding
+    return None
+
+class StreamCompressor:
+    def __init__(self, encoding):
+        if encoding == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=3).compressobj()
+            self.compress, self.flush = compressor.compress, compressor.flush
+        elif encoding == 'br':
+            compressor = brotli.Compressor(quality=4)
+            self.compress, self.flush = compressor.process, compressor.finish
+        else:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+            self.compress, self.flush = compressor.compress, compressor.flush
+
+class StreamDecoder:
+    # Decodes a Content-Encoding'd request body piece by piece. Output comes in
+    # bounded pieces (zlib and brotli cap it per call, zstd gets its input in small
+    # steps) and a decoded body over limit is refused, so a small compressed body
+    # can't balloon in memory or on disk.
+    def __init__(self, encoding, limit=None):
+        encoding = encoding.strip().lower()
+        self.encoding = encoding
+        self.decompressor = None
+        self.limit = MAX_CONTENT_LENGTH if limit is None else limit
+        self.size = 0
+        if encoding in ('', 'identity'):
+            self.encoding = None
+        elif encoding in ('gzip', 'deflate'):
+            self.decompressor = zlib.decompressobj(47 if encoding == 'gzip' else 15)
+        elif encoding == 'zstd' and zstandard is not None:
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif encoding == 'br' and brotli is not None and hasattr(brotli.Decompressor, 'can_accept_more_data'):
+            # Brotli 1.1+ is needed for the output limit
+            self.decompressor = brotli.Decompressor()
+        else:
+            raise ValueError(f"Unsupported Content-Encoding '{encoding}'")
+
+    def decode(self, data):
+        for piece in self.pieces(data):
+            self.size += len(piece)
+            if self.encoding and self.size > self.limit:
+                raise ValueError(f'Decompressed body is larger than {format_size(self.limit)}')
+            yield piece
+
+    def pieces(self, data):
+        if self.encoding is None:
+            yield data
+        elif self.encoding == 'br':
+            try:
+                # More output can be pending even once the input is taken
+                piece = self.decompressor.process(data, output_buffer_limit=UPLOAD_BUFFER_SIZE)
+                while piece or not self.decompressor.can_accept_more_data():
+                    yield piece
+                    piece = self.decompressor.process(b'', output_buffer_limit=UPLOAD_BUFFER_SIZE)
+            except brotli.error as e:
+                raise ValueError(f'Corrupt compressed body: {e}')
+        elif self.encoding == 'zstd':
+            # decompressobj has no output cap; small input steps bound what one call yields
+            try:
+                for start in range(0, len(data), ZSTD_INPUT_STEP):
+                    yield self.decompressor.decompress(data[start:start + ZSTD_INPUT_STEP])
+            except zstandard.ZstdError as e:
+                raise ValueError(f'Corrupt compressed body: {e}')
+        else:
+            try:
+                yield self.decompressor.decompress(data, UPLOAD_BUFFER_SIZE)
+                while self.decompressor.unconsumed_tail:
+                    yield self.decompressor.decompress(self.decompressor.unconsumed_tail, UPLOAD_BUFFER_SIZE)
+            except zlib.error as e:
+                raise ValueError(f'Corrupt compressed body: {e}')
+
+    def flush(self):
+        if self.encoding in ('gzip', 'deflate'):
+            if not self.decompressor.eof:
+                raise ValueError('Truncated compressed body')
+            return self.decompressor.flush()
+        return b''
+
+class CompressionCache:
+    # Encoded copies of shared files, keyed by path, size, mtime and encoding.
+    # The first request compresses while streaming and keeps the result; the
+    # least recently served copies go once the cache outgrows max_size.
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.in_progress = set()
+
+    def path_for(self, filepath, st, encoding):
+        key = hashlib.sha1(f'{os.path.abspath(filepath)}|{st.st_size}|{st.st_mtime_ns}'.encode()).hexdigest()
+        return os.path.join(self.folder, f'{key}.{encoding}')
+
+    def lookup(self, filepath, st, encoding):
+        path = self.path_for(filepath, st, encoding)
+        try:
+            os.utime(path)
+            return path
+        except OSError:
+            return None
+
+    def iter_compressed(self, filepath, st, encoding, checksum=False):
+        path = self.path_for(filepath, st, encoding)
+        hasher = hashlib.sha256() if checksum else None
+        with self.lock:
+            keep = st.st_size <= COMPRESSION_CACHE_MAX_FILE and path not in self.in_progress
+            if keep:
+                self.in_progress.add(path)
+        out = None
+        try:
+            if keep:
+                os.makedirs(self.folder, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+                out = os.fdopen(fd, 'wb')
+            compressor = StreamCompressor(encoding)
+            with open(filepath, 'rb') as f:
+                while True:
+                    data = f.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    if hasher:
+                        hasher.update(data)
+                    data = compressor.compress(data)
+                    if data:
+                        if out:
+                            out.write(data)
+                        yield data
+            data = compressor.flush()
+            if hasher:
+                checksum_index.record(filepath, hasher.hexdigest(), st)
+            if out:
+                out.write(data)
+                out.close()
+                out = None
+                os.replace(tmp_path, path)
+                self.evict()
+            yield data
+        finally:
+            if out:
+                out.close()
+                os.remove(tmp_path)
+            if keep:
+                with self.lock:
+                    self.in_progress.discard(path)
+
+    def evict(self):
+        with self.lock:
+            evict_lru(self.folder, self.max_size)
+
+def evict_lru(folder, max_size):
+    # Cache hits touch their file, so the oldest mtimes are the least recently used
+    entries = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+compression_cache = CompressionCache(COMPRESSION_CACHE_FOLDER, COMPRESSION_CACHE_SIZE)
+
+# Thumbnails
+class ThumbnailService:
+    # JPEG previews made on first request by a small worker pool, so a screen
+    # full of rows never decodes more than THUMBNAIL_WORKERS images at once.
+    # Requests don't wait for them: until one is ready the page is asked to retry.
+    # Cache files are keyed by path, size and mtime; failures are remembered.
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.failed = set()
+        self.executor = None
+
+    def available(self, filepath):
+        ext = os.path.splitext(filepath)[1].lower()
+        if ext in THUMBNAIL_IMAGE_EXTENSIONS:
+            return Image is not None or shutil.which('ffmpeg') is not None
+        return ext in THUMBNAIL_VIDEO_EXTENSIONS and shutil.which('ffmpeg') is not None
+
+    def path_for(self, filepath, st):
+        key = hashlib.sha1(f'{os.path.abspath(filepath)}|{st.st_size}|{st.st_mtime_ns}'.encode()).hexdigest()
+        return os.path.join(self.folder, key + '.jpg')
+
+    def get(self, filepath, st):
+        # (path, ready): the thumbnail's path, or None when it can't be made, and
+        # whether it exists yet; a missing one is queued and not waited for
+        path = self.path_for(filepath, st)
+        try:
+            os.utime(path)
+            return path, True
+        except OSError:
+            pass
+        with self.lock:
+            if path in self.failed:
+                return None, True
+            if path not in self.pending:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix='thumbnail')
+                self.pending[path] = self.executor.submit(self.generate, filepath, path)
+        return path, False
+
+    def generate(self, filepath, path):
+        os.makedirs(self.folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+        os.close(fd)
+        try:
+            ext = os.path.splitext(filepath)[1].lower()
+            if ext in THUMBNAIL_IMAGE_EXTENSIONS and Image is not None:
+                self.render_image(filepath, tmp_path)
+            else:
+                self.render_frame(filepath, tmp_path)
+            if os.path.getsize(tmp_path) == 0:
+                raise ValueError('No frame could be decoded')
+            os.replace(tmp_path, path)
+            evict_lru(self.folder, self.max_size)
+            return True
+        except Exception as e:
+            log_message(f"Thumbnail error: {os.path.basename(filepath)}: {str(e)}")
+            with self.lock:
+                self.failed.add(path)
+            return False
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def render_image(self, filepath, out_path):
+        with Image.open(filepath) as img:
+            # JPEG can decode straight at a fraction of full size
+            img.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            img.convert('RGB').save(out_path, 'JPEG', quality=80)
+
+    def render_frame(self, filepath, out_path):
+        # A frame one second in (or the first one, for very short clips)
+        scale = f'scale={THUMBNAIL_SIZE}:{THUMBNAIL_SIZE}:force_original_aspect_ratio=decrease'
+        for seek in (['-ss', '1'], []):
+            subprocess.run(['ffmpeg', '-v', 'error', '-y'] + seek + ['-i', filepath, '-frames:v', '1',
+                            '-vf', scale, '-f', 'image2', '-c:v', 'mjpeg', out_path],
+                           stdin=subprocess.DEVNULL, capture_output=True, timeout=THUMBNAIL_TIMEOUT)
+            if os.path.getsize(out_path) > 0:
+                return
+
+thumbnails = ThumbnailService(THUMBNAIL_CACHE_FOLDER, THUMBNAIL_CACHE_SIZE)
+
+
+# Downloads
+class FileBody:
+    # WSGI body made of literal byte strings and (start, end) spans of one file.
+    # When the server hands us its socket the spans go out with sendfile and
+    # never pass through Python buffers.
+    def __init__(self, filepath, pieces, sock=None, checksum_st=None):
+        self.filepath = filepath
+        self.pieces = pieces
+        self.sock = sock if ZERO_COPY_DOWNLOADS else None
+        # Stat of a whole file with no known digest: hash it on the buffered path
+        self.checksum_st = checksum_st
+        self.sent = 0
+        self.close_callbacks = []
+        # RequestProfile when profiling, client IP when shaped; set after construction
+        self.profile = None
+        self.client = None
+
+    @property
+    def content_length(self):
+        return sum(len(piece) if isinstance(piece, bytes) else piece[1] - piece[0]
+                   for piece in self.pieces)
+
+    def __iter__(self):
+        profile = self.profile
+        with open(self.filepath, 'rb') as f:
+            if self.sock is not None:
+                # The empty chunk makes the server send the status line and headers
+                yield b''
+                for piece in self.pieces:
+                    if isinstance(piece, bytes):
+                        with phase_of(profile, 'socket_write'):
+                            self.sock.sendall(piece)
+                        self.sent += len(piece)
+                    else:
+                        with phase_of(profile, 'sendfile'):
+                            self.send_span(f, piece[0], piece[1])
+                return
+            hasher = hashlib.sha256() if self.checksum_st is not None else None
+            for piece in self.pieces:
+                if isinstance(piece, bytes):
+                    with phase_of(profile, 'socket_write'):
+                        yield piece
+                    self.sent += len(piece)
+                    continue
+                start, end = piece
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    with phase_of(profile, 'disk_read'):
+                        data = f.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    if hasher:
+                        with phase_of(profile, 'hash'):
+                            hasher.update(data)
+                    # The server writes to the socket while we are suspended here
+                    with phase_of(profile, 'socket_write'):
+                        yield data
+                    self.sent += len(data)
+                    self.throttle(len(data))
+            if hasher and remaining == 0:
+                checksum_index.record(self.filepath, hasher.hexdigest(), self.checksum_st)
+
+    def call_on_close(self, callback):
+        # Same hook as Response.call_on_close; the body is handed to the server as-is
+        self.close_callbacks.append(callback)
+
+    def close(self):
+        callbacks, self.close_callbacks = self.close_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    @property
+    def step(self):
+        # Shaped downloads go out in small steps so the rate stays even
+        return SHAPING_QUANTUM if self.client is not None and download_shaper.active else SENDFILE_CHUNK_SIZE
+
+    def throttle(self, count):
+        if self.client is not None:
+            delay = download_shaper.reserve(self.client, count)
+            if delay > 0:
+                time.sleep(delay)
+
+    def send_span(self, f, start, end):
+        offset = start
+        while offset < end:
+            count = min(self.step, end - offset)
+            if hasattr(os, 'sendfile') and self.sock.gettimeout() is None:
+                sent = os.sendfile(self.sock.fileno(), f.fileno(), offset, count)
+            else:
+                sent = self.sock.sendfile(f, offset, count)
+            if sent == 0:
+                raise ConnectionError('File truncated while sending')
+            offset += sent
+            self.sent += sent
+            self.throttle(sent)
+
+class ZipSink:
+    # Write-only target for zipfile; the bytes written so far are handed to
+    # the response with drain(), so memory stays at about one copy buffer
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def iter_zip_archive(names):
+    # zipfile writes data descriptors when the target cannot seek and switches
+    # to ZIP64 records for large members and archives
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True, compresslevel=ZIP_COMPRESS_LEVEL) as archive:
+        for name in names:
+            filepath = os.path.join(UPLOAD_FOLDER, name)
+            try:
+                st = os.stat(filepath)
+                info = zipfile.ZipInfo.from_file(filepath, name)
+                src = open(filepath, 'rb')
+            except OSError as e:
+                log_message(f"Archive error: skipped {name}: {str(e)}")
+                continue
+            info.compress_type = zipfile.ZIP_STORED if is_compressed_file(filepath) else zipfile.ZIP_DEFLATED
+            # open() takes the level from the ZipInfo, not the archive (renamed in 3.13)
+            if hasattr(info, 'compress_level'):
+                info.compress_level = ZIP_COMPRESS_LEVEL
+            else:
+                info._compresslevel = ZIP_COMPRESS_LEVEL
+            hasher = hashlib.sha256()
+            with src, archive.open(info, 'w') as dest:
+                while True:
+                    data = src.read(COPY_BUFFER_SIZE)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    dest.write(data)
+                    if sink.buffer:
+                        yield sink.drain()
+            checksum_index.record(filepath, hasher.hexdigest(), st)
+            yield sink.drain()
+    yield sink.drain()
+
+def file_etag(st):
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+def content_disposition(filename):
+    fallback = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'download'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+def parse_byte_ranges(header, size):
+    # Returns sorted, coalesced (start, end) spans with an exclusive end.
+    # None means the header should be ignored, [] means nothing is satisfiable.
+    if not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        start_text, sep, end_text = spec.strip().partition('-')
+        try:
+            if not sep:
+                return None
+            if start_text:
+                start = int(start_text)
+                end = int(end_text) + 1 if end_text else size
+                if end_text and end <= start:
+                    return None
+            else:
+                start, end = max(size - int(end_text), 0), size
+        except ValueError:
+            return None
+        end = min(end, size)
+        if start < end:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def if_range_matches(if_range, etag, mtime):
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    date = parse_date(if_range)
+    return date is not None and int(date.timestamp()) == int(mtime)
+
+def is_not_modified(etag, mtime):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+    since = parse_date(request.headers.get('If-Modified-Since'))
+    return since is not None and int(mtime) <= since.timestamp()
+
+def requested_download_size(filename):
+    # What a /download or /delta request will send, for admission: nothing for
+    # HEAD or a 304 and only the spans of a Range request, so segmented fetches
+    # and video seeking don't queue as whole files
+    try:
+        st = os.stat(os.path.join(UPLOAD_FOLDER, os.path.basename(filename)))
+    except OSError:
+        return None
+    etag = file_etag(st)
+    if request.method == 'HEAD':
+        return 0
+    # Compressed variants carry the ETag with '-<encoding>' added
+    if_none_match = [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',') if tag.strip()]
+    if any(tag == etag or tag.startswith(etag[:-1] + '-') for tag in if_none_match) or is_not_modified(etag, st.st_mtime):
+        return 0
+    range_header = request.headers.get('Range')
+    if (request.method == 'GET' and range_header
+            and if_range_matches(request.headers.get('If-Range'), etag, st.st_mtime)):
+        ranges = parse_byte_ranges(range_header, st.st_size)
+        if ranges is not None:
+            return sum(end - start for start, end in ranges)
+    return st.st_size
+
+def file_response(filepath, download_name):
+    st = os.stat(filepath)
+    etag = file_etag(st)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': content_disposition(download_name)
+    }
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    sock = request.environ.get('werkzeug.socket')
+    range_header = request.headers.get('Range')
+    digest = checksum_index.lookup(filepath, st.st_size, st.st_mtime_ns)
+    if digest:
+        headers['X-Checksum-SHA256'] = digest
+
+    # Ranges always address the identity encoding, so ranged requests skip compression.
+    # So do large files: recompressing gigabytes per download costs more than it saves.
+    encoding = None
+    if (not range_header and COMPRESSION_MIN_SIZE <= st.st_size <= COMPRESSION_MAX_SIZE
+            and not is_compressed_file(filepath)):
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = negotiate_encoding(request.accept_encodings)
+        if encoding:
+            etag = headers['ETag'] = f'{etag[:-1]}-{encoding}"'
+    if is_not_modified(etag, st.st_mtime):
+        return Response(status=304, headers=headers)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        del headers['Accept-Ranges']
+        cached_path = compression_cache.lookup(filepath, st, encoding)
+        if cached_path is None:
+            return Response(compression_cache.iter_compressed(filepath, st, encoding, digest is None),
+                            headers=headers, mimetype=mimetype)
+        body = FileBody(cached_path, [(0, os.path.getsize(cached_path))], sock)
+        headers['Content-Length'] = str(body.content_length)
+        return Response(body, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+    ranges = None
+    if range_header and if_range_matches(request.headers.get('If-Range'), etag, st.st_mtime):
+        ranges = parse_byte_ranges(range_header, st.st_size)
+        if ranges == []:
+            headers['Content-Range'] = f'bytes */{st.st_size}'
+            return Response(status=416, headers=headers)
+
+    if not ranges:
+        status, body = 200, FileBody(filepath, [(0, st.st_size)], sock, None if digest else st)
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{st.st_size}'
+        status, body = 206, FileBody(filepath, [(start, end)], sock)
+    else:
+        boundary = uuid.uuid4().hex
+        pieces = []
+        for start, end in ranges:
+            part_header = (f'--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                           f'Content-Range: bytes {start}-{end - 1}/{st.st_size}\r\n\r\n')
+            pieces += [part_header.encode(), (start, end), b'\r\n']
+        pieces.append(f'--{boundary}--\r\n'.encode())
+        status, body = 206, FileBody(filepath, pieces, sock)
+        mimetype = f'multipart/byteranges; boundary={boundary}'
+    headers['Content-Length'] = str(body.content_length)
+    return Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+# Delta transfers
+# The client describes its old copy as fixed-size blocks, each with an Adler-32
+# (weak, rolling) and a truncated SHA-256 (strong) checksum. The server rolls the
+# weak checksum over the current file and answers with a stream of records:
+#   b'C' + >II (first block, count)   copy blocks from the old copy
+#   b'L' + >I (length) + bytes         literal bytes
+#   b'E' + 32-byte SHA-256             end, digest of the rebuilt file
+# Rolling costs a Python loop step per byte, so it has a budget of DELTA_SCAN_LIMIT
+# bytes, earned back a block per copied block; while it is spent only windows a
+# whole block apart are tried, so in-place edits still match but shifted data doesn't.
+ADLER_MOD = 65521
+
+def strong_checksum(data):
+    return hashlib.sha256(data).hexdigest()[:16]
+
+def iter_delta(filepath, block_size, blocks, old_size):
+    weak_index = {}
+    tail = None
+    for i, (weak, strong) in enumerate(blocks):
+        length = min(block_size, old_size - i * block_size)
+        if length == block_size:
+            weak_index.setdefault(weak, {}).setdefault(strong, i)
+        elif length > 0:
+            tail = (i, length, weak, strong)
+
+    out = bytearray()
+    literal = bytearray()
+    run = None
+    scan_left = DELTA_SCAN_LIMIT
+    hasher = hashlib.sha256()
+
+    def flush_literal():
+        if literal:
+            out.extend(b'L' + struct.pack('>I', len(literal)) + literal)
+            literal.clear()
+
+    def flush_run():
+        nonlocal run
+        if run:
+            out.extend(b'C' + struct.pack('>II', *run))
+            run = None
+
+    def copy_block(index):
+        nonlocal run
+        flush_literal()
+        if run and run[0] + run[1] == index:
+            run = (run[0], run[1] + 1)
+        else:
+            flush_run()
+            run = (index, 1)
+
+    with open(filepath, 'rb') as f:
+        buf = bytearray()
+        pos = 0
+        eof = False
+        weak = None
+        while True:
+            if len(buf) - pos <= block_size and not eof:
+                if pos >= COPY_BUFFER_SIZE:
+                    del buf[:pos]
+                    pos = 0
+                data = f.read(UPLOAD_BUFFER_SIZE)
+                hasher.update(data)
+                buf.extend(data)
+                eof = not data
+                continue
+            if len(buf) - pos < block_size:
+                break
+            if not weak_index:
+                # Nothing to match against; only the tail check is left
+                take = len(buf) - pos - block_size + 1
+                flush_run()
+                literal.extend(buf[pos:pos + take])
+                pos += take
+                if len(literal) >= UPLOAD_BUFFER_SIZE:
+                    flush_literal()
+                    yield bytes(out)
+                    out.clear()
+                continue
+            if weak is None:
+                weak = zlib.adler32(buf[pos:pos + block_size])
+                a, b = weak & 0xffff, weak >> 16
+            candidates = weak_index.get(weak)
+            if candidates:
+                index = candidates.get(strong_checksum(buf[pos:pos + block_size]))
+                if index is not None:
+                    copy_block(index)
+                    pos += block_size
+                    weak = None
+                    scan_left = min(scan_left + block_size, DELTA_SCAN_LIMIT)
+                    if len(out) >= UPLOAD_BUFFER_SIZE:
+                        yield bytes(out)
+                        out.clear()
+                    continue
+            # Roll the window forward to the next weak match, within the buffer and budget
+            start = pos
+            end = min(len(buf) - block_size, pos + scan_left)
+            while pos < end:
+                outgoing = buf[pos]
+                a = (a - outgoing + buf[pos + block_size]) % ADLER_MOD
+                b = (b - block_size * outgoing + a - 1) % ADLER_MOD
+                pos += 1
+                weak = (b << 16) | a
+                if weak in weak_index:
+                    break
+            scan_left -= pos - start
+            if pos == start:
+                # Out of budget, or the window can't roll in this buffer: skip
+                # ahead and start over
+                pos += block_size if scan_left <= 0 else 1
+                weak = None
+            flush_run()
+            literal.extend(buf[start:pos])
+            if len(literal) >= UPLOAD_BUFFER_SIZE:
+                flush_literal()
+                yield bytes(out)
+                out.clear()
+
+    rest = bytes(buf[pos:])
+    if (tail and len(rest) == tail[1] and zlib.adler32(rest) == tail[2]
+            and strong_checksum(rest) == tail[3]):
+        copy_block(tail[0])
+    else:
+        flush_run()
+        literal.extend(rest)
+    flush_literal()
+    flush_run()
+    out.extend(b'E' + hasher.digest())
+    yield bytes(out)
 
 # Flask Routes
 @app.route('/')
+@instrumented('index')
 def index():
     html = """<!DOCTYPE html>
 <html>
@@ -249,6 +2890,41 @@ def index():
         }
         .available-file:last-child { border-bottom: none; }
         .available-file:hover { background: #f7fafc; }
+        .available-file > div {
+            flex: 1;
+            min-width: 0;
+        }
+        .file-thumb {
+            width: 48px;
+            height: 48px;
+            object-fit: cover;
+            border-radius: 4px;
+            background: #edf2f7;
+            flex-shrink: 0;
+        }
+        .file-select {
+            width: 22px;
+            height: 22px;
+            flex-shrink: 0;
+        }
+        .download-btn:disabled {
+            background: #cbd5e0;
+            cursor: not-allowed;
+        }
+        .list-controls {
+            display: flex;
+            gap: 8px;
+            margin-bottom: 12px;
+        }
+        .list-controls input, .list-controls select {
+            flex: 1;
+            padding: 10px;
+            font-size: clamp(14px, 3.5vw, 16px);
+            border: 1px solid #cbd5e0;
+            border-radius: 6px;
+            background: white;
+            min-width: 0;
+        }
         .no-files {
             padding: 20px;
             text-align: center;
@@ -304,9 +2980,19 @@ def index():
                     <span class="direction-badge">Computer → Phone</span>
                 </div>
                 <button class="refresh-btn" id="refreshBtn">🔄 Refresh File List</button>
+                <div class="list-controls">
+                    <input type="search" id="fileSearch" placeholder="Search files">
+                    <select id="fileSort">
+                        <option value="name:asc">Name</option>
+                        <option value="mtime:desc">Newest</option>
+                        <option value="size:desc">Largest</option>
+                    </select>
+                </div>
                 <div id="availableFiles" class="available-files">
                     <div class="no-files">Loading files...</div>
                 </div>
+                <button class="refresh-btn" id="loadMoreBtn" style="display: none; margin-top: 12px;">Load more</button>
+                <button class="download-btn" id="downloadSelectedBtn" disabled>📦 Download selected</button>
             </div>
             <div id="progressContainer" class="progress-container">
                 <div class="progress-bar-bg">
@@ -321,6 +3007,106 @@ def index():
             </div>
         </div>
     </div>
+    <script type="text/js-worker" id="hashWorker">
+        // Runs in a Web Worker. crypto.subtle is missing on plain-http LAN pages,
+        // so SHA-256 is done here incrementally.
+        var SAMPLE_SIZE = 64 * 1024;
+        var K = new Uint32Array([
+            0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+            0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+            0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+            0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+            0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+            0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+            0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+            0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+        ]);
+        function Sha256() {
+            this.h = new Uint32Array([0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+                                      0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]);
+            this.w = new Uint32Array(64);
+            this.pending = new Uint8Array(64);
+            this.pendingLength = 0;
+            this.length = 0;
+        }
+        Sha256.prototype.block = function(bytes, offset) {
+            var w = this.w, h = this.h, i, t1, t2;
+            for (i = 0; i < 16; i++) {
+                var j = offset + i * 4;
+                w[i] = (bytes[j] << 24) | (bytes[j + 1] << 16) | (bytes[j + 2] << 8) | bytes[j + 3];
+            }
+            for (i = 16; i < 64; i++) {
+                var a = w[i - 15], b = w[i - 2];
+                var s0 = ((a >>> 7) | (a << 25)) ^ ((a >>> 18) | (a << 14)) ^ (a >>> 3);
+                var s1 = ((b >>> 17) | (b << 15)) ^ ((b >>> 19) | (b << 13)) ^ (b >>> 10);
+                w[i] = (w[i - 16] + s0 + w[i - 7] + s1) | 0;
+            }
+            var A = h[0], B = h[1], C = h[2], D = h[3], E = h[4], F = h[5], G = h[6], H = h[7];
+            for (i = 0; i < 64; i++) {
+                t1 = (H + (((E >>> 6) | (E << 26)) ^ ((E >>> 11) | (E << 21)) ^ ((E >>> 25) | (E << 7))) +
+                      ((E & F) ^ (~E & G)) + K[i] + w[i]) | 0;
+                t2 = ((((A >>> 2) | (A << 30)) ^ ((A >>> 13) | (A << 19)) ^ ((A >>> 22) | (A << 10))) +
+                      ((A & B) ^ (A & C) ^ (B & C))) | 0;
+                H = G; G = F; F = E; E = (D + t1) | 0;
+                D = C; C = B; B = A; A = (t1 + t2) | 0;
+            }
+            h[0] += A; h[1] += B; h[2] += C; h[3] += D; h[4] += E; h[5] += F; h[6] += G; h[7] += H;
+        };
+        Sha256.prototype.update = function(bytes) {
+            var offset = 0;
+            this.length += bytes.length;
+            if (this.pendingLength > 0) {
+                var take = Math.min(64 - this.pendingLength, bytes.length);
+                this.pending.set(bytes.subarray(0, take), this.pendingLength);
+                this.pendingLength += take;
+                offset = take;
+                if (this.pendingLength < 64) return;
+                this.block(this.pending, 0);
+                this.pendingLength = 0;
+            }
+            for (; offset + 64 <= bytes.length; offset += 64) this.block(bytes, offset);
+            this.pending.set(bytes.subarray(offset), 0);
+            this.pendingLength = bytes.length - offset;
+        };
+        Sha256.prototype.hex = function() {
+            var bits = this.length * 8;
+            var tail = new Uint8Array(this.pendingLength < 56 ? 64 : 128);
+            tail.set(this.pending.subarray(0, this.pendingLength));
+            tail[this.pendingLength] = 0x80;
+            var view = new DataView(tail.buffer);
+            view.setUint32(tail.length - 8, Math.floor(bits / 0x100000000));
+            view.setUint32(tail.length - 4, bits >>> 0);
+            for (var offset = 0; offset < tail.length; offset += 64) this.block(tail, offset);
+            return Array.prototype.map.call(this.h, function(word) {
+                return ('0000000' + word.toString(16)).slice(-8);
+            }).join('');
+        };
+        function sampleSpans(size) {
+            if (size <= 3 * SAMPLE_SIZE) return [[0, size]];
+            var middle = Math.floor((size - SAMPLE_SIZE) / 2);
+            return [[0, SAMPLE_SIZE], [middle, middle + SAMPLE_SIZE], [size - SAMPLE_SIZE, size]];
+        }
+        self.onmessage = function(e) {
+            // {file, full}: the sampled hash (three 64 KB windows), or the SHA-256 of every byte
+            var file = e.data.file;
+            var reader = new FileReaderSync();
+            function read(start, end) {
+                return new Uint8Array(reader.readAsArrayBuffer(file.slice(start, end)));
+            }
+            if (e.data.full) {
+                var full = new Sha256();
+                for (var start = 0; start < file.size; start += 4 * 1024 * 1024) {
+                    full.update(read(start, Math.min(start + 4 * 1024 * 1024, file.size)));
+                }
+                self.postMessage({sha256: full.hex()});
+                return;
+            }
+            var sample = new Sha256();
+            sample.update(new TextEncoder().encode(file.size + ':'));
+            sampleSpans(file.size).forEach(function(span) { sample.update(read(span[0], span[1])); });
+            self.postMessage({sample: sample.hex()});
+        };
+    </script>
     <script>
         var uploadStartTime = 0;
         function formatFileSize(bytes) {
@@ -376,139 +3162,945 @@ def index():
                 btn.disabled = true;
             }
         });
-        function uploadFiles(formData, fileCount) {
+        var MAX_RETRIES = 8;
+        var MAX_CONCURRENT_FILES = 4;
+        var FULL_HASH_LIMIT = 32 * 1024 * 1024;
+        var connections = {max: 6, limit: 2, active: 0, waiting: [], bytes: 0, since: 0, lastRate: 0, step: 1};
+        function acquireConnection() {
+            return new Promise(function(resolve) {
+                if (connections.active < connections.limit) {
+                    connections.active += 1;
+                    resolve();
+                } else {
+                    connections.waiting.push(resolve);
+                }
+            });
+        }
+        function releaseConnection(bytes) {
+            connections.active -= 1;
+            adaptConcurrency(bytes);
+            while (connections.active < connections.limit && connections.waiting.length > 0) {
+                connections.active += 1;
+                connections.waiting.shift()();
+            }
+        }
+        function adaptConcurrency(bytes) {
+            // Hill climbing on measured throughput: keep moving the connection limit
+            // the same way while the rate improves, turn around when it drops
+            var now = Date.now();
+            connections.bytes += bytes;
+            if (!connections.since) connections.since = now;
+            if (now - connections.since < 2000) return;
+            var rate = connections.bytes / (now - connections.since);
+            if (rate < connections.lastRate * 0.95) connections.step = -connections.step;
+            connections.limit = Math.max(1, Math.min(connections.max, connections.limit + connections.step));
+            connections.lastRate = rate;
+            connections.bytes = 0;
+            connections.since = now;
+        }
+        function wait(ms) {
+            return new Promise(function(resolve) { setTimeout(resolve, ms); });
+        }
+        function waitTurn(direction, size) {
+            // Resolves to a ticket once the server has a slot; until then it shows
+            // the place in line and asks again when the server says to
+            var ticket = null;
+            function ask() {
+                var url = '/queue/' + direction + (size === null ? '' : '?size=' + size);
+                return fetch(url, {headers: ticket ? {'X-Queue-Ticket': ticket} : {}}).then(function(response) {
+                    return response.json().then(function(data) {
+                        if (response.ok) return data.ticket;
+                        if (response.status !== 503) {
+                            var error = new Error(data.error || 'Request failed');
+                            error.status = response.status;
+                            throw error;
+                        }
+                        ticket = data.ticket || null;
+                        showMessage(data.position ? 'Server busy: #' + data.position + ' in line, starting automatically...'
+                                                  : 'Server busy, trying again shortly...', 'success');
+                        var delay = parseFloat(response.headers.get('Retry-After')) || data.retry_after || 1;
+                        return wait(delay * 1000).then(ask);
+                    });
+                });
+            }
+            return ask();
+        }
+        function requestJson(method, url, body) {
+            var options = {method: method};
+            if (body) {
+                options.headers = {'Content-Type': 'application/json'};
+                options.body = JSON.stringify(body);
+            }
+            return fetch(url, options).then(function(response) {
+                return response.json().then(function(data) {
+                    if (!response.ok) {
+                        var error = new Error(data.error || 'Request failed');
+                        error.status = response.status;
+                        throw error;
+                    }
+                    return data;
+                });
+            });
+        }
+        function sessionKey(file) {
+            return 'upload:' + file.name + ':' + file.size + ':' + file.lastModified;
+        }
+        function openSession(file) {
+            var key = sessionKey(file);
+            var existing = localStorage.getItem(key);
+            function create() {
+                return requestJson('POST', '/upload/session', {name: file.name, size: file.size}).then(function(session) {
+                    localStorage.setItem(key, session.id);
+                    return session;
+                });
+            }
+            if (!existing) return create();
+            return requestJson('GET', '/upload/session/' + existing).catch(create);
+        }
+        function missingPieces(session) {
+            var pieces = [];
+            for (var start = 0; start < session.size; start += session.chunk_size) {
+                var end = Math.min(start + session.chunk_size, session.size);
+                var pos = start;
+                session.ranges.forEach(function(range) {
+                    if (range[1] <= pos || range[0] >= end) return;
+                    if (range[0] > pos) pieces.push([pos, range[0]]);
+                    pos = Math.max(pos, range[1]);
+                });
+                if (pos < end) pieces.push([pos, end]);
+            }
+            return pieces;
+        }
+        var COMPRESSED_TYPES = /\\.(jpe?g|png|gif|webp|heic|mp3|mp4|m4a|mkv|mov|avi|webm|ogg|flac|zip|gz|tgz|bz2|xz|zst|7z|rar|apk|docx|xlsx|pptx)$/i;
+        var MAGIC_SIGNATURES = [[0, 'ffd8ff'], [0, '89504e47'], [0, '47494638'], [4, '66747970'], [0, '1a45dfa3'],
+                                [0, '4f676753'], [0, '504b0304'], [0, '1f8b'], [0, '28b52ffd'], [0, '377abcaf271c']];
+        var compressUploads = typeof CompressionStream !== 'undefined';
+        function shouldCompress(file) {
+            if (!compressUploads || file.size < 1024 || COMPRESSED_TYPES.test(file.name)) return Promise.resolve(false);
+            return file.slice(0, 16).arrayBuffer().then(function(buffer) {
+                var hex = Array.prototype.map.call(new Uint8Array(buffer), function(b) {
+                    return ('0' + b.toString(16)).slice(-2);
+                }).join('');
+                return !MAGIC_SIGNATURES.some(function(sig) { return hex.substr(sig[0] * 2, sig[1].length) === sig[1]; });
+            });
+        }
+        function chunkBody(file, start, end, compress) {
+            var blob = file.slice(start, end);
+            if (!compress) return Promise.resolve(blob);
+            return new Response(blob.stream().pipeThrough(new CompressionStream('gzip'))).blob();
+        }
+        function sendChunk(sessionId, file, start, end, onProgress, compress, ticket) {
+            return chunkBody(file, start, end, compress).then(function(body) {
+                return sendBody(sessionId, start, body, compress, ticket, function(loaded) {
+                    // Progress is reported in original bytes, not bytes on the wire
+                    onProgress(body.size > 0 ? Math.round(loaded * (end - start) / body.size) : 0);
+                });
+            });
+        }
+        function sendBody(sessionId, start, body, compress, ticket, onProgress) {
+            return new Promise(function(resolve, reject) {
+                var xhr = new XMLHttpRequest();
+                xhr.upload.addEventListener('progress', function(e) { onProgress(e.loaded); });
+                xhr.addEventListener('load', function() {
+                    var data = {};
+                    try { data = JSON.parse(xhr.responseText); } catch (err) {}
+                    if (xhr.status === 200) {
+                        resolve(data);
+                    } else {
+                        var error = new Error(data.error || 'Upload failed');
+                        error.status = xhr.status;
+                        reject(error);
+                    }
+                });
+                xhr.addEventListener('error', function() { reject(new Error('Connection lost')); });
+                xhr.open('PUT', '/upload/session/' + sessionId + '?offset=' + start);
+                if (compress) xhr.setRequestHeader('Content-Encoding', 'gzip');
+                if (ticket) xhr.setRequestHeader('X-Queue-Ticket', ticket);
+                xhr.send(body);
+            });
+        }
+        function updateProgress(loaded, total, sent) {
+            var percent = total > 0 ? Math.round((loaded / total) * 100) : 100;
+            var elapsed = (Date.now() - uploadStartTime) / 1000;
+            var speed = elapsed > 0 ? sent / elapsed : 0;
+            var remaining = speed > 0 ? (total - loaded) / speed : 0;
+            document.getElementById('progressBar').style.width = percent + '%';
+            document.getElementById('progressText').textContent = percent + '%';
+            document.getElementById('progressSize').textContent = formatFileSize(loaded) + ' / ' + formatFileSize(total);
+            document.getElementById('progressTime').textContent = 'Elapsed: ' + formatTime(elapsed);
+            document.getElementById('progressEta').textContent = remaining > 0 ? 'ETA: ' + formatTime(remaining) : 'ETA: --';
+        }
+        function reportProgress(tracker) {
+            var loaded = tracker.completed;
+            var sent = tracker.sent;
+            Object.keys(tracker.received).forEach(function(key) { loaded += tracker.received[key]; });
+            Object.keys(tracker.inflight).forEach(function(key) {
+                loaded += tracker.inflight[key];
+                sent += tracker.inflight[key];
+            });
+            updateProgress(Math.min(loaded, tracker.total), tracker.total, sent);
+        }
+        function uploadFile(file, tracker) {
+            var attempt = 0;
+            var compress = false;
+            var fileKey = sessionKey(file);
+            if (!fileDigests[fileKey] && file.size <= FULL_HASH_LIMIT && canHash()) {
+                // Small files are hashed alongside the upload for the end-to-end check
+                fileDigests[fileKey] = hashFile(file, true).then(function(hash) {
+                    return hash.sha256;
+                }, function() { return null; });
+            }
+            function attemptUpload(session, ticket) {
+                // Segments go out over the shared connection pool; after the first
+                // failure the ones still queued are dropped and the retry picks them up.
+                // They all carry the ticket: the first claims the slot, the rest share it.
+                var failed = false;
+                connections.max = session.max_connections || connections.max;
+                tracker.received[fileKey] = session.received;
+                return Promise.all(missingPieces(session).map(function(piece) {
+                    var key = session.id + ':' + piece[0];
+                    return acquireConnection().then(function() {
+                        if (failed) {
+                            releaseConnection(0);
+                            return;
+                        }
+                        return sendChunk(session.id, file, piece[0], piece[1], function(loaded) {
+                            tracker.inflight[key] = loaded;
+                            reportProgress(tracker);
+                        }, compress, ticket).then(function(status) {
+                            delete tracker.inflight[key];
+                            tracker.sent += piece[1] - piece[0];
+                            tracker.received[fileKey] = Math.max(tracker.received[fileKey], status.received);
+                            attempt = 0;
+                            releaseConnection(piece[1] - piece[0]);
+                        }, function(error) {
+                            delete tracker.inflight[key];
+                            failed = true;
+                            releaseConnection(0);
+                            throw error;
+                        });
+                    });
+                })).then(function() {
+                    // With a known digest the server refuses to commit damaged bytes
+                    return Promise.resolve(fileDigests[fileKey]).then(function(digest) {
+                        return requestJson('POST', '/upload/session/' + session.id + '/finalize', digest ? {sha256: digest} : null);
+                    });
+                });
+            }
+            function run() {
+                return openSession(file).then(function(session) {
+                    return waitTurn('upload', session.size - session.received).then(function(ticket) {
+                        return attemptUpload(session, ticket);
+                    });
+                }).catch(function(error) {
+                    if (error.status === 415 && compress) {
+                        // The server can't decode it; send the rest as is
+                        compress = compressUploads = false;
+                        return run();
+                    }
+                    if (error.status === 503) {
+                        // Lost the slot between segments; get back in line
+                        return run();
+                    }
+                    if (error.status === 507) throw error;
+                    attempt += 1;
+                    if (attempt > MAX_RETRIES) throw error;
+                    var delay = Math.min(1000 * Math.pow(2, attempt - 1), 30000);
+                    showMessage('Connection lost, resuming in ' + formatTime(delay / 1000) + '...', 'error');
+                    return wait(delay).then(run);
+                });
+            }
+            return shouldCompress(file).then(function(result) {
+                compress = result;
+                return run();
+            }).then(function(result) {
+                localStorage.removeItem(fileKey);
+                delete fileDigests[fileKey];
+                delete tracker.received[fileKey];
+                tracker.completed += file.size;
+                reportProgress(tracker);
+                return result;
+            });
+        }
+        var hashWorker = null;
+        var hashQueue = Promise.resolve();
+        var fileDigests = {};
+        function canHash() {
+            return typeof Worker !== 'undefined' && typeof FileReader !== 'undefined';
+        }
+        function hashFile(file, full) {
+            // One file at a time through the worker
+            if (!hashWorker) {
+                var source = document.getElementById('hashWorker').textContent;
+                hashWorker = new Worker(URL.createObjectURL(new Blob([source], {type: 'text/javascript'})));
+            }
+            var result = hashQueue.then(function() {
+                return new Promise(function(resolve, reject) {
+                    hashWorker.onmessage = function(e) { resolve(e.data); };
+                    hashWorker.onerror = function(e) { reject(new Error(e.message)); };
+                    hashWorker.postMessage({file: file, full: full});
+                });
+            });
+            hashQueue = result.catch(function() {});
+            return result;
+        }
+        function hashAll(files, full) {
+            return Promise.all(files.map(function(file) { return hashFile(file, full); }));
+        }
+        function precheckFiles(files) {
+            // Resolves to the files the computer doesn't have yet; on any failure, all of them.
+            // Only the sampled hash is taken up front; files whose sample matches something
+            // on the computer ('maybe') are then hashed in full to confirm it.
+            if (!canHash()) return Promise.resolve(files);
+            var samples = [];
+            var digests = {};
+            function ask() {
+                return requestJson('POST', '/upload/precheck', {files: files.map(function(file, i) {
+                    return {name: file.name, size: file.size, sample: samples[i].sample, sha256: digests[i]};
+                })});
+            }
+            return hashAll(files, false).then(function(hashes) {
+                samples = hashes;
+                return ask();
+            }).then(function(result) {
+                var maybe = [];
+                files.forEach(function(file, i) { if (result.files[i].status === 'maybe') maybe.push(i); });
+                if (maybe.length === 0) return result;
+                return hashAll(maybe.map(function(i) { return files[i]; }), true).then(function(hashes) {
+                    maybe.forEach(function(i, n) {
+                        digests[i] = hashes[n].sha256;
+                        fileDigests[sessionKey(files[i])] = hashes[n].sha256;
+                    });
+                    return ask();
+                });
+            }).then(function(result) {
+                return files.filter(function(file, i) { return result.files[i].status === 'missing'; });
+            }).catch(function(error) {
+                // Not enough room is final; anything else just means no pre-check
+                if (error.status === 507) throw error;
+                return files;
+            });
+        }
+        function uploadFiles(files) {
+            showMessage('Checking for files already on the computer...', 'success');
+            precheckFiles(files).then(function(missing) {
+                sendFiles(missing, files.length - missing.length);
+            }, function(error) {
+                showMessage(error.message, 'error');
+            });
+        }
+        function sendFiles(files, skipped) {
             var progressContainer = document.getElementById('progressContainer');
-            var progressBar = document.getElementById('progressBar');
-            var progressText = document.getElementById('progressText');
-            var progressSize = document.getElementById('progressSize');
-            var progressTime = document.getElementById('progressTime');
-            var progressEta = document.getElementById('progressEta');
             progressContainer.classList.add('show');
             uploadStartTime = Date.now();
-            var xhr = new XMLHttpRequest();
-            xhr.upload.addEventListener('progress', function(e) {
-                if (e.lengthComputable) {
-                    var percent = Math.round((e.loaded / e.total) * 100);
-                    var elapsed = (Date.now() - uploadStartTime) / 1000;
-                    var speed = e.loaded / elapsed;
-                    var remaining = (e.total - e.loaded) / speed;
-                    progressBar.style.width = percent + '%';
-                    progressText.textContent = percent + '%';
-                    progressSize.textContent = formatFileSize(e.loaded) + ' / ' + formatFileSize(e.total);
-                    progressTime.textContent = 'Elapsed: ' + formatTime(elapsed);
-                    progressEta.textContent = remaining > 0 ? 'ETA: ' + formatTime(remaining) : 'ETA: --';
-                }
-            });
-            xhr.addEventListener('load', function() {
+            var tracker = {
+                total: files.reduce(function(sum, file) { return sum + file.size; }, 0),
+                completed: 0,
+                sent: 0,
+                received: {},
+                inflight: {}
+            };
+            connections.since = connections.bytes = 0;
+            // A few files at a time; small ones then share the pool instead of queueing
+            var queue = files.slice();
+            function nextFile() {
+                var file = queue.shift();
+                if (!file) return Promise.resolve();
+                return uploadFile(file, tracker).then(nextFile, function(error) {
+                    queue.length = 0;
+                    throw error;
+                });
+            }
+            var workers = [];
+            for (var i = 0; i < Math.min(MAX_CONCURRENT_FILES, files.length); i++) workers.push(nextFile());
+            Promise.all(workers).then(function() {
                 progressContainer.classList.remove('show');
-                if (xhr.status === 200) {
-                    showMessage(fileCount === 1 ? 'File uploaded successfully!' : fileCount + ' files uploaded successfully!', 'success');
-                    document.getElementById('singleForm').reset();
-                    document.getElementById('multiForm').reset();
-                    document.getElementById('singleInfo').classList.remove('show');
-                    document.getElementById('multiInfo').classList.remove('show');
-                    document.querySelector('#singleForm button').disabled = true;
-                    document.querySelector('#multiForm button').disabled = true;
-                } else {
-                    showMessage('Upload failed. Please try again.', 'error');
-                }
-            });
-            xhr.addEventListener('error', function() {
+                var sent = files.length === 1 ? 'File uploaded successfully!' : files.length + ' files uploaded successfully!';
+                if (files.length === 0) sent = 'Nothing to upload.';
+                showMessage(skipped > 0 ? sent + ' ' + skipped + ' already on the computer.' : sent, 'success');
+                document.getElementById('singleForm').reset();
+                document.getElementById('multiForm').reset();
+                document.getElementById('singleInfo').classList.remove('show');
+                document.getElementById('multiInfo').classList.remove('show');
+                document.querySelector('#singleForm button').disabled = true;
+                document.querySelector('#multiForm button').disabled = true;
+            }).catch(function(error) {
                 progressContainer.classList.remove('show');
-                showMessage('Upload failed. Check your connection.', 'error');
+                showMessage(error.status === 507 ? error.message : 'Upload interrupted. Select the same file again to resume.', 'error');
             });
-            xhr.open('POST', '/upload');
-            xhr.send(formData);
         }
         document.getElementById('singleForm').addEventListener('submit', function(e) {
             e.preventDefault();
             var file = document.getElementById('singleFile').files[0];
             if (file) {
-                var formData = new FormData();
-                formData.append('files', file);
-                uploadFiles(formData, 1);
+                uploadFiles([file]);
             }
         });
         document.getElementById('multiForm').addEventListener('submit', function(e) {
             e.preventDefault();
-            var files = document.getElementById('multiFiles').files;
+            var files = Array.from(document.getElementById('multiFiles').files);
             if (files.length > 0) {
-                var formData = new FormData();
-                for (var i = 0; i < files.length; i++) {
-                    formData.append('files', files[i]);
-                }
-                uploadFiles(formData, files.length);
+                uploadFiles(files);
             }
         });
-        function refreshFileList() {
-            fetch('/list_files').then(function(response) {
+        var PAGE_SIZE = 100;
+        var listCursor = null;
+        var searchTimer = null;
+        var listVersion = null;
+        function fileListUrl(cursor) {
+            var sort = document.getElementById('fileSort').value.split(':');
+            var params = ['limit=' + PAGE_SIZE, 'sort=' + sort[0], 'order=' + sort[1]];
+            var query = document.getElementById('fileSearch').value.trim();
+            if (query) params.push('q=' + encodeURIComponent(query));
+            if (cursor) params.push('cursor=' + encodeURIComponent(cursor));
+            return '/list_files?' + params.join('&');
+        }
+        var PREVIEW_TYPES = /[.](jpe?g|png|gif|webp|bmp|tiff?|heic|heif|avif|mp4|mov|m4v|mkv|webm|avi|3gp)$/i;
+        var thumbObserver = null;
+        function observeThumbnails() {
+            // Previews load only once their row scrolls into view
+            var images = document.querySelectorAll('#availableFiles img.file-thumb[data-src]');
+            if (!window.IntersectionObserver) {
+                Array.prototype.forEach.call(images, function(img) { img.src = img.getAttribute('data-src'); img.removeAttribute('data-src'); });
+                return;
+            }
+            if (!thumbObserver) {
+                thumbObserver = new IntersectionObserver(function(entries) {
+                    entries.forEach(function(entry) {
+                        if (!entry.isIntersecting) return;
+                        var img = entry.target;
+                        img.src = img.getAttribute('data-src');
+                        img.removeAttribute('data-src');
+                        thumbObserver.unobserve(img);
+                    });
+                }, {root: document.getElementById('availableFiles'), rootMargin: '200px'});
+            }
+            Array.prototype.forEach.call(images, function(img) { thumbObserver.observe(img); });
+        }
+        function renderThumbnail(file) {
+            if (!PREVIEW_TYPES.test(file.name)) return '';
+            var url = '/thumbnail/' + encodeURIComponent(file.name) + '?v=' + file.mtime + '-' + file.size;
+            return '<img class="file-thumb" alt="" data-src="' + url + '" onerror="thumbnailFailed(this)">';
+        }
+        var THUMBNAIL_ATTEMPTS = 30;
+        function thumbnailFailed(img) {
+            // A preview still being made answers 202 with Retry-After: wait for it
+            // with HEAD requests, then load the image again
+            var url = img.getAttribute('src');
+            var attempt = 0;
+            function poll() {
+                fetch(url, {method: 'HEAD'}).then(function(response) {
+                    if (response.status === 202 && ++attempt < THUMBNAIL_ATTEMPTS) {
+                        var delay = parseFloat(response.headers.get('Retry-After')) || 1;
+                        setTimeout(poll, delay * 1000);
+                    } else if (response.ok) {
+                        img.onerror = function() { img.style.visibility = 'hidden'; };
+                        img.removeAttribute('src');
+                        img.src = url;
+                    } else {
+                        img.style.visibility = 'hidden';
+                    }
+                }).catch(function() { img.style.visibility = 'hidden'; });
+            }
+            if (!url || typeof fetch === 'undefined') {
+                img.style.visibility = 'hidden';
+                return;
+            }
+            poll();
+        }
+        function renderFileRow(file) {
+            return '<div class="available-file" data-name="' + encodeURIComponent(file.name) + '" data-size="' + file.size + '" data-mtime="' + file.mtime + '"><input type="checkbox" class="file-select">' + renderThumbnail(file) + '<div><div class="file-name"' + (file.sha256 ? ' title="SHA-256 ' + file.sha256 + '"' : '') + '>' + file.name + '</div><div class="file-size">' + formatFileSize(file.size) + '</div></div><button class="download-btn" data-filename="' + encodeURIComponent(file.name) + '">⬇️ Download</button></div>';
+        }
+        function refreshFileList(append) {
+            append = append === true;
+            fetch(fileListUrl(append ? listCursor : null)).then(function(response) {
+                listVersion = response.headers.get('ETag');
                 return response.json();
             }).then(function(data) {
                 var container = document.getElementById('availableFiles');
-                if (data.files.length === 0) {
+                if (!append && data.files.length === 0) {
                     container.innerHTML = '<div class="no-files">No files available for download</div>';
                 } else {
-                    var html = '';
-                    data.files.forEach(function(file) {
-                        html += '<div class="available-file"><div><div class="file-name">' + file.name + '</div><div class="file-size">' + formatFileSize(file.size) + '</div></div><button class="download-btn" data-filename="' + encodeURIComponent(file.name) + '">⬇️ Download</button></div>';
-                    });
-                    container.innerHTML = html;
-                    var downloadButtons = container.querySelectorAll('.download-btn');
-                    for (var i = 0; i < downloadButtons.length; i++) {
-                        downloadButtons[i].addEventListener('click', function() {
-                            var filename = this.getAttribute('data-filename');
-                            window.location.href = '/download/' + filename;
-                            showMessage('Downloading ' + decodeURIComponent(filename) + '...', 'success');
-                        });
+                    var html = data.files.map(renderFileRow).join('');
+                    if (append) {
+                        container.insertAdjacentHTML('beforeend', html);
+                    } else {
+                        container.innerHTML = html;
                     }
                 }
+                listCursor = data.next_cursor;
+                document.getElementById('loadMoreBtn').style.display = listCursor ? 'block' : 'none';
+                observeThumbnails();
+                updateSelection();
             }).catch(function() {
                 showMessage('Failed to load file list', 'error');
             });
         }
-        document.getElementById('refreshBtn').addEventListener('click', refreshFileList);
+        function findFileRow(name) {
+            var rows = document.querySelectorAll('#availableFiles .available-file');
+            for (var i = 0; i < rows.length; i++) {
+                if (rows[i].getAttribute('data-name') === encodeURIComponent(name)) return rows[i];
+            }
+            return null;
+        }
+        function rowComesBefore(file, row) {
+            var sort = document.getElementById('fileSort').value;
+            if (sort === 'mtime:desc') return file.mtime >= Number(row.getAttribute('data-mtime'));
+            if (sort === 'size:desc') return file.size >= Number(row.getAttribute('data-size'));
+            return file.name.toLowerCase() < decodeURIComponent(row.getAttribute('data-name')).toLowerCase();
+        }
+        function applyChanges(change) {
+            var container = document.getElementById('availableFiles');
+            var query = document.getElementById('fileSearch').value.trim().toLowerCase();
+            change.removed.forEach(function(name) {
+                var row = findFileRow(name);
+                if (row) row.parentNode.removeChild(row);
+            });
+            change.modified.concat(change.added).forEach(function(file) {
+                var row = findFileRow(file.name);
+                if (row) row.parentNode.removeChild(row);
+                if (query && file.name.toLowerCase().indexOf(query) === -1) return;
+                var rows = container.querySelectorAll('.available-file');
+                var before = null;
+                for (var i = 0; i < rows.length; i++) {
+                    if (rowComesBefore(file, rows[i])) { before = rows[i]; break; }
+                }
+                // Rows past the loaded page arrive with Load more instead
+                if (!before && listCursor) return;
+                var placeholder = container.querySelector('.no-files');
+                if (placeholder) container.removeChild(placeholder);
+                if (before) {
+                    before.insertAdjacentHTML('beforebegin', renderFileRow(file));
+                } else {
+                    container.insertAdjacentHTML('beforeend', renderFileRow(file));
+                }
+            });
+            if (!container.querySelector('.available-file')) {
+                container.innerHTML = '<div class="no-files">No files available for download</div>';
+            }
+            listVersion = change.version;
+            observeThumbnails();
+            updateSelection();
+        }
+        function connectEvents() {
+            if (!window.EventSource) return;
+            var source = new EventSource('/events');
+            source.addEventListener('hello', function(e) {
+                // Anything missed while disconnected is picked up with one full refresh
+                if (listVersion && JSON.parse(e.data).version !== listVersion) refreshFileList();
+            });
+            source.addEventListener('change', function(e) { applyChanges(JSON.parse(e.data)); });
+            source.addEventListener('reset', function() { refreshFileList(); });
+        }
+        document.getElementById('availableFiles').addEventListener('click', function(e) {
+            var button = e.target.closest('.download-btn');
+            if (!button) return;
+            var filename = button.getAttribute('data-filename');
+            var size = Number(button.parentNode.getAttribute('data-size'));
+            waitTurn('download', size).then(function(ticket) {
+                window.location.href = '/download/' + filename + (ticket ? '?ticket=' + ticket : '');
+                showMessage('Downloading ' + decodeURIComponent(filename) + '...', 'success');
+            }).catch(function(error) {
+                showMessage('Download failed: ' + error.message, 'error');
+            });
+        });
+        function selectedNames() {
+            var boxes = document.querySelectorAll('#availableFiles .file-select:checked');
+            return Array.prototype.map.call(boxes, function(box) {
+                return decodeURIComponent(box.parentNode.getAttribute('data-name'));
+            });
+        }
+        function updateSelection() {
+            var count = selectedNames().length;
+            var btn = document.getElementById('downloadSelectedBtn');
+            btn.disabled = count === 0;
+            btn.textContent = count > 0 ? '📦 Download selected (' + count + ')' : '📦 Download selected';
+        }
+        function downloadArchive(names, ticket) {
+            // A form POST lets the browser save the streamed ZIP like any other download
+            var form = document.createElement('form');
+            form.method = 'POST';
+            form.action = '/download_zip' + (ticket ? '?ticket=' + ticket : '');
+            names.forEach(function(name) {
+                var input = document.createElement('input');
+                input.type = 'hidden';
+                input.name = 'names';
+                input.value = name;
+                form.appendChild(input);
+            });
+            document.body.appendChild(form);
+            form.submit();
+            document.body.removeChild(form);
+            showMessage('Downloading ' + names.length + ' files as ZIP...', 'success');
+        }
+        document.getElementById('availableFiles').addEventListener('change', updateSelection);
+        document.getElementById('downloadSelectedBtn').addEventListener('click', function() {
+            var names = selectedNames();
+            if (names.length === 0) return;
+            waitTurn('download', null).then(function(ticket) {
+                downloadArchive(names, ticket);
+            }).catch(function(error) {
+                showMessage('Download failed: ' + error.message, 'error');
+            });
+        });
+        document.getElementById('refreshBtn').addEventListener('click', function() { refreshFileList(); });
+        document.getElementById('loadMoreBtn').addEventListener('click', function() { refreshFileList(true); });
+        document.getElementById('fileSort').addEventListener('change', function() { refreshFileList(); });
+        document.getElementById('fileSearch').addEventListener('input', function() {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(refreshFileList, 300);
+        });
         refreshFileList();
+        connectEvents();
     </script>
 </body>
 </html>"""
     return html
 
 @app.route('/upload', methods=['POST'])
+@instrumented('upload', 'upload')
+@admitted(upload_queue, size=lambda: request.content_length)
 def upload_file():
+    shortage = check_free_space(request.content_length)
+    if shortage is not None:
+        log_message(f"Upload error: {shortage['error']}")
+        return jsonify(shortage), 507
+    if STREAMING_UPLOADS and request.mimetype == 'multipart/form-data':
+        return stream_upload()
     try:
-        files = request.files.getlist('files')
+        with profile_phase('form_parse'):
+            files = request.files.getlist('files')
         if not files:
             return jsonify({'error': 'No files provided'}), 400
         
-        for file in files:
+        expected = request.form.getlist('sha256')
+        checksums, rejected = {}, []
+        for i, file in enumerate(files):
             if file.filename:
-                from werkzeug.utils import secure_filename
-                safe_filename = secure_filename(file.filename)
-                filepath = os.path.join(DOWNLOAD_FOLDER, safe_filename)
-                file.save(filepath)
-                log_message(f"Received: {safe_filename}")
-        
-        return jsonify({'success': True, 'count': len(files)}), 200
+                with profile_phase('secure_filename'):
+                    safe_filename = secure_filename(file.filename)
+                # The form parser has spooled the part already, so its size is known
+                size = file.stream.seek(0, os.SEEK_END)
+                file.stream.seek(0)
+                incoming = IncomingFile(safe_filename, size)
+                try:
+                    for data in iter(lambda: file.stream.read(COPY_BUFFER_SIZE), b''):
+                        incoming.write(data)
+                    digest = incoming.hasher.hexdigest()
+                    if i < len(expected) and expected[i] and expected[i].strip().lower() != digest:
+                        incoming.abort()
+                        rejected.append(safe_filename)
+                        log_message(f"Upload error: Checksum mismatch for {safe_filename}")
+                        continue
+                    duplicate = incoming.commit()
+                except Exception:
+                    incoming.abort()
+                    raise
+                checksums[safe_filename] = digest
+                log_message(f"Received: {safe_filename}" + (" (duplicate)" if duplicate else ""))
+        if rejected:
+            return jsonify({'error': 'Checksum mismatch', 'rejected': rejected,
+                            'count': len(checksums), 'checksums': checksums}), 422
+        return jsonify({'success': True, 'count': len(files), 'checksums': checksums}), 200
+    except Exception as e:
+        log_message(f"Upload error: {str(e)}")
+        return jsonify({'error': str(e)}), 507 if is_disk_full(e) else 500
+
+def stream_upload():
+    boundary = request.mimetype_params.get('boundary')
+    if not boundary:
+        return jsonify({'error': 'Missing multipart boundary'}), 400
+    try:
+        decoder = StreamDecoder(request.headers.get('Content-Encoding', ''))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 415
+    upload = MultipartUpload(boundary.encode(), g.transfer, request.content_length)
+    step = SHAPING_QUANTUM if upload_shaper.active else UPLOAD_BUFFER_SIZE
+    try:
+        while True:
+            with profile_phase('socket_read'):
+                data = request.stream.read(step)
+            if not data:
+                break
+            # Only what is left after the nested multipart_parse counts as decompress
+            with profile_phase('decompress'):
+                for piece in decoder.decode(data):
+                    upload.feed(piece)
+        upload.feed(decoder.flush())
+        upload.feed(None)
+    except ValueError as e:
+        upload.abort()
+        log_message(f"Upload error: {str(e)}")
+        return jsonify({'error': 'Malformed upload'}), 400
+    except Exception as e:
+        upload.abort()
+        log_message(f"Upload error: {str(e)}")
+        return jsonify({'error': str(e)}), 507 if is_disk_full(e) else 500
+    status, body = upload.result()
+    return jsonify(body), status
+
+@app.route('/upload/precheck', methods=['POST'])
+def precheck_upload():
+    data = request.get_json(silent=True) or {}
+    files = data.get('files')
+    if not isinstance(files, list) or len(files) > MAX_PRECHECK_FILES:
+        return jsonify({'error': f'Expected a list of at most {MAX_PRECHECK_FILES} files'}), 400
+    try:
+        results = received_index.check(files)
+    except Exception as e:
+        log_message(f"Upload error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+    # The whole batch is known here, so a full disk is reported before the first byte is sent
+    needed = sum(item['size'] for item, result in zip(files, results)
+                 if result['status'] == 'missing' and isinstance(item, dict) and isinstance(item.get('size'), int))
+    shortage = check_free_space(needed)
+    if shortage is not None:
+        log_message(f"Upload error: {shortage['error']}")
+        return jsonify(dict(shortage, files=results)), 507
+    return jsonify({'files': results})
+
+@app.route('/upload/session', methods=['POST'])
+def create_upload_session():
+    try:
+        data = request.get_json(silent=True) or {}
+        safe_filename = secure_filename(data.get('name') or '')
+        size = data.get('size')
+        if not safe_filename or not isinstance(size, int) or size < 0:
+            return jsonify({'error': 'A file name and size are required'}), 400
+        shortage = check_free_space(size)
+        if shortage is not None:
+            log_message(f"Upload error: {shortage['error']}")
+            return jsonify(shortage), 507
+        session = UploadSession(uuid.uuid4().hex, safe_filename, size)
+        # Full (sparse) size up front, so segments can land anywhere in any order
+        try:
+            with open(session.part_path, 'wb') as f:
+                f.truncate(size)
+        except OSError:
+            if os.path.exists(session.part_path):
+                os.remove(session.part_path)
+            raise
+        session.save()
+        with upload_sessions_lock:
+            upload_sessions[session.id] = session
+        return jsonify(session.to_dict()), 201
+    except Exception as e:
+        log_message(f"Upload error: {str(e)}")
+        return jsonify({'error': str(e)}), 507 if is_disk_full(e) else 500
+
+@app.route('/upload/session/<session_id>', methods=['GET'])
+def get_upload_status(session_id):
+    session = get_upload_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    return jsonify(session.to_dict())
+
+@app.route('/upload/session/<session_id>', methods=['PUT'])
+@instrumented('upload_chunk', 'upload')
+@admitted(upload_queue, size=remaining_upload, group=lambda session_id: session_id)
+def upload_chunk(session_id):
+    session = get_upload_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    length = request.content_length
+    chunk, error = start_chunk(session, request.args.get('offset', type=int), length,
+                               request.headers.get('Content-Encoding', ''))
+    if chunk is None:
+        return jsonify(error[0]), error[1]
+    # Parallel segments show up as one file on the dashboard
+    g.transfer.name, g.transfer.total = session.filename, session.size
+    g.transfer.group, g.transfer.base = session.id, session.received
+    complete = False
+    try:
+        remaining = length
+        while remaining > 0:
+            with profile_phase('socket_read'):
+                data = request.stream.read(min(COPY_BUFFER_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            if not chunk.feed(data, remaining == 0):
+                break
+        complete = remaining == 0 and not chunk.overflow
+    except Exception as e:
+        chunk.fail(e)
+    body, status = chunk.finish(complete)
+    return jsonify(body), status
+
+@app.route('/upload/session/<session_id>/finalize', methods=['POST'])
+@instrumented('upload_finalize')
+def finalize_upload(session_id):
+    session = get_upload_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    try:
+        with session.lock:
+            if not session.is_complete():
+                return jsonify({'error': 'Upload is incomplete', 'ranges': session.ranges}), 409
+            if os.path.getsize(session.part_path) != session.size:
+                # The part file was cut short behind our back; start the file over
+                os.truncate(session.part_path, session.size)
+                session.ranges = []
+                session.reset_hash()
+                session.save()
+                return jsonify({'error': 'Upload is incomplete', 'ranges': session.ranges}), 409
+            with profile_phase('hash'):
+                digest = session.digest()
+            expected = (request.get_json(silent=True) or {}).get('sha256')
+            if isinstance(expected, str) and expected.strip().lower() != digest:
+                # Something arrived damaged; there is no telling which segment, so start over
+                session.ranges = []
+                session.reset_hash()
+                session.save()
+                log_message(f"Upload error: Checksum mismatch for {session.filename}")
+                return jsonify({'error': 'Checksum mismatch', 'ranges': session.ranges}), 422
+            filepath = os.path.join(DOWNLOAD_FOLDER, session.filename)
+            with profile_phase('commit'):
+                duplicate = content_store.commit(session.part_path, digest, filepath)
+                checksum_index.record(filepath, digest)
+            metrics.files_received.inc()
+            session.remove()
+        with upload_sessions_lock:
+            upload_sessions.pop(session.id, None)
+        upload_queue.end_group(session.id)
+        log_message(f"Received: {session.filename}" + (" (duplicate)" if duplicate else ""))
+        return jsonify({'success': True, 'name': session.filename, 'sha256': digest}), 200
     except Exception as e:
         log_message(f"Upload error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/upload/session/<session_id>', methods=['DELETE'])
+def abort_upload(session_id):
+    session = get_upload_session(session_id)
+    if session is None:
+        return jsonify({'error': 'Upload session not found'}), 404
+    with session.lock:
+        session.remove()
+    with upload_sessions_lock:
+        upload_sessions.pop(session.id, None)
+    upload_queue.end_group(session.id)
+    return jsonify({'success': True})
+
+@app.route('/dedup_stats', methods=['GET'])
+def dedup_stats():
+    try:
+        return jsonify(content_store.stats())
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/profile', methods=['GET'])
+def profile_report():
+    # ?format=pstats gives the sampled cProfile data for python -m pstats or snakeviz
+    if request.args.get('format') == 'pstats':
+        data = profiler.pstats_dump()
+        if data is None:
+            return jsonify({'error': 'No requests were sampled; set a sample rate with --profile-sample'}), 404
+        return Response(data, mimetype='application/octet-stream',
+                        headers={'Content-Disposition': content_disposition('file_transfer.pstats')})
+    return jsonify(profiler.report())
+
+@app.route('/profile', methods=['DELETE'])
+def reset_profile():
+    profiler.reset()
+    return jsonify({'success': True})
+
+@app.route('/queue/<direction>', methods=['GET'])
+def queue_probe(direction):
+    # Waiting room for clients about to send a large body or start a browser
+    # download: a 200 sets a slot aside for the ticket for QUEUE_HOLD_TIMEOUT,
+    # and the request that follows claims it with X-Queue-Ticket or ?ticket=
+    scheduler = transfer_queues.get(direction)
+    if scheduler is None:
+        return jsonify({'error': 'Unknown transfer direction'}), 404
+    if not scheduler.active:
+        return jsonify({'ticket': None, 'position': 0})
+    slot, ticket = scheduler.admit(request.remote_addr, request.args.get('size', type=int),
+                                   request.headers.get('X-Queue-Ticket') or request.args.get('ticket'), hold=True)
+    if slot is not None:
+        # Small enough to skip the line
+        return jsonify({'ticket': None, 'position': 0})
+    if ticket is None or ticket.position:
+        body, headers = queue_busy(ticket)
+        return jsonify(body), 503, headers
+    return jsonify({'ticket': ticket.id, 'position': 0}), 200, {'X-Queue-Ticket': ticket.id}
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain',
+                    headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+                             'Cache-Control': 'no-store'})
+
 @app.route('/list_files', methods=['GET'])
+@instrumented('list_files')
 def list_files():
     try:
-        files = []
-        for filename in os.listdir(UPLOAD_FOLDER):
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(filepath):
-                files.append({
-                    'name': filename,
-                    'size': os.path.getsize(filepath)
-                })
-        return jsonify({'files': files})
+        if request.args:
+            try:
+                etag, page = list_page(request.args)
+            except (ValueError, TypeError, IndexError) as e:
+                return jsonify({'error': f'Invalid listing parameters: {str(e)}'}), 400
+            listing = json.dumps(page).encode()
+        else:
+            etag, listing = share_index.json_listing()
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            return Response(status=304, headers=headers)
+        return Response(listing, mimetype='application/json', headers=headers)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/download_zip', methods=['GET', 'POST'])
+@instrumented('download_zip', 'download')
+@admitted(download_queue)
+def download_zip():
+    try:
+        values = request.values
+        if values.get('all'):
+            share_index.refresh()
+            names = sorted(share_index.entries)
+        else:
+            names = []
+            for name in values.getlist('names'):
+                if name and os.path.basename(name) == name and name not in names:
+                    names.append(name)
+            names = [name for name in names if os.path.isfile(os.path.join(UPLOAD_FOLDER, name))]
+        if not names:
+            return jsonify({'error': 'No files selected'}), 400
+        archive_name = f"shared-files-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+        g.transfer.name = archive_name
+        log_message(f"Sending archive: {len(names)} file(s)")
+        return Response(iter_zip_archive(names), mimetype='application/zip',
+                        headers={'Content-Disposition': content_disposition(archive_name)})
+    except Exception as e:
+        log_message(f"Download error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/events')
+def share_event_stream():
+    start_share_watcher()
+    events = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    callback = share_events.subscribe(events.put_nowait)
+
+    def stream():
+        try:
+            yield b'retry: 3000\n' + format_sse('hello', {'version': share_index.etag})
+            while True:
+                try:
+                    yield format_sse('change', events.get(timeout=EVENT_KEEPALIVE_INTERVAL))
+                except queue.Empty:
+                    if not share_events.is_subscribed(callback):
+                        yield format_sse('reset', {})
+                        return
+                    yield b': keepalive\n\n'
+        finally:
+            share_events.unsubscribe(callback)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/download/<filename>')
+@instrumented('download', 'download', sends_file=True)
+@admitted(download_queue, size=requested_download_size)
 def download_file(filename):
     try:
         # Prevent path traversal by only allowing base filenames
@@ -520,18 +4112,742 @@ def download_file(filename):
         if not os.path.isfile(filepath):
             log_message(f"Download error: File not found '{safe_filename}'")
             return jsonify({'error': 'File not found'}), 404
-        log_message(f"Sent: {safe_filename}")
-        return send_file(filepath, as_attachment=True)
+        with profile_phase('prepare'):
+            response = file_response(filepath, safe_filename)
+        if request.method == 'HEAD':
+            # Only the headers went out
+            return response
+        if response.status_code == 200:
+            log_message(f"Sent: {safe_filename}")
+        elif response.status_code == 206:
+            log_message(f"Sent: {safe_filename} ({response.headers.get('Content-Range', 'multiple ranges')})")
+        return response
     except Exception as e:
         log_message(f"Download error: {str(e)}")
         return jsonify({'error': 'File not found'}), 404
 
+@app.route('/thumbnail/<filename>')
+def thumbnail(filename):
+    safe_filename = os.path.basename(filename)
+    if safe_filename != filename or not safe_filename:
+        return jsonify({'error': 'Invalid filename'}), 400
+    filepath = os.path.join(UPLOAD_FOLDER, safe_filename)
+    if not os.path.isfile(filepath):
+        return jsonify({'error': 'File not found'}), 404
+    if not thumbnails.available(filepath):
+        return jsonify({'error': 'No preview for this file type'}), 404
+    st = os.stat(filepath)
+    # The page asks with ?v=<mtime>-<size>, so a changed file gets a new URL
+    headers = {'ETag': file_etag(st), 'Cache-Control': 'public, max-age=31536000, immutable'}
+    if is_not_modified(headers['ETag'], st.st_mtime):
+        return Response(status=304, headers=headers)
+    path, ready = thumbnails.get(filepath, st)
+    if not ready:
+        return (jsonify({'status': 'pending'}), 202,
+                {'Retry-After': str(THUMBNAIL_RETRY_AFTER), 'Cache-Control': 'no-store'})
+    if path is None:
+        return jsonify({'error': 'Preview could not be generated'}), 404
+    body = FileBody(path, [(0, os.path.getsize(path))], request.environ.get('werkzeug.socket'))
+    headers['Content-Length'] = str(body.content_length)
+    return Response(body, headers=headers, mimetype='image/jpeg', direct_passthrough=True)
+
+@app.route('/delta/<filename>', methods=['POST'])
+@instrumented('delta', 'download')
+@admitted(download_queue, size=requested_download_size)
+def delta_download(filename):
+    safe_filename = os.path.basename(filename)
+    if safe_filename != filename or not safe_filename:
+        return jsonify({'error': 'Invalid filename'}), 400
+    filepath = os.path.join(UPLOAD_FOLDER, safe_filename)
+    if not os.path.isfile(filepath):
+        return jsonify({'error': 'File not found'}), 404
+    data = request.get_json(silent=True) or {}
+    block_size, old_size, blocks = data.get('block_size'), data.get('size'), data.get('blocks')
+    if (not isinstance(block_size, int) or not DELTA_MIN_BLOCK_SIZE <= block_size <= DELTA_MAX_BLOCK_SIZE
+            or not isinstance(old_size, int) or not isinstance(blocks, list)
+            or len(blocks) > MAX_DELTA_BLOCKS or len(blocks) != -(-old_size // block_size)):
+        return jsonify({'error': 'Expected block_size, size and one signature per block'}), 400
+    try:
+        blocks = [(int(weak), str(strong)) for weak, strong in blocks]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Malformed block signatures'}), 400
+    st = os.stat(filepath)
+    headers = {'ETag': file_etag(st), 'X-File-Size': str(st.st_size), 'Cache-Control': 'no-store'}
+    if is_not_modified(headers['ETag'], st.st_mtime):
+        return Response(status=304, headers=headers)
+
+    def generate():
+        yield from iter_delta(filepath, block_size, blocks, old_size)
+        log_message(f"Sent: {safe_filename} (delta)")
+
+    return Response(generate(), headers=headers, mimetype='application/octet-stream')
+
+# Production server
+def make_environ(method, target, version, headers, client_address, server_address,
+                 input_stream, sock=None):
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': server_address[0],
+        'SERVER_PORT': str(server_address[1]),
+        'SERVER_PROTOCOL': version,
+        'REMOTE_ADDR': client_address[0],
+        'REMOTE_PORT': str(client_address[1]),
+        'CONTENT_TYPE': '',
+        'CONTENT_LENGTH': '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': input_stream,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    if sock is not None:
+        # Same key as Werkzeug's server, so FileBody can use sendfile here too
+        environ['werkzeug.socket'] = sock
+    for name, value in headers:
+        key = name.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = environ[key] + ',' + value if environ.get(key) else value
+    return environ
+
+class WSGIRequestHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 WSGI handler with keep-alive; one instance serves every
+    # request on a connection until the client closes or goes idle
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FileTransferApp'
+    event_stream = None
+
+    def run_wsgi(self):
+        self.connection.settimeout(self.server.timeout)
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            self.send_error(411, 'Chunked request bodies are not supported')
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, 'Invalid Content-Length')
+            return
+        self.input_stream = LimitedStream(self.rfile, content_length)
+        self.status = None
+        self.response_headers = None
+        self.headers_sent = False
+        self.chunked = False
+        self.send_body = True
+
+        try:
+            result = self.server.app(self.make_environ(), self.start_response)
+            if self.is_event_stream():
+                # Left open for as long as the page is; TransferServer serves it
+                # from its own thread once this worker is free
+                self.event_stream = result
+                self.close_connection = True
+                return
+            try:
+                for data in result:
+                    self.write(data)
+                if not self.headers_sent:
+                    self.write(b'')
+                if self.chunked:
+                    self.wfile.write(b'0\r\n\r\n')
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except (ConnectionError, TimeoutError):
+            self.close_connection = True
+            return
+        except Exception as e:
+            log_message(f"Server error: {str(e)}")
+            if self.headers_sent:
+                self.close_connection = True
+            else:
+                self.send_error(500)
+            return
+
+        # Unread request body would be parsed as the next request line
+        if not self.input_stream.is_exhausted:
+            self.input_stream.read(MAX_DRAIN_SIZE)
+            if not self.input_stream.is_exhausted:
+                self.close_connection = True
+        self.connection.settimeout(self.server.keepalive_timeout)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = run_wsgi
+
+    def is_event_stream(self):
+        return any(name.lower() == 'content-type' and value.startswith('text/event-stream')
+                   for name, value in self.response_headers or ())
+
+    def send_event_stream(self):
+        try:
+            for data in self.event_stream:
+                self.write(data)
+            if self.chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (ConnectionError, TimeoutError, ValueError, OSError):
+            pass
+        finally:
+            self.event_stream.close()
+            self.event_stream = None
+            self.finish()
+
+    def finish(self):
+        # A detached event stream is finished by the thread that serves it
+        if self.event_stream is None:
+            super().finish()
+
+    def make_environ(self):
+        return make_environ(self.command, self.path, self.request_version, self.headers.items(),
+                            self.client_address, self.server.server_address, self.input_stream,
+                            self.connection)
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headers_sent:
+                    raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                exc_info = None
+        self.status = status
+        self.response_headers = headers
+        return self.write
+
+    def write(self, data):
+        if not self.headers_sent:
+            self.send_status_and_headers()
+        if data and self.send_body:
+            if self.chunked:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+    def send_status_and_headers(self):
+        code, _, message = self.status.partition(' ')
+        code = int(code)
+        self.send_response(code, message)
+        header_names = set()
+        for name, value in self.response_headers:
+            self.send_header(name, value)
+            header_names.add(name.lower())
+        if self.command == 'HEAD' or code < 200 or code in (204, 304):
+            self.send_body = False
+        elif 'content-length' not in header_names:
+            if self.request_version == 'HTTP/1.1':
+                self.chunked = True
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                self.close_connection = True
+        if 'connection' not in header_names:
+            self.send_header('Connection', 'close' if self.close_connection else 'keep-alive')
+        self.end_headers()
+        self.headers_sent = True
+
+    def log_message(self, format, *args):
+        pass
+
+class TransferServer:
+    # Bounded worker pool: a connection is only accepted when a worker is free,
+    # the rest wait in the kernel listen backlog
+    def __init__(self, wsgi_app, host, port, workers=MAX_WORKERS, backlog=LISTEN_BACKLOG,
+                 timeout=CONNECTION_TIMEOUT, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        self.app = wsgi_app
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.socket = socket.create_server((host, port), backlog=backlog)
+        self.server_address = self.socket.getsockname()
+        self.slots = threading.BoundedSemaphore(workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='transfer-worker')
+        self.streams = set()
+        self.streams_lock = threading.Lock()
+        self.running = False
+
+    def serve_forever(self):
+        self.running = True
+        self.socket.settimeout(0.5)
+        while self.running:
+            if not self.slots.acquire(timeout=0.5):
+                continue
+            try:
+                conn, address = self.socket.accept()
+            except OSError:
+                self.slots.release()
+                continue
+            conn.settimeout(self.timeout)
+            # Headers and body go out in separate writes; without this a keep-alive
+            # response can sit behind the client's delayed ACK (~40 ms)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.executor.submit(self.handle_connection, conn, address)
+
+    def handle_connection(self, conn, address):
+        metrics.open_connections.inc()
+        handler = None
+        try:
+            handler = WSGIRequestHandler(conn, address, self)
+        except Exception:
+            pass
+        finally:
+            try:
+                if handler is not None and handler.event_stream is not None:
+                    # /events mostly waits for share folder changes: a plain thread
+                    # per stream, so open tabs cannot use up the worker slots
+                    with self.streams_lock:
+                        self.streams.add(conn)
+                    threading.Thread(target=self.serve_event_stream, args=(handler, conn),
+                                     name='event-stream', daemon=True).start()
+                else:
+                    self.close_connection(conn)
+            finally:
+                self.slots.release()
+
+    def serve_event_stream(self, handler, conn):
+        try:
+            handler.send_event_stream()
+        finally:
+            with self.streams_lock:
+                self.streams.discard(conn)
+            self.close_connection(conn)
+
+    def close_connection(self, conn):
+        metrics.open_connections.dec()
+        conn.close()
+
+    def shutdown(self):
+        self.running = False
+        self.socket.close()
+        self.executor.shutdown(wait=False)
+        with self.streams_lock:
+            streams = list(self.streams)
+        for conn in streams:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class AsyncTransferServer:
+    # Event-loop engine: an idle or slow connection costs a coroutine instead of
+    # a thread. The Flask app and disk writes run on a small executor; uploads
+    # to /upload and resumable chunks are written as they arrive and FileBody
+    # downloads go out with loop.sendfile.
+    def __init__(self, wsgi_app, host, port, workers=ASYNC_IO_WORKERS, backlog=LISTEN_BACKLOG,
+                 timeout=CONNECTION_TIMEOUT, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        self.app = wsgi_app
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='transfer-io')
+        self.loop = asyncio.new_event_loop()
+        self.handlers = set()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle_client, host, port, backlog=backlog))
+        self.server_address = self.server.sockets[0].getsockname()
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def shutdown(self):
+        async def stop():
+            self.server.close()
+            try:
+                # Only the connection handlers are cancelled; they get a bounded
+                # time to run their cleanup (writer.close(), part files). They are
+                # cancelled again each round, as wait_for can swallow a cancellation
+                # that races with the operation it waits for finishing.
+                deadline = self.loop.time() + SHUTDOWN_TIMEOUT
+                pending = set(self.handlers)
+                while pending and self.loop.time() < deadline:
+                    for task in pending:
+                        task.cancel()
+                    _, pending = await asyncio.wait(pending, timeout=0.1)
+                await asyncio.sleep(0)
+            finally:
+                self.executor.shutdown(wait=False)
+                self.loop.stop()
+        asyncio.run_coroutine_threadsafe(stop(), self.loop)
+
+    async def run_blocking(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def run_profiled(self, profile, func, *args):
+        # run_blocking with the request's profile active on the executor thread
+        def call():
+            profiler.local.profile = profile
+            try:
+                return func(*args)
+            finally:
+                profiler.local.profile = None
+        return await self.run_blocking(call)
+
+    async def handle_client(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        timeout = self.timeout
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        metrics.open_connections.inc()
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), timeout)
+                if not request_line.strip():
+                    break
+                if not await self.handle_request(request_line, reader, writer, client_address):
+                    break
+                timeout = self.keepalive_timeout
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # shutdown() ends every connection this way; the handler itself is done
+            pass
+        except Exception as e:
+            log_message(f"Server error: {str(e)}")
+        finally:
+            self.handlers.discard(handler)
+            metrics.open_connections.dec()
+            writer.close()
+
+    async def handle_request(self, request_line, reader, writer, client_address):
+        method, target, version = request_line.decode('latin-1').split()
+        headers = Headers()
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.add(name.strip(), value.strip())
+
+        connection = headers.get('Connection', '').lower()
+        keep_alive = 'close' not in connection if version == 'HTTP/1.1' else 'keep-alive' in connection
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            await self.send_json(writer, version, 411, {'error': 'Chunked request bodies are not supported'}, False)
+            return False
+        content_length = int(headers.get('Content-Length') or 0)
+        if headers.get('Expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        if method == 'GET' and target.partition('?')[0] == '/events':
+            await self.stream_events(writer, version)
+            return False
+
+        mimetype, options = parse_options_header(headers.get('Content-Type', ''))
+        path, _, query = target.partition('?')
+        if method == 'POST' and path == '/upload' and STREAMING_UPLOADS and mimetype == 'multipart/form-data':
+            ticket_id = headers.get('X-Queue-Ticket') or parse_qs(query).get('ticket', [None])[0]
+            return await self.receive_upload(reader, writer, version, options.get('boundary'),
+                                             headers.get('Content-Encoding', ''), content_length, keep_alive,
+                                             client_address, ticket_id)
+        if method == 'PUT' and path.startswith('/upload/session/') and '/' not in path[len('/upload/session/'):]:
+            return await self.receive_chunk(reader, writer, version, path[len('/upload/session/'):], query,
+                                            headers, keep_alive, client_address)
+
+        body = await self.read_body(reader, content_length, client_address[0])
+        environ = make_environ(method, target, version, headers.items(), client_address,
+                               self.server_address, body)
+        environ['filetransfer.shaped'] = True
+        return await self.run_app(environ, writer, version, keep_alive)
+
+    async def read_body(self, reader, content_length, client):
+        # Small bodies stay in memory; larger ones are spooled to disk off the loop.
+        # Either way the upload shaper paces them here, while they arrive.
+        if content_length <= UPLOAD_BUFFER_SIZE:
+            data = await asyncio.wait_for(reader.readexactly(content_length), self.timeout)
+            await self.shape_upload(client, len(data))
+            return io.BytesIO(data)
+        body = await self.run_blocking(tempfile.TemporaryFile)
+        remaining = content_length
+        step = SHAPING_QUANTUM if upload_shaper.active else UPLOAD_BUFFER_SIZE
+        while remaining > 0:
+            data = await asyncio.wait_for(reader.read(min(step, remaining)), self.timeout)
+            if not data:
+                body.close()
+                raise ConnectionError('Client disconnected')
+            remaining -= len(data)
+            await self.run_blocking(body.write, data)
+            await self.shape_upload(client, len(data))
+        await self.run_blocking(body.seek, 0)
+        return body
+
+    async def shape_upload(self, client, count):
+        delay = upload_shaper.reserve(client, count)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def receive_upload(self, reader, writer, version, boundary, encoding, content_length, keep_alive,
+                             client_address, ticket_id=None):
+        # Counted under the same endpoint as the WSGI /upload route
+        started = time.perf_counter()
+        metrics.active_transfers.inc('upload')
+        status, remaining = 500, content_length
+        transfer = transfers.start('upload', client_address[0], '', content_length)
+        transfer.sources.append(lambda: content_length - remaining)
+        profile = profiler.start('upload') if profiler.enabled else None
+        slot = None
+        try:
+            if upload_queue.active:
+                slot, ticket = upload_queue.admit(client_address[0], content_length, ticket_id)
+                if slot is None:
+                    # Answered before any of the body is read; the connection can't be reused
+                    status = 503
+                    body, extra_headers = queue_busy(ticket)
+                    await self.send_json(writer, version, status, body, False, extra_headers)
+                    return False
+            shortage = await self.run_blocking(check_free_space, content_length)
+            if shortage is not None:
+                log_message(f"Upload error: {shortage['error']}")
+                status = 507
+                await self.send_json(writer, version, status, shortage, False)
+                return False
+            if not boundary:
+                status = 400
+                await self.send_json(writer, version, status, {'error': 'Missing multipart boundary'}, False)
+                return False
+            try:
+                decoder = StreamDecoder(encoding)
+            except ValueError as e:
+                status = 415
+                await self.send_json(writer, version, status, {'error': str(e)}, False)
+                return False
+            upload = MultipartUpload(boundary.encode(), transfer, content_length)
+
+            def feed(data):
+                with profile_phase('decompress'):
+                    for piece in decoder.decode(data):
+                        upload.feed(piece)
+
+            step = SHAPING_QUANTUM if upload_shaper.active else UPLOAD_BUFFER_SIZE
+            try:
+                while remaining > 0:
+                    with phase_of(profile, 'socket_read'):
+                        data = await asyncio.wait_for(reader.read(min(step, remaining)), self.timeout)
+                    if not data:
+                        raise ConnectionError('Client disconnected')
+                    remaining -= len(data)
+                    await self.run_profiled(profile, feed, data)
+                    await self.shape_upload(client_address[0], len(data))
+                await self.run_blocking(upload.feed, decoder.flush())
+                await self.run_blocking(upload.feed, None)
+            except ValueError as e:
+                await self.run_blocking(upload.abort)
+                log_message(f"Upload error: {str(e)}")
+                status = 400
+                await self.send_json(writer, version, status, {'error': 'Malformed upload'}, False)
+                return False
+            except OSError as e:
+                await self.run_blocking(upload.abort)
+                log_message(f"Upload error: {str(e)}")
+                if not is_disk_full(e):
+                    raise
+                status = 507
+                await self.send_json(writer, version, status, {'error': 'The computer ran out of disk space'}, False)
+                return False
+            except BaseException as e:
+                await self.run_blocking(upload.abort)
+                log_message(f"Upload error: {str(e)}")
+                raise
+            status, body = upload.result()
+            await self.send_json(writer, version, status, body, keep_alive)
+            return keep_alive
+        finally:
+            if slot is not None:
+                upload_queue.release(slot)
+            transfers.finish(transfer)
+            if profile is not None:
+                profiler.finish(profile)
+            metrics.record('upload', status, started, content_length - remaining, 0, 'upload')
+
+    async def receive_chunk(self, reader, writer, version, session_id, query, headers, keep_alive,
+                            client_address):
+        # PUT /upload/session/<id> read off the socket like receive_upload: the queue
+        # and space checks answer before the body, which goes to the part file once.
+        # Counted under the same endpoint as the WSGI route.
+        started = time.perf_counter()
+        metrics.active_transfers.inc('upload')
+        content_length = int(headers['Content-Length']) if headers.get('Content-Length') else None
+        status, remaining = 500, content_length or 0
+        transfer = transfers.start('upload', client_address[0], '', content_length)
+        transfer.sources.append(lambda: (content_length or 0) - remaining)
+        profile = profiler.start('upload_chunk') if profiler.enabled else None
+        slot = None
+        try:
+            session = await self.run_blocking(get_upload_session, session_id)
+            if session is None:
+                status = 404
+                await self.send_json(writer, version, status, {'error': 'Upload session not found'}, False)
+                return False
+            params = parse_qs(query)
+            if upload_queue.active:
+                ticket_id = headers.get('X-Queue-Ticket') or params.get('ticket', [None])[0]
+                slot, ticket = upload_queue.admit(client_address[0], remaining_upload(session_id), ticket_id,
+                                                  session_id)
+                if slot is None:
+                    status = 503
+                    body, extra_headers = queue_busy(ticket)
+                    await self.send_json(writer, version, status, body, False, extra_headers)
+                    return False
+            try:
+                offset = int(params['offset'][0])
+            except (KeyError, ValueError):
+                offset = None
+            chunk, error = await self.run_profiled(profile, start_chunk, session, offset, content_length,
+                                                   headers.get('Content-Encoding', ''))
+            if chunk is None:
+                status = error[1]
+                await self.send_json(writer, version, status, error[0], False)
+                return False
+            transfer.name, transfer.total = session.filename, session.size
+            transfer.group, transfer.base = session.id, session.received
+            complete = False
+            step = SHAPING_QUANTUM if upload_shaper.active else UPLOAD_BUFFER_SIZE
+            try:
+                while remaining > 0:
+                    with phase_of(profile, 'socket_read'):
+                        data = await asyncio.wait_for(reader.read(min(step, remaining)), self.timeout)
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    if not await self.run_profiled(profile, chunk.feed, data, remaining == 0):
+                        break
+                    await self.shape_upload(client_address[0], len(data))
+                complete = remaining == 0 and not chunk.overflow
+            except Exception as e:
+                chunk.fail(e)
+            finally:
+                body, status = await self.run_profiled(profile, chunk.finish, complete)
+            # Unread body would be parsed as the next request
+            keep_alive = keep_alive and remaining == 0
+            await self.send_json(writer, version, status, body, keep_alive)
+            return keep_alive
+        finally:
+            if slot is not None:
+                upload_queue.release(slot)
+            transfers.finish(transfer)
+            if profile is not None:
+                profiler.finish(profile)
+            metrics.record('upload_chunk', status, started, (content_length or 0) - remaining, 0, 'upload')
+
+    async def run_app(self, environ, writer, version, keep_alive):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return lambda data: None
+
+        result = await self.run_blocking(self.app, environ, start_response)
+        try:
+            code = int(response['status'].split()[0])
+            headers = list(response['headers'])
+            header_names = {name.lower() for name, _ in headers}
+            send_body = environ['REQUEST_METHOD'] != 'HEAD' and code >= 200 and code not in (204, 304)
+            chunked = send_body and 'content-length' not in header_names
+            if chunked and version != 'HTTP/1.1':
+                chunked, keep_alive = False, False
+            if chunked:
+                headers.append(('Transfer-Encoding', 'chunked'))
+            await self.send_head(writer, version, response['status'], headers, keep_alive)
+            if not send_body:
+                return keep_alive
+            if isinstance(result, FileBody):
+                await self.send_file_body(writer, result)
+                return keep_alive
+            iterator = iter(result)
+            while True:
+                data = await self.run_blocking(next, iterator, None)
+                if data is None:
+                    break
+                if data:
+                    writer.write(b'%x\r\n%s\r\n' % (len(data), data) if chunked else data)
+                    await asyncio.wait_for(writer.drain(), self.timeout)
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await asyncio.wait_for(writer.drain(), self.timeout)
+            return keep_alive
+        finally:
+            if hasattr(result, 'close'):
+                await self.run_blocking(result.close)
+
+    async def stream_events(self, writer, version):
+        # Native SSE stream: waiting for the next change costs no executor thread
+        start_share_watcher()
+        events = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+
+        def deliver(event):
+            if events.full():
+                raise queue.Full
+            self.loop.call_soon_threadsafe(events.put_nowait, event)
+
+        share_events.subscribe(deliver)
+        try:
+            headers = [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache')]
+            await self.send_head(writer, version, '200 OK', headers, False)
+            writer.write(b'retry: 3000\n' + format_sse('hello', {'version': share_index.etag}))
+            while True:
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                try:
+                    event = await asyncio.wait_for(events.get(), EVENT_KEEPALIVE_INTERVAL)
+                    writer.write(format_sse('change', event))
+                except asyncio.TimeoutError:
+                    if not share_events.is_subscribed(deliver):
+                        writer.write(format_sse('reset', {}))
+                        await asyncio.wait_for(writer.drain(), self.timeout)
+                        return
+                    writer.write(b': keepalive\n\n')
+        finally:
+            share_events.unsubscribe(deliver)
+
+    async def send_file_body(self, writer, body):
+        f = await self.run_blocking(open, body.filepath, 'rb')
+        try:
+            for piece in body.pieces:
+                if isinstance(piece, bytes):
+                    writer.write(piece)
+                    body.sent += len(piece)
+                    continue
+                with phase_of(body.profile, 'socket_write'):
+                    await asyncio.wait_for(writer.drain(), self.timeout)
+                start, end = piece
+                # In steps, so the transfer dashboard sees progress and shaping can pace them
+                offset = start
+                while offset < end:
+                    count = min(body.step, end - offset)
+                    with phase_of(body.profile, 'sendfile'):
+                        await self.loop.sendfile(writer.transport, f, offset, count)
+                    offset += count
+                    body.sent += count
+                    if body.client is not None:
+                        delay = download_shaper.reserve(body.client, count)
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+            with phase_of(body.profile, 'socket_write'):
+                await asyncio.wait_for(writer.drain(), self.timeout)
+        finally:
+            await self.run_blocking(f.close)
+
+    async def send_head(self, writer, version, status, headers, keep_alive):
+        lines = [f'{version} {status}', f'Date: {http_date()}', 'Server: FileTransferApp']
+        lines += [f'{name}: {value}' for name, value in headers]
+        if not any(name.lower() == 'connection' for name, _ in headers):
+            lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def send_json(self, writer, version, code, payload, keep_alive, extra_headers=()):
+        body = json.dumps(payload).encode() + b'\n'
+        status = f'{code} {http.server.BaseHTTPRequestHandler.responses[code][0]}'
+        headers = [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))] + list(extra_headers)
+        await self.send_head(writer, version, status, headers, keep_alive)
+        writer.write(body)
+        await asyncio.wait_for(writer.drain(), self.timeout)
+
 # GUI Application
 class FileTransferGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("File Transfer Server")
-        self.root.geometry("600x500")
+        self.root.geometry("760x840")
         
         title = tk.Label(root, text="📱💻 Bidirectional File Transfer", 
                         font=("Arial", 16, "bold"), pady=10)
@@ -575,6 +4891,37 @@ class FileTransferGUI:
                                       font=("Arial", 10, "bold"), fg="red")
         self.network_label.grid(row=1, column=1, sticky=tk.W, padx=10)
         
+        tk.Label(status_frame, text="Max transfers:", font=("Arial", 10)).grid(row=2, column=0, sticky=tk.W)
+        self.workers_var = tk.StringVar(value=str(MAX_WORKERS))
+        tk.Spinbox(status_frame, from_=1, to=256, width=5, textvariable=self.workers_var,
+                   font=("Arial", 10)).grid(row=2, column=1, sticky=tk.W, padx=10)
+        
+        tk.Label(status_frame, text="Profiling:", font=("Arial", 10)).grid(row=3, column=0, sticky=tk.W)
+        profile_frame = tk.Frame(status_frame)
+        profile_frame.grid(row=3, column=1, sticky=tk.W, padx=10)
+        self.profile_var = tk.BooleanVar(value=profiler.enabled)
+        tk.Checkbutton(profile_frame, text="Time request phases", variable=self.profile_var,
+                       command=self.toggle_profiling, font=("Arial", 10)).pack(side=tk.LEFT)
+        tk.Button(profile_frame, text="📊 Dump Profile", command=self.dump_profile,
+                  font=("Arial", 9)).pack(side=tk.LEFT, padx=5)
+        
+        # MB/s, 0 for no limit; changes apply to transfers already running
+        self.limit_vars = {}
+        for row, (label, shaper) in enumerate((("Upload limit:", upload_shaper),
+                                               ("Download limit:", download_shaper)), start=4):
+            tk.Label(status_frame, text=label, font=("Arial", 10)).grid(row=row, column=0, sticky=tk.W)
+            limit_frame = tk.Frame(status_frame)
+            limit_frame.grid(row=row, column=1, sticky=tk.W, padx=10)
+            for text, rate in (("MB/s total", shaper.rate), ("MB/s per device", shaper.client_rate)):
+                var = tk.StringVar(value=f"{rate / 1024 ** 2:g}")
+                spinbox = tk.Spinbox(limit_frame, from_=0, to=10000, increment=0.5, width=6, textvariable=var,
+                                     command=self.apply_limits, font=("Arial", 10))
+                spinbox.bind("<Return>", lambda event: self.apply_limits())
+                spinbox.bind("<FocusOut>", lambda event: self.apply_limits())
+                spinbox.pack(side=tk.LEFT)
+                tk.Label(limit_frame, text=text, font=("Arial", 9)).pack(side=tk.LEFT, padx=(2, 8))
+                self.limit_vars.setdefault(shaper, []).append(var)
+        
         info_frame = tk.LabelFrame(root, text="Folder Locations", 
                                   font=("Arial", 10, "bold"), padx=10, pady=10)
         info_frame.pack(pady=10, padx=20, fill=tk.BOTH)
@@ -585,6 +4932,27 @@ class FileTransferGUI:
         tk.Label(info_frame, text="📤 Shared files:", font=("Arial", 9)).grid(row=1, column=0, sticky=tk.W)
         tk.Label(info_frame, text=UPLOAD_FOLDER, font=("Arial", 9), fg="blue").grid(row=1, column=1, sticky=tk.W, padx=5)
         
+        transfer_frame = tk.LabelFrame(root, text="Active Transfers", 
+                                      font=("Arial", 10, "bold"), padx=10, pady=10)
+        transfer_frame.pack(pady=10, padx=20, fill=tk.BOTH)
+        
+        columns = ("client", "file", "progress", "speed", "average", "eta")
+        headings = ("Client", "File", "Done / Total", "Speed", "Average", "ETA")
+        self.transfer_table = ttk.Treeview(transfer_frame, columns=columns, show="headings", height=5)
+        for column, heading in zip(columns, headings):
+            self.transfer_table.heading(column, text=heading)
+            self.transfer_table.column(column, width=200 if column == "file" else 90,
+                                       anchor=tk.W if column == "file" else tk.CENTER)
+        self.transfer_table.pack(fill=tk.X)
+        
+        bandwidth_frame = tk.Frame(transfer_frame)
+        bandwidth_frame.pack(fill=tk.X, pady=(8, 0))
+        self.bandwidth_label = tk.Label(bandwidth_frame, text="0 B/s", font=("Arial", 9), width=12, anchor=tk.W)
+        self.bandwidth_label.pack(side=tk.LEFT)
+        self.sparkline = tk.Canvas(bandwidth_frame, height=36, bg="white", highlightthickness=1,
+                                   highlightbackground="#ccc")
+        self.sparkline.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        
         log_frame = tk.LabelFrame(root, text="Activity Log", 
                                  font=("Arial", 10, "bold"), padx=10, pady=10)
         log_frame.pack(pady=10, padx=20, fill=tk.BOTH, expand=True)
@@ -597,6 +4965,86 @@ class FileTransferGUI:
         log_message("Application started")
         log_message(f"Received files folder: {DOWNLOAD_FOLDER}")
         log_message(f"Shared files folder: {UPLOAD_FOLDER}")
+        self.drain_log()
+        self.refresh_transfers()
+    
+    def drain_log(self):
+        # One insert per tick however busy the server is; the widget keeps
+        # the last LOG_HISTORY_LINES lines like a ring buffer
+        lines = drain_log_queue()
+        if lines:
+            log_widget.insert(tk.END, ''.join(lines))
+            excess = int(log_widget.index('end-1c').split('.')[0]) - LOG_HISTORY_LINES
+            if excess > 0:
+                log_widget.delete('1.0', f'{excess + 1}.0')
+            log_widget.see(tk.END)
+        self.root.after(LOG_DRAIN_INTERVAL, self.drain_log)
+    
+    def refresh_transfers(self):
+        # Polls the transfer registry on the Tk loop; request threads never touch the widgets
+        rows, history = transfers.sample()
+        self.transfer_table.delete(*self.transfer_table.get_children())
+        for row in rows:
+            arrow = "⬆" if row['direction'] == 'upload' else "⬇"
+            total = format_size(row['total']) if row['total'] is not None else "?"
+            eta = "—"
+            if row['eta'] is not None:
+                minutes, seconds = divmod(int(row['eta']), 60)
+                eta = f"{minutes}:{seconds:02d}"
+            self.transfer_table.insert("", tk.END, values=(
+                row['client'], f"{arrow} {row['name'] or '—'}", f"{format_size(row['done'])} / {total}",
+                f"{format_size(row['rate'])}/s", f"{format_size(row['average'])}/s", eta))
+        
+        queued = upload_queue.queued() + download_queue.queued()
+        self.bandwidth_label.config(text=f"{format_size(history[-1])}/s" + (f" · {queued} queued" if queued else ""))
+        self.sparkline.delete("all")
+        width, height = self.sparkline.winfo_width(), self.sparkline.winfo_height()
+        peak = max(history) or 1
+        step = (width - 4) / max(len(history) - 1, 1)
+        points = []
+        for i, rate in enumerate(history):
+            points += [2 + i * step, height - 3 - (height - 6) * rate / peak]
+        self.sparkline.create_line(*points, fill="#2196F3", width=2)
+        self.root.after(DASHBOARD_INTERVAL, self.refresh_transfers)
+    
+    def apply_limits(self):
+        for shaper, (total_var, client_var) in self.limit_vars.items():
+            try:
+                rate, client_rate = (max(0.0, float(var.get())) * 1024 ** 2 for var in (total_var, client_var))
+            except ValueError:
+                continue
+            if (rate, client_rate) != (shaper.rate, shaper.client_rate):
+                shaper.configure(rate, client_rate)
+                name = "Upload" if shaper is upload_shaper else "Download"
+                describe = lambda value: f"{value / 1024 ** 2:g} MB/s" if value else "unlimited"
+                log_message(f"{name} limit: {describe(rate)} total, {describe(client_rate)} per device")
+    
+    def toggle_profiling(self):
+        profiler.enabled = self.profile_var.get()
+        log_message("Profiling " + ("on" if profiler.enabled else "off"))
+    
+    def dump_profile(self):
+        report = profiler.report()
+        if not report['endpoints']:
+            log_message("Profile: no requests recorded yet" + ("" if profiler.enabled else " (profiling is off)"))
+            return
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(CACHE_FOLDER, f"profile-{stamp}.json")
+        try:
+            os.makedirs(CACHE_FOLDER, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            data = profiler.pstats_dump()
+            if data is not None:
+                with open(os.path.join(CACHE_FOLDER, f"profile-{stamp}.pstats"), 'wb') as f:
+                    f.write(data)
+        except OSError as e:
+            log_message(f"Profile error: {str(e)}")
+            return
+        for endpoint, entry in report['endpoints'].items():
+            phases = ', '.join(f"{name} {phase['share']:.0%}" for name, phase in list(entry['phases'].items())[:4])
+            log_message(f"Profile {endpoint}: {entry['requests']} requests, {entry['mean_ms']:.1f} ms mean ({phases})")
+        log_message(f"Profile written to {path}")
     
     def select_files_to_share(self):
         files = filedialog.askopenfilenames(title="Select files to share with phone")
@@ -607,54 +5055,105 @@ class FileTransferGUI:
                     filename = os.path.basename(filepath)
                     dest_path = os.path.join(UPLOAD_FOLDER, filename)
                     
-                    shutil.copy2(filepath, dest_path)
+                    copy_with_checksum(filepath, dest_path)
+                    share_index.invalidate()
                     log_message(f"Added to share: {filename}")
                     count += 1
                 except Exception as e:
                     log_message(f"Error adding {filename}: {str(e)}")
             
+            # Rescan now so connected phones get the change event right away
+            share_index.refresh()
             if count > 0:
                 messagebox.showinfo("Success", f"Added {count} file(s) to share folder")
     
     def start_server(self):
-        global server_running, server_thread
+        global server_running, server_thread, http_server
         
-        def run_server():
-            app.run(host='0.0.0.0', port=8080, debug=False, use_reloader=False)
+        if SERVER_MODE in ('production', 'asyncio'):
+            try:
+                if SERVER_MODE == 'asyncio':
+                    http_server = AsyncTransferServer(app, '0.0.0.0', SERVER_PORT)
+                else:
+                    http_server = TransferServer(app, '0.0.0.0', SERVER_PORT, workers=int(self.workers_var.get()))
+            except (OSError, ValueError) as e:
+                messagebox.showerror("Error", f"Could not start server: {str(e)}")
+                return
+            run_server = http_server.serve_forever
+        else:
+            def run_server():
+                app.run(host='0.0.0.0', port=SERVER_PORT, debug=False, use_reloader=False)
         
         server_thread = threading.Thread(target=run_server, daemon=True)
         server_thread.start()
         server_running = True
+        start_housekeeping()
         
         local_ip = get_local_ip()
-        self.local_label.config(text=f"http://localhost:8080", fg="green")
+        self.local_label.config(text=f"http://localhost:{SERVER_PORT}", fg="green")
+        self.network_label.config(text=f"http://{local_ip}:{SERVER_PORT}", fg="green")
+        self.start_button.config(state=tk.DISABLED)
+        self.stop_button.config(state=tk.NORMAL)
         log_message("Server started successfully")
-        log_message(f"Local URL: http://localhost:8080")
-        log_message(f"Network URL: http://{local_ip}:8080")
+        log_message(f"Local URL: http://localhost:{SERVER_PORT}")
+        log_message(f"Network URL: http://{local_ip}:{SERVER_PORT}")
         log_message("Phone → Computer: Upload files from phone")
         log_message("Computer → Phone: Add files to share and download from phone")
         log_message("⚠️ WARNING: The server is accessible to anyone on your network. There is NO authentication or HTTPS. Do not use on untrusted networks!")
         print("WARNING: Flask server is running on 0.0.0.0 without authentication or HTTPS. Accessible to anyone on your network.")
-        log_message("Server started successfully")
-        log_message(f"Local URL: http://localhost:8080")
-        log_message(f"Network URL: http://{local_ip}:8080")
-        log_message("Phone → Computer: Upload files from phone")
-        log_message("Computer → Phone: Add files to share and download from phone")
+        if SERVER_MODE == 'asyncio':
+            log_message("Serving with the asyncio engine")
+        elif http_server is not None:
+            log_message(f"Serving up to {self.workers_var.get()} concurrent transfers")
     
     def stop_server(self):
-        global server_running
+        global server_running, http_server
         server_running = False
         
         self.local_label.config(text="Not running", fg="red")
         self.network_label.config(text="Not running", fg="red")
         
-        self.start_button.config(state=tk.NORMAL)
         self.stop_button.config(state=tk.DISABLED)
         
-        log_message("Server stopped")
-        messagebox.showinfo("Info", "Please restart the application to start the server again")
+        if http_server is not None:
+            http_server.shutdown()
+            http_server = None
+            self.start_button.config(state=tk.NORMAL)
+            log_message("Server stopped")
+        else:
+            log_message("Server stopped")
+            messagebox.showinfo("Info", "Please restart the application to start the server again")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File Transfer Server")
+    parser.add_argument('--engine', choices=['production', 'asyncio', 'development'], default=SERVER_MODE,
+                        help="server engine used when the server is started")
+    parser.add_argument('--log-file', default=LOG_FILE,
+                        help="also write the activity log to this file, rotated at 5 MB")
+    for direction, total, client in (('upload', UPLOAD_LIMIT, CLIENT_UPLOAD_LIMIT),
+                                     ('download', DOWNLOAD_LIMIT, CLIENT_DOWNLOAD_LIMIT)):
+        parser.add_argument(f'--{direction}-limit', type=float, default=total / 1024 ** 2, metavar='MB/S',
+                            help=f"{direction} bandwidth for all devices together, 0 for no limit")
+        parser.add_argument(f'--client-{direction}-limit', type=float, default=client / 1024 ** 2, metavar='MB/S',
+                            help=f"{direction} bandwidth per device, 0 for no limit")
+    parser.add_argument('--max-uploads', type=int, default=MAX_ACTIVE_UPLOADS, metavar='N',
+                        help="uploads running at once, the rest wait in line; 0 for no limit")
+    parser.add_argument('--max-downloads', type=int, default=MAX_ACTIVE_DOWNLOADS, metavar='N',
+                        help="downloads running at once, the rest wait in line; 0 for no limit")
+    parser.add_argument('--profile', action='store_true', default=PROFILING,
+                        help="time the phases of each upload and download request (see /profile)")
+    parser.add_argument('--profile-sample', type=float, default=PROFILE_SAMPLE_RATE, metavar='RATE',
+                        help="share of profiled requests also run under cProfile, e.g. 0.05")
+    args = parser.parse_args()
+    SERVER_MODE = args.engine
+    profiler.enabled = args.profile or args.profile_sample > 0
+    profiler.sample_rate = args.profile_sample
+    upload_shaper.configure(args.upload_limit * 1024 ** 2, args.client_upload_limit * 1024 ** 2)
+    download_shaper.configure(args.download_limit * 1024 ** 2, args.client_download_limit * 1024 ** 2)
+    upload_queue.configure(max(0, args.max_uploads))
+    download_queue.configure(max(0, args.max_downloads))
+    if args.log_file:
+        start_log_file(args.log_file)
     root = tk.Tk()
     app_gui = FileTransferGUI(root)
     root.mainloop()
\ No newline at end of file
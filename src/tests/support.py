@@ -0,0 +1,28 @@
+"""Shared test setup: the app is imported once per run, in a scratch directory.
+
+The app creates its folders in the working directory when imported, so every
+test module gets the same module object and the same folders.
+"""
+import atexit
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+fta = None
+
+def load_app():
+    global fta
+    if fta is None:
+        workdir = tempfile.mkdtemp(prefix='ft-test-')
+        os.chdir(workdir)
+        atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+        atexit.register(os.chdir, SRC_DIR)
+        sys.path.insert(0, SRC_DIR)
+        import file_transfer_app
+        fta = file_transfer_app
+        fta.log_message = lambda message: None
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    return fta
@@ -0,0 +1,63 @@
+"""Request body decoding: bounded output pieces and the decoded size limit.
+
+brotli and zstd cases run only where those packages are installed.
+"""
+import importlib.util
+import unittest
+import zlib
+
+import support
+
+fta = None
+
+def setUpModule():
+    global fta
+    fta = support.load_app()
+
+BOMB_SIZE = 64 * 1024 * 1024
+HAVE_BROTLI = importlib.util.find_spec('brotli') is not None
+HAVE_ZSTD = importlib.util.find_spec('zstandard') is not None
+
+class StreamDecoderTests(unittest.TestCase):
+    def compress(self, encoding, data):
+        if encoding == 'gzip':
+            packer = zlib.compressobj(9, zlib.DEFLATED, 31)
+            return packer.compress(data) + packer.flush()
+        if encoding == 'br':
+            return fta.brotli.compress(data)
+        return fta.zstandard.ZstdCompressor(level=19).compress(data)
+
+    def check_bounded(self, encoding):
+        body = self.compress(encoding, bytes(BOMB_SIZE))
+        decoder = fta.StreamDecoder(encoding)
+        total = largest = 0
+        for start in range(0, len(body), 64 * 1024):
+            for piece in decoder.decode(body[start:start + 64 * 1024]):
+                total += len(piece)
+                largest = max(largest, len(piece))
+        total += len(decoder.flush())
+        self.assertEqual(total, BOMB_SIZE)
+        self.assertLessEqual(largest, 8 * fta.UPLOAD_BUFFER_SIZE)
+        # Refused once the decoded size passes the limit
+        decoder = fta.StreamDecoder(encoding, limit=BOMB_SIZE // 2)
+        with self.assertRaises(ValueError):
+            for _ in decoder.decode(body):
+                pass
+
+    def test_gzip(self):
+        self.check_bounded('gzip')
+
+    @unittest.skipUnless(HAVE_BROTLI, 'brotli is not installed')
+    def test_brotli(self):
+        self.check_bounded('br')
+
+    @unittest.skipUnless(HAVE_ZSTD, 'zstandard is not installed')
+    def test_zstd(self):
+        self.check_bounded('zstd')
+
+    def test_identity_is_not_limited(self):
+        decoder = fta.StreamDecoder('', limit=10)
+        self.assertEqual(list(decoder.decode(b'x' * 100)), [b'x' * 100])
+
+if __name__ == '__main__':
+    unittest.main()
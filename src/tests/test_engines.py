@@ -0,0 +1,352 @@
+"""The same HTTP checks against every server engine.
+
+Each engine (Werkzeug's development server, the threaded production server
+and the asyncio server) is started on localhost and driven over real
+sockets, so the asyncio engine's native upload paths are covered along with
+the Flask routes they stand in for.
+
+    python -m unittest discover -s tests
+"""
+import hashlib
+import http.client
+import io
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import unittest
+import zipfile
+import zlib
+
+import support
+
+fta = None
+
+def setUpModule():
+    global fta
+    fta = support.load_app()
+
+def multipart(name, data, boundary='testboundary'):
+    return (f'--{boundary}\r\nContent-Disposition: form-data; name="files"; filename="{name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+
+class EngineTests:
+    # Mixed into one TestCase per engine; start_server returns (server, stop)
+    def setUp(self):
+        self.server, self.stop = self.start_server()
+        self.port = self.server.server_address[1]
+        self.reserve = fta.DISK_SPACE_RESERVE
+
+    def tearDown(self):
+        fta.DISK_SPACE_RESERVE = self.reserve
+        self.stop()
+
+    def request(self, method, path, body=None, headers=None, conn=None):
+        own = conn is None
+        conn = conn or http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            conn.request(method, path, body, headers or {})
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            if own:
+                conn.close()
+        return response, data
+
+    def request_json(self, method, path, payload=None, headers=None):
+        body = json.dumps(payload) if payload is not None else None
+        response, data = self.request(method, path, body, dict(headers or {}, **{'Content-Type': 'application/json'}))
+        return response.status, json.loads(data)
+
+    def test_index(self):
+        response, data = self.request('GET', '/')
+        self.assertEqual(response.status, 200)
+        self.assertIn(b'<html', data.lower())
+
+    def test_multipart_upload(self):
+        data = os.urandom(300 * 1024)
+        response, body = self.request('POST', '/upload', multipart('form.bin', data),
+                                      {'Content-Type': 'multipart/form-data; boundary=testboundary'})
+        self.assertEqual(response.status, 200, body)
+        self.assertEqual(json.loads(body)['checksums']['form.bin'], hashlib.sha256(data).hexdigest())
+        with open(os.path.join(fta.DOWNLOAD_FOLDER, 'form.bin'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_upload_without_space(self):
+        fta.DISK_SPACE_RESERVE = shutil.disk_usage(fta.DOWNLOAD_FOLDER).free
+        response, body = self.request('POST', '/upload', multipart('full.bin', b'x' * 1024),
+                                      {'Content-Type': 'multipart/form-data; boundary=testboundary'})
+        self.assertEqual(response.status, 507, body)
+        self.assertFalse(os.path.exists(os.path.join(fta.DOWNLOAD_FOLDER, 'full.bin')))
+
+    def test_resumable_upload(self):
+        data = os.urandom(700 * 1024)
+        status, session = self.request_json('POST', '/upload/session', {'name': 'chunks.bin', 'size': len(data)})
+        self.assertEqual(status, 201)
+        path = '/upload/session/' + session['id']
+        # Out of order, over one keep-alive connection
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        for start, end in ((400 * 1024, len(data)), (0, 400 * 1024)):
+            response, body = self.request('PUT', f'{path}?offset={start}', data[start:end], conn=conn)
+            self.assertEqual(response.status, 200, body)
+        conn.close()
+        status, info = self.request_json('GET', path)
+        self.assertEqual(info['ranges'], [[0, len(data)]])
+        status, result = self.request_json('POST', path + '/finalize', {'sha256': hashlib.sha256(data).hexdigest()})
+        self.assertEqual(status, 200, result)
+        with open(os.path.join(fta.DOWNLOAD_FOLDER, 'chunks.bin'), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_resumable_upload_checks(self):
+        status, session = self.request_json('POST', '/upload/session', {'name': 'bad.bin', 'size': 1000})
+        path = '/upload/session/' + session['id']
+        response, body = self.request('PUT', path + '?offset=900', b'x' * 200)
+        self.assertEqual(response.status, 416, body)
+        response, body = self.request('PUT', '/upload/session/' + '0' * 32 + '?offset=0', b'x')
+        self.assertEqual(response.status, 404, body)
+        response, body = self.request('PUT', path + '?offset=0', b'x' * 1000)
+        self.assertEqual(response.status, 200, body)
+        status, result = self.request_json('POST', path + '/finalize', {'sha256': '0' * 64})
+        self.assertEqual(status, 422)
+        self.assertEqual(result['ranges'], [])
+
+    def test_resumable_upload_without_space(self):
+        status, session = self.request_json('POST', '/upload/session', {'name': 'later.bin', 'size': 4096})
+        self.assertEqual(status, 201)
+        fta.DISK_SPACE_RESERVE = shutil.disk_usage(fta.DOWNLOAD_FOLDER).free
+        response, body = self.request('PUT', '/upload/session/' + session['id'] + '?offset=0', b'x' * 4096)
+        self.assertEqual(response.status, 507, body)
+        status, result = self.request_json('POST', '/upload/session', {'name': 'big.bin', 'size': 4096})
+        self.assertEqual(status, 507, result)
+
+    def test_precheck(self):
+        data = os.urandom(100 * 1024)
+        path = os.path.join(fta.DOWNLOAD_FOLDER, 'have.bin')
+        with open(path, 'wb') as f:
+            f.write(data)
+        sample, sha256 = fta.sample_digest(path, len(data)), hashlib.sha256(data).hexdigest()
+        copy_path = os.path.join(fta.DOWNLOAD_FOLDER, 'copy.bin')
+        if os.path.exists(copy_path):
+            os.remove(copy_path)
+
+        def precheck(*files):
+            status, result = self.request_json('POST', '/upload/precheck', {'files': [
+                dict(zip(('name', 'size', 'sample', 'sha256'), item)) for item in files]})
+            self.assertEqual(status, 200, result)
+            return [entry['status'] for entry in result['files']]
+        # A matching sample alone is never trusted
+        self.assertEqual(precheck(('have.bin', len(data), sample), ('copy.bin', len(data), sample)), ['maybe', 'maybe'])
+        self.assertFalse(os.path.exists(copy_path))
+        self.assertEqual(precheck(('have.bin', len(data), sample, sha256), ('copy.bin', len(data), sample, sha256),
+                                  ('other.bin', len(data), sample, '0' * 64), ('new.bin', len(data), '0' * 64)),
+                         ['present', 'linked', 'missing', 'missing'])
+        with open(copy_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_duplicate_upload(self):
+        data = os.urandom(200 * 1024)
+        for name in ('dup1.bin', 'dup2.bin'):
+            response, body = self.request('POST', '/upload', multipart(name, data),
+                                          {'Content-Type': 'multipart/form-data; boundary=testboundary'})
+            self.assertEqual(response.status, 200, body)
+        first, second = (os.path.join(fta.DOWNLOAD_FOLDER, name) for name in ('dup1.bin', 'dup2.bin'))
+        # Reflinked or stored plainly, never sharing an inode: editing one copy leaves the other alone
+        self.assertNotEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        with open(first, 'r+b') as f:
+            f.write(b'edited')
+        with open(second, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_compression_bomb(self):
+        packer = zlib.compressobj(9, zlib.DEFLATED, 31)
+        bomb = packer.compress(bytes(64 * 1024 * 1024)) + packer.flush()
+        status, session = self.request_json('POST', '/upload/session', {'name': 'bomb.bin', 'size': 4096})
+        response, body = self.request('PUT', '/upload/session/' + session['id'] + '?offset=0', bomb,
+                                      {'Content-Encoding': 'gzip'})
+        self.assertEqual(response.status, 416, body)
+        limit, fta.MAX_CONTENT_LENGTH = fta.MAX_CONTENT_LENGTH, 1024 * 1024
+        try:
+            response, body = self.request('POST', '/upload', multipart('bomb.bin', bytes(4 * 1024 * 1024)),
+                                          {'Content-Type': 'multipart/form-data; boundary=testboundary'})
+            self.assertEqual(response.status, 200, body)
+            packer = zlib.compressobj(9, zlib.DEFLATED, 31)
+            data = multipart('bomb.bin', bytes(4 * 1024 * 1024))
+            response, body = self.request('POST', '/upload', packer.compress(data) + packer.flush(),
+                                          {'Content-Type': 'multipart/form-data; boundary=testboundary',
+                                           'Content-Encoding': 'gzip'})
+        finally:
+            fta.MAX_CONTENT_LENGTH = limit
+        self.assertEqual(response.status, 400, body)
+
+    def test_chunk_refused_before_body(self):
+        status, session = self.request_json('POST', '/upload/session', {'name': 'early.bin', 'size': 4096})
+        fta.DISK_SPACE_RESERVE = shutil.disk_usage(fta.DOWNLOAD_FOLDER).free
+        with socket.create_connection(('127.0.0.1', self.port), timeout=5) as sock:
+            sock.sendall(f'PUT /upload/session/{session["id"]}?offset=0 HTTP/1.1\r\nHost: test\r\n'
+                         f'Content-Length: 4096\r\n\r\n'.encode())
+            self.assertTrue(sock.recv(4096).startswith(b'HTTP/1.1 507'))
+
+    def test_download(self):
+        data = os.urandom(200 * 1024)
+        with open(os.path.join(fta.UPLOAD_FOLDER, 'shared.bin'), 'wb') as f:
+            f.write(data)
+        fta.share_index.refresh()
+        status, listing = self.request_json('GET', '/list_files')
+        self.assertIn('shared.bin', [entry['name'] for entry in listing['files']])
+        response, body = self.request('GET', '/download/shared.bin')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, data)
+        response, body = self.request('GET', '/download/shared.bin', headers={'Range': 'bytes=100-199'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, data[100:200])
+        response, body = self.request('GET', '/download/missing.bin')
+        self.assertEqual(response.status, 404)
+
+    def test_thumbnail_pending(self):
+        with open(os.path.join(fta.UPLOAD_FOLDER, f'{self.port}.jpg'), 'wb') as f:
+            f.write(os.urandom(1024))
+        release = threading.Event()
+
+        def render(filepath, out_path):
+            release.wait(10)
+            with open(out_path, 'wb') as f:
+                f.write(b'preview')
+        # Stand-in renderer, so the test needs neither Pillow nor ffmpeg
+        fta.thumbnails.available = lambda filepath: True
+        fta.thumbnails.render_image = fta.thumbnails.render_frame = render
+        try:
+            response, body = self.request('GET', f'/thumbnail/{self.port}.jpg')
+            self.assertEqual(response.status, 202)
+            self.assertEqual(response.getheader('Retry-After'), str(fta.THUMBNAIL_RETRY_AFTER))
+            release.set()
+            for _ in range(100):
+                response, body = self.request('GET', f'/thumbnail/{self.port}.jpg')
+                if response.status != 202:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(body, b'preview')
+        finally:
+            release.set()
+            for name in ('available', 'render_image', 'render_frame'):
+                vars(fta.thumbnails).pop(name, None)
+
+    def test_zip_download(self):
+        data = b''.join(b'%d,%d,reading\n' % (i, i * i % 977) for i in range(40000))
+        with open(os.path.join(fta.UPLOAD_FOLDER, 'readings.csv'), 'wb') as f:
+            f.write(data)
+        sizes = []
+        for level in (1, 9):
+            saved, fta.ZIP_COMPRESS_LEVEL = fta.ZIP_COMPRESS_LEVEL, level
+            try:
+                response, body = self.request('GET', '/download_zip?names=readings.csv')
+            finally:
+                fta.ZIP_COMPRESS_LEVEL = saved
+            self.assertEqual(response.status, 200)
+            with zipfile.ZipFile(io.BytesIO(body)) as archive:
+                self.assertEqual(archive.read('readings.csv'), data)
+                sizes.append(archive.getinfo('readings.csv').compress_size)
+        # The configured level reaches the compressor
+        self.assertGreater(sizes[0], sizes[1])
+
+    def test_delta(self):
+        import delta_sync
+        old = os.urandom(64 * 1024)
+        new = old[:1000] + b'inserted' + old[1000:30000] + os.urandom(8000) + old[30000:]
+        with open(os.path.join(fta.UPLOAD_FOLDER, 'delta.bin'), 'wb') as f:
+            f.write(new)
+        with open('delta-old.bin', 'wb') as f:
+            f.write(old)
+        payload = {'block_size': 1024, 'size': len(old), 'blocks': delta_sync.signatures('delta-old.bin', 1024)}
+        # Rolled byte by byte, then with a budget that runs out in the new bytes
+        for limit, most in ((fta.DELTA_SCAN_LIMIT, 12000), (2048, len(new) - 16 * 1024)):
+            saved, fta.DELTA_SCAN_LIMIT = fta.DELTA_SCAN_LIMIT, limit
+            try:
+                response, body = self.request('POST', '/delta/delta.bin', json.dumps(payload),
+                                              {'Content-Type': 'application/json'})
+            finally:
+                fta.DELTA_SCAN_LIMIT = saved
+            self.assertEqual(response.status, 200, body)
+            rebuilt = io.BytesIO()
+            self.assertLess(delta_sync.apply_delta(io.BytesIO(body), 'delta-old.bin', 1024, rebuilt), most)
+            self.assertEqual(rebuilt.getvalue(), new)
+
+    def test_compressed_download(self):
+        data = b'timestamp,level,message\n' * 20000
+        with open(os.path.join(fta.UPLOAD_FOLDER, 'log.csv'), 'wb') as f:
+            f.write(data)
+        response, body = self.request('GET', '/download/log.csv', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), data)
+        limit, fta.COMPRESSION_MAX_SIZE = fta.COMPRESSION_MAX_SIZE, len(data) - 1
+        try:
+            response, body = self.request('GET', '/download/log.csv', headers={'Accept-Encoding': 'gzip'})
+        finally:
+            fta.COMPRESSION_MAX_SIZE = limit
+        self.assertIsNone(response.getheader('Content-Encoding'))
+        self.assertEqual(response.getheader('Content-Length'), str(len(data)))
+        self.assertEqual(body, data)
+
+    def test_events(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        conn.request('GET', '/events')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type').split(';')[0], 'text/event-stream')
+        self.assertIn(b'event: hello', response.fp.readline() + response.fp.readline() + response.fp.readline())
+        conn.close()
+
+class DevelopmentServerTests(EngineTests, unittest.TestCase):
+    def start_server(self):
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, fta.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, server.shutdown
+
+class TransferServerTests(EngineTests, unittest.TestCase):
+    def start_server(self):
+        server = fta.TransferServer(fta.app, '127.0.0.1', 0, workers=4)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, server.shutdown
+
+    def test_events_do_not_hold_workers(self):
+        streams = []
+        for _ in range(6):
+            conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+            conn.request('GET', '/events')
+            self.assertEqual(conn.getresponse().status, 200)
+            streams.append(conn)
+        response, _ = self.request('GET', '/list_files')
+        self.assertEqual(response.status, 200)
+        for conn in streams:
+            conn.close()
+
+class AsyncTransferServerTests(EngineTests, unittest.TestCase):
+    def start_server(self):
+        server = fta.AsyncTransferServer(fta.app, '127.0.0.1', 0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        return server, stop
+
+    def test_restart_with_open_stream(self):
+        # Stop -> Start in the GUI: the port is free again even with a stream open
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        conn.request('GET', '/events')
+        self.assertEqual(conn.getresponse().status, 200)
+        self.stop()
+        server = fta.AsyncTransferServer(fta.app, '127.0.0.1', self.port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.stop = server.shutdown
+        response, _ = self.request('GET', '/list_files')
+        self.assertEqual(response.status, 200)
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
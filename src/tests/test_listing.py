@@ -0,0 +1,92 @@
+"""Paged /list_files: cursors, sorting and filters.
+
+Every test lists only its own files by filtering on a name prefix.
+
+    python -m unittest discover -s tests
+"""
+import os
+import unittest
+
+import support
+
+fta = None
+
+def setUpModule():
+    global fta
+    fta = support.load_app()
+
+class ListPageTests(unittest.TestCase):
+    prefix = 'page-'
+
+    def setUp(self):
+        self.client = fta.app.test_client()
+        self.names = []
+        for i in range(25):
+            self.add(f'{self.prefix}{i:02d}.{"txt" if i % 2 else "jpg"}', i * 100)
+
+    def tearDown(self):
+        for name in os.listdir(fta.UPLOAD_FOLDER):
+            if name.startswith(self.prefix):
+                os.remove(os.path.join(fta.UPLOAD_FOLDER, name))
+        fta.share_index.invalidate()
+
+    def add(self, name, size):
+        with open(os.path.join(fta.UPLOAD_FOLDER, name), 'wb') as f:
+            f.truncate(size)
+        self.names.append(name)
+        fta.share_index.invalidate()
+
+    def remove(self, name):
+        os.remove(os.path.join(fta.UPLOAD_FOLDER, name))
+        self.names.remove(name)
+        fta.share_index.invalidate()
+
+    def page(self, **params):
+        response = self.client.get('/list_files', query_string=dict(q=self.prefix, **params))
+        self.assertEqual(response.status_code, 200, response.data)
+        data = response.get_json()
+        return [entry['name'] for entry in data['files']], data['next_cursor']
+
+    def walk(self, **params):
+        names, cursor = self.page(**params)
+        while cursor:
+            more, cursor = self.page(cursor=cursor, **params)
+            names += more
+        return names
+
+    def test_pages_cover_everything_once(self):
+        self.assertEqual(self.walk(limit=10), sorted(self.names))
+        self.assertEqual(self.walk(limit=7, order='desc'), sorted(self.names, reverse=True))
+        by_size = self.walk(limit=4, sort='size')
+        self.assertEqual(by_size, sorted(self.names, key=lambda name: int(name[5:7])))
+
+    def test_cursor_survives_insertions_and_deletions(self):
+        first, cursor = self.page(limit=10)
+        self.assertEqual(first, sorted(self.names)[:10])
+        # Before the cursor, right after it, and at the end; one seen and one unseen file go
+        self.add(self.prefix + '00a.txt', 1)
+        self.add(self.prefix + '09a.txt', 1)
+        self.add(self.prefix + '99.txt', 1)
+        self.remove(self.prefix + '03.txt')
+        self.remove(self.prefix + '12.jpg')
+        rest = []
+        while cursor:
+            more, cursor = self.page(limit=10, cursor=cursor)
+            rest += more
+        self.assertEqual(rest, [name for name in sorted(self.names) if name > first[-1]])
+        self.assertNotIn(self.prefix + '00a.txt', rest)
+
+    def test_filters(self):
+        names, _ = self.page(ext='txt', min_size=500, max_size=1500)
+        self.assertEqual(names, sorted(name for name in self.names
+                                       if name.endswith('.txt') and 500 <= int(name[5:7]) * 100 <= 1500))
+        names, _ = self.page(limit=50)
+        self.assertEqual(len(names), 25)
+
+    def test_bad_parameters(self):
+        for params in ({'sort': 'colour'}, {'limit': 0}, {'cursor': 'garbage'}):
+            response = self.client.get('/list_files', query_string=params)
+            self.assertEqual(response.status_code, 400, params)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+"""Transfer queue: admission, ticket order and slot release.
+
+    python -m unittest discover -s tests
+"""
+import http.client
+import os
+import threading
+import time
+import unittest
+
+import support
+
+fta = None
+
+def setUpModule():
+    global fta
+    fta = support.load_app()
+
+MB = 1024 * 1024
+
+class TransferSchedulerTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = fta.TransferScheduler(limit=1, queue_size=3)
+        self.running, _ = self.queue.admit('10.0.0.9', 100 * MB)
+        self.assertIsNotNone(self.running)
+
+    def test_small_transfers_skip_the_line(self):
+        slot, ticket = self.queue.admit('10.0.0.1', 1024)
+        self.assertIsNotNone(slot)
+        self.assertIsNone(ticket)
+
+    def test_order_small_files_and_idle_devices_first(self):
+        _, big = self.queue.admit('10.0.0.1', 500 * MB)
+        _, busy = self.queue.admit('10.0.0.9', 2 * MB)
+        _, small = self.queue.admit('10.0.0.2', 2 * MB)
+        # Renewing a ticket reports its current place
+        positions = {name: self.queue.admit(ticket.client, ticket.size, ticket.id)[1].position
+                     for name, ticket in (('big', big), ('busy', busy), ('small', small))}
+        self.assertEqual(positions, {'small': 1, 'big': 2, 'busy': 3})
+
+    def test_freed_slot_is_held_for_the_first_in_line(self):
+        _, first = self.queue.admit('10.0.0.1', 2 * MB)
+        self.queue.release(self.running)
+        # A newcomer doesn't take the slot set aside for the ticket
+        slot, ticket = self.queue.admit('10.0.0.2', 2 * MB)
+        self.assertIsNone(slot)
+        self.assertEqual(ticket.position, 1)
+        slot, _ = self.queue.admit('10.0.0.1', 2 * MB, first.id)
+        self.assertIsNotNone(slot)
+
+    def test_full_queue(self):
+        for i in range(3):
+            self.assertIsNotNone(self.queue.admit(f'10.0.1.{i}', 2 * MB)[1])
+        self.assertEqual(self.queue.admit('10.0.2.1', 2 * MB), (None, None))
+
+    def test_segments_of_one_upload_share_a_slot(self):
+        self.queue.release(self.running)
+        first, _ = self.queue.admit('10.0.0.1', 50 * MB, group='session')
+        second, _ = self.queue.admit('10.0.0.1', 50 * MB, group='session')
+        self.assertIs(first, second)
+        self.assertIsNone(self.queue.admit('10.0.0.2', 2 * MB)[0])
+
+class QueueProbeTests(unittest.TestCase):
+    def setUp(self):
+        self.limit = fta.upload_queue.limit
+        fta.upload_queue.running.clear()
+        fta.upload_queue.waiting.clear()
+        fta.upload_queue.configure(1)
+        self.slot, _ = fta.upload_queue.admit('192.0.2.1', 1 << 30)
+        self.client = fta.app.test_client()
+
+    def tearDown(self):
+        fta.upload_queue.running.clear()
+        fta.upload_queue.waiting.clear()
+        fta.upload_queue.configure(self.limit)
+
+    def test_busy_then_admitted(self):
+        response = self.client.get('/queue/upload?size=' + str(50 * MB))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], str(fta.QUEUE_RETRY_AFTER))
+        data = response.get_json()
+        self.assertEqual(data['position'], 1)
+        self.assertEqual(response.headers['X-Queue-Ticket'], data['ticket'])
+        fta.upload_queue.release(self.slot)
+        response = self.client.get('/queue/upload', headers={'X-Queue-Ticket': data['ticket']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {'ticket': data['ticket'], 'position': 0})
+
+    def test_upload_refused_before_its_body(self):
+        response = self.client.post('/upload', data=b'x' * (2 * MB),
+                                    headers={'Content-Type': 'multipart/form-data; boundary=b'})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('ticket', response.get_json())
+
+class SlotReleaseTests(unittest.TestCase):
+    # A download abandoned halfway gives its slot back
+    def setUp(self):
+        self.limit = fta.download_queue.limit
+        fta.download_queue.running.clear()
+        fta.download_queue.waiting.clear()
+        fta.download_queue.configure(1)
+        with open(os.path.join(fta.UPLOAD_FOLDER, 'large.bin'), 'wb') as f:
+            f.truncate(256 * MB)
+        self.server = fta.TransferServer(fta.app, '127.0.0.1', 0, workers=2)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        fta.download_queue.configure(self.limit)
+        os.remove(os.path.join(fta.UPLOAD_FOLDER, 'large.bin'))
+
+    def test_early_close(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=10)
+        conn.request('GET', '/download/large.bin')
+        response = conn.getresponse()
+        self.assertEqual(response.status, 200)
+        response.read(MB)
+        self.assertEqual(len(fta.download_queue.running), 1)
+        conn.sock.shutdown(2)
+        conn.close()
+        deadline = time.monotonic() + 10
+        while fta.download_queue.running and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(fta.download_queue.running, {})
+
+class DownloadAdmissionTests(unittest.TestCase):
+    # One download slot, taken by another device for the whole test
+    def setUp(self):
+        self.limit = fta.download_queue.limit
+        # Whatever other test modules left behind doesn't count
+        fta.download_queue.running.clear()
+        fta.download_queue.waiting.clear()
+        fta.download_queue.configure(1)
+        self.slot, _ = fta.download_queue.admit('192.0.2.1', 1 << 30)
+        self.assertIsNotNone(self.slot)
+        self.size = 4 * fta.QUEUE_MIN_SIZE
+        with open(os.path.join(fta.UPLOAD_FOLDER, 'movie.mp4'), 'wb') as f:
+            f.truncate(self.size)
+        self.client = fta.app.test_client()
+
+    def tearDown(self):
+        fta.download_queue.release(self.slot)
+        fta.download_queue.waiting.clear()
+        fta.download_queue.configure(self.limit)
+
+    def test_whole_file_waits(self):
+        response = self.client.get('/download/movie.mp4')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('X-Queue-Ticket', response.headers)
+
+    def test_head_and_304_skip_the_queue(self):
+        response = self.client.head('/download/movie.mp4')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = self.client.get('/download/movie.mp4', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/download/movie.mp4', headers={'If-None-Match': '"other"'})
+        self.assertEqual(response.status_code, 503)
+
+    def test_ranges_are_admitted_by_their_size(self):
+        response = self.client.get('/download/movie.mp4', headers={'Range': 'bytes=0-65535'})
+        self.assertEqual(response.status_code, 206)
+        response.close()
+        response = self.client.get('/download/movie.mp4', headers={'Range': f'bytes=0-{self.size // 2}'})
+        self.assertEqual(response.status_code, 503)
+
+    def test_unchanged_delta_skips_the_queue(self):
+        etag = self.client.head('/download/movie.mp4').headers['ETag']
+        response = self.client.post('/delta/movie.mp4', json={'block_size': 1024, 'size': 0, 'blocks': []},
+                                    headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+"""Bandwidth shaping: token buckets, fair shares and a shaped download.
+
+Rates are checked against the clock with a generous tolerance.
+
+    python -m unittest discover -s tests
+"""
+import http.client
+import os
+import threading
+import time
+import unittest
+
+import support
+
+fta = None
+
+def setUpModule():
+    global fta
+    fta = support.load_app()
+
+MB = 1024 * 1024
+
+class TokenBucketTests(unittest.TestCase):
+    def test_steady_rate(self):
+        # The caller sleeps off each reservation, on a simulated clock
+        bucket = fta.TokenBucket(MB)
+        start = now = bucket.updated
+        for _ in range(40):
+            now += bucket.reserve(fta.SHAPING_QUANTUM, now)
+        # 10 MB at 1 MB/s
+        self.assertAlmostEqual(now - start, 10.0, places=6)
+
+    def test_unlimited(self):
+        bucket = fta.TokenBucket(0)
+        self.assertEqual(bucket.reserve(100 * MB, time.monotonic()), 0.0)
+
+    def test_idle_time_only_buys_a_burst(self):
+        bucket = fta.TokenBucket(MB)
+        now = bucket.updated + 3600
+        self.assertEqual(bucket.reserve(bucket.burst, now), 0.0)
+        self.assertAlmostEqual(bucket.reserve(MB, now), 1.0)
+
+class BandwidthShaperTests(unittest.TestCase):
+    def run_clients(self, shaper, clients, duration):
+        sent = dict.fromkeys(clients, 0)
+        stop = time.monotonic() + duration
+
+        def transfer(client):
+            while time.monotonic() < stop:
+                delay = shaper.reserve(client, fta.SHAPING_QUANTUM)
+                sent[client] += fta.SHAPING_QUANTUM
+                time.sleep(delay)
+        threads = [threading.Thread(target=transfer, args=(client,)) for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {client: count / duration for client, count in sent.items()}
+
+    def test_total_is_shared_fairly(self):
+        shaper = fta.BandwidthShaper(4 * MB)
+        rates = self.run_clients(shaper, ['10.0.0.1', '10.0.0.2'], 2.0)
+        self.assertLess(abs(sum(rates.values()) - 4 * MB), 1.5 * MB, rates)
+        self.assertLess(abs(rates['10.0.0.1'] - rates['10.0.0.2']), MB, rates)
+
+    def test_client_limit(self):
+        shaper = fta.BandwidthShaper(0, 2 * MB)
+        rates = self.run_clients(shaper, ['10.0.0.1', '10.0.0.2'], 1.5)
+        for rate in rates.values():
+            self.assertLess(abs(rate - 2 * MB), 0.75 * MB, rates)
+
+    def test_live_reconfiguration(self):
+        shaper = fta.BandwidthShaper(2 * MB)
+        self.assertTrue(shaper.active)
+        shaper.configure(0, 0)
+        self.assertFalse(shaper.active)
+        self.assertEqual(shaper.reserve('10.0.0.1', 100 * MB), 0.0)
+
+class ShapedDownloadTests(unittest.TestCase):
+    def setUp(self):
+        self.size = 3 * MB
+        with open(os.path.join(fta.UPLOAD_FOLDER, 'shaped.bin'), 'wb') as f:
+            f.write(os.urandom(self.size))
+        fta.download_shaper.configure(2 * MB, 0)
+        self.server = fta.TransferServer(fta.app, '127.0.0.1', 0, workers=2)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        fta.download_shaper.configure(fta.DOWNLOAD_LIMIT, fta.CLIENT_DOWNLOAD_LIMIT)
+        self.server.shutdown()
+
+    def test_download_rate(self):
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=10)
+        started = time.monotonic()
+        conn.request('GET', '/download/shaped.bin')
+        body = conn.getresponse().read()
+        elapsed = time.monotonic() - started
+        conn.close()
+        self.assertEqual(len(body), self.size)
+        # 3 MB at 2 MB/s, less the first burst
+        expected = (self.size - fta.SHAPING_BURST * 2 * MB) / (2 * MB)
+        self.assertGreater(elapsed, expected * 0.8)
+        self.assertLess(elapsed, expected * 1.6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Share folder index: rescans only on change, versioned ETags and 304s.
+
+    python -m unittest discover -s tests
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+
+fta = None
+
+def setUpModule():
+    global fta
+    fta = support.load_app()
+
+class ShareIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='share-', dir=fta.UPLOAD_FOLDER)
+        self.index = fta.ShareIndex(self.folder)
+        self.interval = fta.INDEX_RESCAN_INTERVAL
+
+    def tearDown(self):
+        fta.INDEX_RESCAN_INTERVAL = self.interval
+        shutil.rmtree(self.folder)
+
+    def add(self, name, data=b'x'):
+        with open(os.path.join(self.folder, name), 'wb') as f:
+            f.write(data)
+        # The folder mtime may not move within one tick; the app invalidates on its own writes
+        self.index.invalidate()
+
+    def test_unchanged_folder_keeps_its_version(self):
+        self.add('a.txt')
+        etag, listing = self.index.json_listing()
+        self.assertEqual([entry['name'] for entry in json.loads(listing)['files']], ['a.txt'])
+        self.index.invalidate()
+        self.assertEqual(self.index.json_listing(), (etag, listing))
+
+    def test_changes_bump_the_version(self):
+        self.add('a.txt')
+        first, _ = self.index.json_listing()
+        self.add('b.txt')
+        second, listing = self.index.json_listing()
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(entry['name'] for entry in json.loads(listing)['files']), ['a.txt', 'b.txt'])
+        os.remove(os.path.join(self.folder, 'a.txt'))
+        self.index.invalidate()
+        self.assertNotEqual(self.index.json_listing()[0], second)
+
+    def test_edit_in_place_is_found_by_the_periodic_rescan(self):
+        self.add('a.txt')
+        etag, _ = self.index.json_listing()
+        path = os.path.join(self.folder, 'a.txt')
+        with open(path, 'wb') as f:
+            f.write(b'longer')
+        # Leaves the folder mtime alone; only the rescan interval notices
+        fta.INDEX_RESCAN_INTERVAL = 0
+        etag2, listing = self.index.json_listing()
+        self.assertNotEqual(etag, etag2)
+        self.assertEqual(json.loads(listing)['files'][0]['size'], 6)
+
+class ListFilesTests(unittest.TestCase):
+    def setUp(self):
+        self.client = fta.app.test_client()
+
+    def test_not_modified(self):
+        response = self.client.get('/list_files')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = self.client.get('/list_files', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        with open(os.path.join(fta.UPLOAD_FOLDER, 'etag-test.txt'), 'wb') as f:
+            f.write(b'new')
+        fta.share_index.invalidate()
+        response = self.client.get('/list_files', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('etag-test.txt', [entry['name'] for entry in response.get_json()['files']])
+
+if __name__ == '__main__':
+    unittest.main()